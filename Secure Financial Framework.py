@@ -1,35 +1,69 @@
+import argparse
+import functools
+import math
 import sqlite3
-from tabulate import tabulate
-import hashlib
-import pyotp
-import qrcode
-
-MAX_ATTEMPTS = 3
+from schema import initialize_database
+from transfer_engine import transfer_funds
+from history import iter_transactions, display_history_pages
+from connection_pool import configure, get_manager, resolve_connection, account_connection, close_all
+import instrumentation
+from instrumentation import idle, timed
+from auth import MAX_ATTEMPTS, hash_password, is_account_locked, authenticate_account, verify_admin_password, get_verification_pool
+from checkpoints import advance_checkpoints
+from aggregates import advance_aggregates, rebuild_aggregates, daily_volume, top_accounts, unusual_activity, display_report, DAILY_VOLUME_HEADERS, TOP_ACCOUNT_HEADERS, UNUSUAL_HEADERS, TOP_ORDERS
+from archive import drop_archives
+from statements import export_statement
+from account_listing import display_account_pages, export_accounts, SORT_COLUMNS
+from account_repository import get_account, invalidate_accounts, invalidate_all_accounts, record_failed_attempt, reset_failed_attempts
+from group_commit import commit_write, enable_group_commit, disable_group_commit
+from snapshots import enable_snapshots, disable_snapshots, reporting_connection, describe_staleness
+from limiter import enable_limiter, disable_limiter, login_retry_after, reserve_spending, release_spending, forget_account, reset_limiter
+from provisioning import create_accounts
+from sharding import configure_shards, get_router, close_shards, release_shards, data_connections, recorded_shard_count
 
 class BankAccount:
-    def __init__(self, name, acc_num, conn):
+    # Columns of the accounts row mirrored as attributes; assignments to them are tracked until flushed
+    _COLUMNS = ("total_amount", "total_dep", "total_wit", "total_tra", "incorrect_password_attempts", "is_locked", "two_factor_enabled", "incorrect_2fa_attempts")
+    # Running totals are written as deltas, so postings made meanwhile by other sessions are kept
+    _COUNTERS = frozenset(("total_amount", "total_dep", "total_wit", "total_tra"))
+    _TRACKED = frozenset(_COLUMNS)
+    __slots__ = ("name", "acc_num", "conn", "autoflush", "_loaded", "_dirty", "_pending", "_tickets") + _COLUMNS
+
+    def __init__(self, name, acc_num, conn=None, autoflush=True):
         # Initialize BankAccount object with name, account number, and connection to the database
+        # (the calling thread's pooled connection when none is given, the account's shard when sharded)
+        # With autoflush off the account works as a unit of work: deposits and withdrawals stay
+        # pending until flush() (or the end of a with-block) writes them in one commit.
+        self._dirty = set()
+        self._pending = []
+        # Spending-limit reservations of the queued withdrawals, given back if they are never written
+        self._tickets = []
         self.name = name
         self.acc_num = acc_num
-        self.conn = conn
+        self.conn = account_connection(acc_num, conn)
+        self.autoflush = autoflush
         # Initialize account details by fetching values from the database
         self._initialize_account()
 
+    # Method to record which tracked columns were assigned since the last load or flush
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name in BankAccount._TRACKED:
+            self._dirty.add(name)
+
     def _initialize_account(self):
-        # Fetch account details from the database based on the account number
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT total_amount, total_dep, total_wit, total_tra, incorrect_password_attempts, is_locked, two_factor_enabled, incorrect_2fa_attempts FROM accounts WHERE acc_num=?", (self.acc_num,))
-        account_details = cursor.fetchone()
+        # Fetch account details based on the account number, through the account row cache
+        account_details = get_account(self.conn, self.acc_num)
         if account_details:
             # If account details are found, initialize attributes with database values
-            self.total_amount = account_details[0]
-            self.total_dep = account_details[1]
-            self.total_wit = account_details[2]
-            self.total_tra = account_details[3]
-            self.incorrect_password_attempts = account_details[4]
-            self.is_locked = account_details[5]
-            self.two_factor_enabled = account_details[6]
-            self.incorrect_2fa_attempts = account_details[7]
+            self.total_amount = account_details[2]
+            self.total_dep = account_details[3]
+            self.total_wit = account_details[4]
+            self.total_tra = account_details[5]
+            self.incorrect_password_attempts = account_details[6]
+            self.is_locked = account_details[7]
+            self.two_factor_enabled = account_details[9]
+            self.incorrect_2fa_attempts = account_details[10]
             
         else:
             # If account details are not found, initialize attributes with default values
@@ -41,16 +75,29 @@ class BankAccount:
             self.is_locked = 0
             self.two_factor_enabled = False  # Default value is False
             self.incorrect_2fa_attempts = 0
+        self._mark_clean()
+
+    # Method to treat the current attribute values as what the database holds
+    def _mark_clean(self):
+        self._loaded = {column: getattr(self, column) for column in self._COLUMNS}
+        self._dirty.clear()
 
     # Method to deposit funds into the account
+    @timed("deposit")
     def deposit(self, amount):
         self.total_amount += amount
         self.total_dep += amount
         self._record_transaction('deposit', amount)
 
     # Method to withdraw funds from the account
+    @timed("withdraw")
     def withdraw(self, amount):
         if amount <= self.total_amount:
+            ticket, message = reserve_spending(self.acc_num, amount)
+            if ticket is None:
+                print(message)
+                return
+            self._tickets.append(ticket)
             self.total_amount -= amount
             self.total_wit += amount
             self._record_transaction('withdrawal', -amount)
@@ -58,28 +105,112 @@ class BankAccount:
             print("Insufficient funds")
 
     # Method to transfer funds from this account to another account
+    # The debit, credit and both ledger rows are written in one transaction by the transfer engine
+    @timed("transfer")
     def transfer(self, amount, target_acc):
-        if amount <= self.total_amount:
-            self.total_amount -= amount
-            target_acc.deposit(amount)
-            self.total_tra += amount  # Update total_transferred
-            self._record_transaction('transfer', -amount)
-            target_acc._record_transaction('transfer', amount)
+        # The transfer is a unit-of-work boundary: both accounts are reloaded afterwards
+        self.flush()
+        target_acc.flush()
+        ticket, message = reserve_spending(self.acc_num, amount)
+        if ticket is None:
+            print(message)
+            return
+        router = get_router()
+        if router is not None:
+            # Accounts on different shards are moved by the router's two-phase transfer
+            success, message = router.transfer(self.acc_num, target_acc.acc_num, amount)
         else:
-            print("Insufficient funds")
+            success, message = transfer_funds(self.conn, self.acc_num, target_acc.acc_num, amount)
+        if success:
+            # Refresh both objects from the committed rows instead of trusting cached balances
+            self._initialize_account()
+            target_acc._initialize_account()
+        else:
+            release_spending(self.acc_num, ticket)
+            print(message)
 
-    # Method to record transaction details in the database
+    # Method to queue a ledger row; it is written together with the changed columns by flush()
     def _record_transaction(self, transaction_type, amount):
-        cursor = self.conn.cursor()
-        cursor.execute("INSERT INTO transactions (acc_num, transaction_type, amount) VALUES (?, ?, ?)",
-                       (self.acc_num, transaction_type, amount))
-        self.conn.commit()
+        self._pending.append((self.acc_num, transaction_type, amount))
+        if self.autoflush:
+            self.flush()
+
+    # Method to write the queued ledger rows and only the changed columns in a single commit
+    # Returns False without touching the database if nothing changed. Queued rows get the
+    # flush time as their timestamp.
+    def flush(self):
+        assignments = []
+        params = []
+        for column in self._COLUMNS:
+            if column not in self._dirty:
+                continue
+            value = getattr(self, column)
+            if column in self._COUNTERS:
+                if value != self._loaded[column]:
+                    assignments.append(f"{column} = {column} + ?")
+                    params.append(value - self._loaded[column])
+            elif value != self._loaded[column]:
+                assignments.append(f"{column} = ?")
+                params.append(value)
+        if not assignments and not self._pending:
+            self._dirty.clear()
+            return False
 
-    # Method to retrieve transaction history for this account
-    def get_transaction_history(self):
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT * FROM transactions WHERE acc_num=?", (self.acc_num,))
-        return cursor.fetchall()
+        pending = list(self._pending)
+
+        def write(conn):
+            cursor = conn.cursor()
+            if pending:
+                cursor.executemany("INSERT INTO transactions (acc_num, transaction_type, amount) VALUES (?, ?, ?)", pending)
+            if assignments:
+                cursor.execute(f"UPDATE accounts SET {', '.join(assignments)} WHERE acc_num=?", params + [self.acc_num])
+            if pending:
+                # Fold the new rows into the balance checkpoints and daily aggregates in the same commit
+                advance_checkpoints(conn, [self.acc_num])
+                advance_aggregates(conn)
+
+        try:
+            # Committed on this account's connection, or batched with other sessions' writes
+            # when group commit is on
+            commit_write(self.conn, self.acc_num, write)
+        except BaseException:
+            # The withdrawals weren't written, so they don't count against the spending limit
+            self._release_tickets()
+            raise
+        finally:
+            invalidate_accounts(self.conn, self.acc_num)
+        self._pending.clear()
+        self._tickets.clear()
+        self._mark_clean()
+        return True
+
+    # Method to give back the spending-limit reservations of withdrawals that weren't written
+    def _release_tickets(self):
+        for ticket in self._tickets:
+            release_spending(self.acc_num, ticket)
+        self._tickets.clear()
+
+    # Method to drop the queued changes and reload the account from the database
+    def discard(self):
+        self._pending.clear()
+        self._release_tickets()
+        self._initialize_account()
+
+    # A with-block is a unit of work: flushed on success, discarded if an exception escapes
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+        else:
+            self.discard()
+        return False
+
+    # Method to stream transaction history for this account
+    # Accepts the filters of history.iter_history_pages (after_id, start, end, transaction_types, page_size)
+    def get_transaction_history(self, **filters):
+        return iter_transactions(self.conn, self.acc_num, **filters)
 
     # Method to display account details
     def check_details(self):
@@ -100,51 +231,48 @@ class BankAccount:
         print("Account locked:" + ("Yes" if self.is_locked else "No"))
         print("---------------THANK-YOU----------------")
 
-    # Method to update account details in the database
+    # Method to update account details in the database; writes only what changed (see flush)
     def update_database(self):
-        cursor = self.conn.cursor()
-        cursor.execute("UPDATE accounts SET total_amount=?, total_dep=?, total_wit=?, total_tra=?, incorrect_password_attempts=?, is_locked=?, incorrect_2fa_attempts=? WHERE acc_num=?", 
-                       (self.total_amount, self.total_dep, self.total_wit, self.total_tra, self.incorrect_password_attempts, self.is_locked, self.incorrect_2fa_attempts, self.acc_num))
-        self.conn.commit()
+        return self.flush()
 
     # Method to delete the account from the database
+    @timed("delete_account")
     def delete_account(self, password):
         cursor = self.conn.cursor()
-        cursor.execute("SELECT * FROM accounts WHERE acc_num=? AND password=?", (self.acc_num, password))
-        account_exists = cursor.fetchone() is not None
+        account_exists = authenticate_account(self.conn, self.acc_num, password) is not None
 
         if account_exists:
             cursor.execute("DELETE FROM accounts WHERE acc_num=?", (self.acc_num,))
             self.conn.commit()
+            invalidate_accounts(self.conn, self.acc_num)
             print("Account deleted successfully.")
         else:
             print("Account not found or incorrect password.")
         
-    # Method to display transaction history for this account
-    def display_transaction_history(self):
-        transactions = self.get_transaction_history()
-        headers = ["Transaction ID", "Transaction Type", "Amount", "Timestamp"]
-        print(tabulate(transactions, headers=headers, tablefmt="grid"))
+    # Method to display transaction history for this account, one page at a time
+    # Read from the reporting snapshot when snapshots are enabled, so it never holds up writers
+    @timed("history")
+    def display_transaction_history(self, **filters):
+        describe_staleness()
+        display_history_pages(reporting_connection(self.acc_num, self.conn), self.acc_num, **filters)
 
+    # Method to write this account's statement to a file ('csv' or 'columnar' format)
+    def export_statement(self, path, fmt="csv", start=None, end=None):
+        return export_statement(self.conn, self.acc_num, path, fmt, start, end)
 
-# Function to hash the given password using SHA-256 algorithm
-def hash_password(password):
-    hashed_password = hashlib.sha256(password.encode()).hexdigest()
-    return hashed_password
 
 # Function to create a new account
-def create_account(conn):
+@timed("create_account")
+def create_account(conn=None):
+    conn = resolve_connection(conn)
     try:
-        name = input("Enter your name: ")
-        password = hash_password(input("Set your password: "))
-        cursor = conn.cursor()
-        cursor.execute("SELECT MAX(acc_num) FROM accounts")
-        last_acc_num = cursor.fetchone()[0] or 0
-        acc_num = last_acc_num + 1
-        # Insert new account details into the accounts table
-        cursor.execute("INSERT INTO accounts (name, acc_num, total_amount, total_dep, total_wit, total_tra, incorrect_password_attempts, is_locked, password, two_factor_enabled, incorrect_2fa_attempts) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", 
-                    (name, acc_num, 0, 0, 0, 0, 0, 0, password, 0, 0))
-        conn.commit()
+        with idle():
+            name = input("Enter your name: ")
+            password = input("Set your password: ")
+        password = hash_password(password)
+        # Insert new account details into the accounts table under the next number of the
+        # account sequence (on the account's shard when sharded)
+        acc_num = create_accounts(conn, [(name, password)])[0]
         print(f"Account created successfully with account number: {acc_num}")
         return BankAccount(name, acc_num, conn)
     except sqlite3.OperationalError as e:
@@ -152,43 +280,124 @@ def create_account(conn):
         print("The 'accounts' table does not exist or the database has been cleared.")
         print("Exit the program and rerun it, to initialize database and enable creation of new user accounts")
 
-# Function to display all accounts
-def display_accounts(conn):
+# Function to display all accounts, one page at a time
+# Accepts the filters and sort options of account_listing.iter_account_pages; with export_path
+# the listing is written to a CSV file instead of the screen. Reads the reporting snapshots
+# when snapshots are enabled.
+@timed("display_accounts")
+def display_accounts(conn=None, export_path=None, **options):
+    conn = reporting_connection(conn=conn)
+    router = get_router()
+    if router is not None:
+        # Every page is gathered from all shards in parallel
+        options["fetch_page"] = functools.partial(router.fetch_account_page, from_snapshot=True)
+    describe_staleness()
     try:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM accounts")
-        accounts = cursor.fetchall()
-
-        if len(accounts) == 0:  # Check if there are no accounts
-            print("No accounts found.")
+        if export_path:
+            written = export_accounts(conn, export_path, **options)
+            print(f"Exported {written} accounts to {export_path}")
         else:
-            headers = ["Username", "Account Number", "Balance", "Consecutive Incorrect Password Attempts", "Consecutive Incorrect 2FA Attempts", "Account Status"]
-            account_data = [(acc[0], acc[1], acc[2], acc[6], acc[10],  "Locked" if acc[7] == 1 or acc[6] >= MAX_ATTEMPTS or acc[10] >= MAX_ATTEMPTS else "Unlocked") for acc in accounts]
-            print(tabulate(account_data, headers=headers, tablefmt="grid"))
+            display_account_pages(conn, **options)
 
     except sqlite3.OperationalError as e:
         print("Error:", e)
         print("No accounts exist due to database deletion by admin.")
         print("Exit the program and rerun it, to initialize database and enable creation of new user accounts")
 
+# Function to ask the admin for optional account listing filters and sort order
+def get_listing_options():
+    options = {}
+    if input("Apply filters or sorting? (yes/no): ").lower() != 'yes':
+        return options
+    options['locked_only'] = input("Show locked accounts only? (yes/no): ").lower() == 'yes'
+    min_balance = input("Minimum balance (leave blank for none): ").strip()
+    if min_balance:
+        options['min_balance'] = int(min_balance)
+    max_balance = input("Maximum balance (leave blank for none): ").strip()
+    if max_balance:
+        options['max_balance'] = int(max_balance)
+    name_prefix = input("Name starts with (leave blank for any): ").strip()
+    if name_prefix:
+        options['name_prefix'] = name_prefix
+    min_attempts = input("Minimum consecutive incorrect password attempts (leave blank for any): ").strip()
+    if min_attempts:
+        options['min_password_attempts'] = int(min_attempts)
+    sort_by = input("Sort by (" + ", ".join(SORT_COLUMNS) + "; leave blank for acc_num): ").strip()
+    if sort_by:
+        if sort_by not in SORT_COLUMNS:
+            print("Unknown sort column, sorting by acc_num.")
+        else:
+            options['sort_by'] = sort_by
+            options['descending'] = input("Descending order? (yes/no): ").lower() == 'yes'
+    return options
+
+# Function to show the admin activity reports, answered from the daily aggregates (see aggregates.py)
+@timed("activity_reports")
+def activity_reports(conn=None):
+    conn = resolve_connection(conn)
+    while True:
+        print("\n  1. Daily Volume ")
+        print("  2. Top Accounts by Flow ")
+        print("  3. Unusual Activity ")
+        print("  4. Rebuild Aggregates ")
+        print("  5. Back ")
+
+        choice = get_user_choice("Enter your choice: ")
+        if choice in (1, 2, 3):
+            describe_staleness()
+
+        try:
+            if choice == 1:
+                start = input("First day (YYYY-MM-DD, leave blank for all): ").strip() or None
+                end = input("Day after the last (YYYY-MM-DD, leave blank for all): ").strip() or None
+                display_report(daily_volume(conn, start, end), DAILY_VOLUME_HEADERS)
+            elif choice == 2:
+                limit = input("Number of accounts (leave blank for 10): ").strip()
+                by = input("Rank by (" + ", ".join(TOP_ORDERS) + "; leave blank for gross): ").strip() or "gross"
+                start = input("First day (YYYY-MM-DD, leave blank for all): ").strip() or None
+                end = input("Day after the last (YYYY-MM-DD, leave blank for all): ").strip() or None
+                display_report(top_accounts(conn, int(limit) if limit else 10, start, end, by), TOP_ACCOUNT_HEADERS)
+            elif choice == 3:
+                day = input("Day (YYYY-MM-DD, leave blank for today): ").strip() or None
+                display_report(unusual_activity(conn, day), UNUSUAL_HEADERS)
+            elif choice == 4:
+                written = sum(rebuild_aggregates(data_conn) for data_conn in data_connections(conn))
+                print(f"Aggregates rebuilt: {written} rows.")
+            elif choice == 5:
+                break
+            else:
+                print("Invalid choice")
+        except ValueError as e:
+            print("Error:", e)
+
 # Function to lock or unlock a user account
+@timed("lock_unlock_account")
 def lock_unlock_account(conn, acc_num, lock_status):
-    cursor = conn.cursor()
-    
-    cursor.execute("UPDATE accounts SET is_locked=? WHERE acc_num=?", (lock_status, acc_num))
-    conn.commit()
+    conn = account_connection(acc_num, conn)
+    commit_write(conn, acc_num, lambda conn: conn.execute("UPDATE accounts SET is_locked=? WHERE acc_num=?", (lock_status, acc_num)))
+    invalidate_accounts(conn, acc_num)
     if lock_status:
         print(f"Account with account number {acc_num} is locked.")
     else:
-        password = hash_password(input("Enter new password to unlock account:"))
-        pass_cursor = conn.cursor()
-        pass_cursor.execute("UPDATE accounts SET password=? where acc_num=?", (password, acc_num)) 
+        with idle():
+            password = input("Enter new password to unlock account:")
+        password = hash_password(password)
+
+        def unlock(conn):
+            cursor = conn.cursor()
+            cursor.execute("UPDATE accounts SET password=? where acc_num=?", (password, acc_num))
+            cursor.execute("UPDATE accounts SET incorrect_password_attempts = 0 WHERE acc_num = ?", (acc_num,))
+            cursor.execute("UPDATE accounts SET incorrect_2fa_attempts = 0 WHERE acc_num = ?", (acc_num,))
+
+        # Unwritten failure counters would otherwise be overlaid on the reset row
+        forget_account(acc_num)
+        commit_write(conn, acc_num, unlock)
         print(f"Account with account number {acc_num} is unlocked.")
-        cursor.execute("UPDATE accounts SET incorrect_password_attempts = 0 WHERE acc_num = ?", (acc_num,))
-        cursor.execute("UPDATE accounts SET incorrect_2fa_attempts = 0 WHERE acc_num = ?", (acc_num,))
+        invalidate_accounts(conn, acc_num)
 
 # Function to create an admin account
-def create_admin(conn):
+def create_admin(conn=None):
+    conn = resolve_connection(conn)
     admin_password = hash_password(input("Set your admin password: "))
     cursor = conn.cursor()
     cursor.execute("INSERT INTO admin VALUES (?)", (admin_password,))
@@ -197,16 +406,32 @@ def create_admin(conn):
 
 # Function to delete the entire database (only accessible by admin)
 def delete_database(conn, password):
+    conn = resolve_connection(conn)
     cursor = conn.cursor()
-    cursor.execute("SELECT * FROM admin WHERE password=?", (password,))
-    admin_exists = cursor.fetchone() is not None
+    admin_exists = verify_admin_password(conn, password)
 
     if admin_exists:
         confirm_delete = input("Are you sure you want to delete the entire database? This will delete all accounts and their transaction history. (yes/no): ")
         if confirm_delete.lower() == 'yes':
-            cursor.execute("DROP TABLE accounts")
-            cursor.execute("DROP TABLE transactions")
+            drop_archives(conn)
+            # Account data lives in the shard files when the database is sharded
+            for data_conn in data_connections(conn):
+                data_conn.execute("DROP TABLE accounts")
+                data_conn.execute("DROP TABLE transactions")
+                data_conn.execute("DROP TABLE IF EXISTS balance_checkpoints")
+                data_conn.execute("DROP TABLE IF EXISTS balance_checkpoint_state")
+                data_conn.execute("DROP TABLE IF EXISTS daily_aggregates")
+                data_conn.execute("DROP TABLE IF EXISTS aggregate_state")
+                data_conn.execute("DROP TABLE IF EXISTS transfer_outbox")
+                data_conn.execute("DROP TABLE IF EXISTS transfer_inbox")
+                data_conn.commit()
+            cursor.execute("DROP TABLE IF EXISTS import_progress")
+            cursor.execute("DROP TABLE IF EXISTS account_sequence")
+            cursor.execute("DROP TABLE IF EXISTS archive_partitions")
+            cursor.execute("DROP TABLE IF EXISTS limiter_state")
             conn.commit()
+            reset_limiter()
+            invalidate_all_accounts()
             print("Database cleared successfully.")
             print("Exit the program and rerun it, to Initialize Database and enable Creation of new user accounts")
         else:
@@ -216,16 +441,32 @@ def delete_database(conn, password):
 
 # Function to clear the accounts and transactions tables (only accessible by admin)
 def clear_tables(conn, password):
+    conn = resolve_connection(conn)
     cursor = conn.cursor()
-    cursor.execute("SELECT * FROM admin WHERE password=?", (password,))
-    admin_exists = cursor.fetchone() is not None
+    admin_exists = verify_admin_password(conn, password)
 
     if admin_exists:
         confirm_clear = input("Are you sure you want to clear the accounts and transactions tables? This will remove all data from these tables. (yes/no): ")
         if confirm_clear.lower() == 'yes':
-            cursor.execute("DELETE FROM accounts")
-            cursor.execute("DELETE FROM transactions")
+            drop_archives(conn)
+            for data_conn in data_connections(conn):
+                data_conn.execute("DELETE FROM accounts")
+                data_conn.execute("DELETE FROM transactions")
+                data_conn.execute("DELETE FROM balance_checkpoints")
+                data_conn.execute("DELETE FROM balance_checkpoint_state")
+                data_conn.execute("DELETE FROM daily_aggregates")
+                data_conn.execute("DELETE FROM aggregate_state")
+                if get_router() is not None:
+                    data_conn.execute("DELETE FROM transfer_outbox")
+                    data_conn.execute("DELETE FROM transfer_inbox")
+                data_conn.commit()
+            cursor.execute("DELETE FROM import_progress")
+            # Numbering starts over, as the accounts are gone
+            cursor.execute("DELETE FROM account_sequence")
+            cursor.execute("DELETE FROM limiter_state")
             conn.commit()
+            reset_limiter()
+            invalidate_all_accounts()
             print("Tables cleared successfully.")
         else:
             print("Clear operation canceled.")
@@ -246,11 +487,11 @@ def get_user_choice(prompt):
             print("Please enter a choice.")
 
 # Function to change the main admin password
-def change_admin_password(conn):
-    admin_password = hash_password(input("Enter current admin password: "))
+def change_admin_password(conn=None):
+    conn = resolve_connection(conn)
+    admin_password = input("Enter current admin password: ")
     cursor = conn.cursor()
-    cursor.execute("SELECT * FROM admin WHERE password=?", (admin_password,))
-    admin_exists = cursor.fetchone() is not None
+    admin_exists = verify_admin_password(conn, admin_password)
 
     if admin_exists:
         new_password = hash_password(input("Enter new admin password: "))
@@ -261,11 +502,11 @@ def change_admin_password(conn):
         print("Incorrect admin password. Password change failed.")
 
 # Function to remove or reset the admin password
-def remove_admin_password(conn):
-    admin_password = hash_password(input("Enter current admin password: "))
+def remove_admin_password(conn=None):
+    conn = resolve_connection(conn)
+    admin_password = input("Enter current admin password: ")
     cursor = conn.cursor()
-    cursor.execute("SELECT * FROM admin WHERE password=?", (admin_password,))
-    admin_exists = cursor.fetchone() is not None
+    admin_exists = verify_admin_password(conn, admin_password)
 
     if admin_exists:
         remove = input("Do you want to remove the admin password? (yes/no): ").lower()
@@ -288,11 +529,10 @@ def enable_2fa(account, conn, cursor):
         choice = input("Do you want to enable Two-Factor Authentication? (yes/no): ").lower()
         success = two_factor_authentication(account)
         if choice == 'yes' and success:
-            # Update the database to indicate that 2FA is enabled for this account
-            cursor.execute("UPDATE accounts SET two_factor_enabled = 1 WHERE acc_num = ?", (account.acc_num,))
-            conn.commit()
+            # Update the attribute and write just that column to the database
+            account.two_factor_enabled = 1
+            account.update_database()
             print("Two-Factor Authentication has been enabled successfully.")
-            account.two_factor_enabled = True  # Update the attribute in memory
         elif success:
             print("Two-Factor Authentication was not enabled.")
         else:
@@ -302,6 +542,10 @@ def enable_2fa(account, conn, cursor):
 
 # Function to generate and display the QR code for 2FA setup
 def two_factor_authentication(account):
+    # Loaded on first use so sessions that never touch 2FA don't pay for pyotp, qrcode and PIL
+    import pyotp
+    import qrcode
+
     # Generate a shared secret key for the user
     secret_key = pyotp.random_base32()
     # Create a TOTP object using the secret key
@@ -329,27 +573,18 @@ def two_factor_authentication(account):
     else:
         return False
 
-# Main function to run the banking system
-def main():
-    conn = sqlite3.connect('bank.db')
+# Function to open the database, create the tables and make sure an admin password exists
+# With shards (or when the database was split before) accounts live in that many shard files
+# next to it and cross-shard transfers interrupted by a crash are completed here.
+def prepare_database(path='bank.db', shards=None):
+    # Pooled per-thread connections in WAL mode so readers and writers don't block each other
+    manager = configure(path, 'wal')
+    conn = manager.acquire()
     # Create necessary tables if they don't exist already
-    conn.execute('''CREATE TABLE IF NOT EXISTS accounts 
-                 (name TEXT, acc_num INTEGER PRIMARY KEY, total_amount INTEGER, 
-                 total_dep INTEGER, total_wit INTEGER, total_tra INTEGER, 
-                 incorrect_password_attempts INTEGER DEFAULT 0, is_locked INTEGER DEFAULT 0, 
-                 password TEXT, two_factor_enabled INTEGER DEFAULT 0, 
-                 incorrect_2fa_attempts INTEGER DEFAULT 0)''')
-
-    conn.execute('''CREATE TABLE IF NOT EXISTS admin 
-                     (password TEXT PRIMARY KEY)''')
-    
-    conn.execute('''CREATE TABLE IF NOT EXISTS transactions
-                 (transaction_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  acc_num INTEGER,
-                  transaction_type TEXT,
-                  amount INTEGER,
-                  timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                  FOREIGN KEY (acc_num) REFERENCES accounts(acc_num))''')
+    initialize_database(conn)
+    shards = shards or recorded_shard_count(path)
+    if shards:
+        configure_shards(path, shards, 'wal').initialize()
 
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM admin")
@@ -358,6 +593,12 @@ def main():
     # Create admin account if it doesn't exist already
     if not admin_exists:
         create_admin(conn)
+    return conn
+
+# Function to run one interactive session, from the main menu until the user exits
+def run_session(conn=None):
+    conn = resolve_connection(conn)
+    cursor = conn.cursor()
 
     # Main loop to handle user and admin interactions
     while True:
@@ -368,10 +609,9 @@ def main():
         choice = get_user_choice("Enter your choice: ")
 
         if choice == 1:
-            admin_password = hash_password(input("Enter admin password: "))
+            admin_password = input("Enter admin password: ")
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM admin WHERE password=?", (admin_password,))
-            admin_exists = cursor.fetchone() is not None
+            admin_exists = verify_admin_password(conn, admin_password)
 
             if admin_exists:
                 while True:
@@ -384,15 +624,15 @@ def main():
                     print("  7. Change Admin Password ")
                     print("  8. Remove Admin Password ")
                     print("  9. Lock/Unlock User Account ")
-                    print("  10. Exit ")
+                    print("  10. Activity Reports ")
+                    print("  11. Exit ")
 
                     admin_choice = get_user_choice("Enter your choice: ")
 
                     if admin_choice == 1:
                         acc_num = int(input("Enter your account number: "))
-                        password = hash_password(input("Enter your password: "))
-                        cursor.execute("SELECT * FROM accounts WHERE acc_num=? AND password=?", (acc_num, password))
-                        account_details = cursor.fetchone()
+                        password = input("Enter your password: ")
+                        account_details = authenticate_account(conn, acc_num, password)
                         if account_details:
                             account = BankAccount(account_details[0], account_details[1], conn)
                             account.check_details()
@@ -402,21 +642,22 @@ def main():
                         account = create_account(conn)
                     elif admin_choice == 3:
                         acc_num = int(input("Enter the account number you want to delete: "))
-                        password = hash_password(input("Enter your password: "))
-                        cursor.execute("SELECT * FROM accounts WHERE acc_num=?", (acc_num,))
-                        account_details = cursor.fetchone()
+                        password = input("Enter your password: ")
+                        account_details = get_account(conn, acc_num)
                         if account_details:
                             account = BankAccount(account_details[0], account_details[1], conn)
                             account.delete_account(password)
                         else:
                             print("Account not found.")
                     elif admin_choice == 4:
-                        display_accounts(conn)
+                        options = get_listing_options()
+                        export_path = input("Export to a CSV file? Enter a file path or leave blank to display: ").strip()
+                        display_accounts(conn, export_path, **options)
                     elif admin_choice == 5:
-                        admin_password = hash_password(input("Enter admin password to delete database: "))
+                        admin_password = input("Enter admin password to delete database: ")
                         clear_tables(conn, admin_password)
                     elif admin_choice == 6:
-                        admin_password = hash_password(input("Enter admin password to delete database: "))
+                        admin_password = input("Enter admin password to delete database: ")
                         delete_database(conn, admin_password)
                     elif admin_choice == 7:
                         change_admin_password(conn)
@@ -427,6 +668,8 @@ def main():
                         lock_status = int(input("Enter lock status (1 for lock, 0 for unlock): "))
                         lock_unlock_account(conn, acc_num, lock_status)
                     elif admin_choice == 10:
+                        activity_reports(conn)
+                    elif admin_choice == 11:
                         break
                     else:
                         print("Invalid choice")
@@ -443,21 +686,25 @@ def main():
                 if user_choice == 1:
                     try:
                         acc_num = int(input("Enter your account number: "))
-                        password = hash_password(input("Enter your password: "))
-                        cursor.execute("SELECT * FROM accounts WHERE acc_num=?AND password=?", (acc_num, password))
-                        account_details = cursor.fetchone()
+                        # A throttled account is turned away before its password is hashed or anything is written
+                        retry_after = login_retry_after(acc_num)
+                        if retry_after:
+                            print(f"Too many failed attempts. Try again in {math.ceil(retry_after)} seconds.")
+                            continue
+                        password = input("Enter your password: ")
+                        account_details = authenticate_account(conn, acc_num, password)
                         if account_details:
-                            if account_details[7] == 1 or account_details[6] >= MAX_ATTEMPTS or account_details[10] >= MAX_ATTEMPTS:
+                            if is_account_locked(account_details[7], account_details[6], account_details[10]):
                                 print("Account is locked. Please contact admin.")
                                 continue
                             # reinitialize consecutive incorrect login attempts to 0
-                            cursor.execute("UPDATE accounts SET incorrect_password_attempts = 0 WHERE acc_num = ?", (acc_num,))
+                            reset_failed_attempts(conn, acc_num, 'password', account_details[6])
                             account = BankAccount(account_details[0], account_details[1], conn)
                             if account.two_factor_enabled:
                                 # Verify Two-Factor Authentication (2FA)
                                 success = two_factor_authentication(account)
                                 if success:
-                                    cursor.execute("UPDATE accounts SET incorrect_2fa_attempts = 0 WHERE acc_num = ?", (acc_num,))
+                                    reset_failed_attempts(conn, acc_num, '2fa', account.incorrect_2fa_attempts)
                                     print("Login successful!")
                                     while True:
                                         print("\n  1. Deposit Amount ")
@@ -481,22 +728,18 @@ def main():
                                         elif option == 3:
                                             amount = int(input("Enter the amount you want to transfer: "))
                                             target_acc_num = int(input("Enter the target account number: "))
-                                            cursor.execute("SELECT * FROM accounts WHERE acc_num=?", (target_acc_num,))
-                                            target_account_details = cursor.fetchone()
+                                            target_account_details = get_account(conn, target_acc_num)
                                             if target_account_details:
                                                 target_account = BankAccount(target_account_details[0], target_account_details[1], conn)
                                                 account.transfer(amount, target_account)
-                                                account.update_database()
-                                                target_account.update_database()
                                             else:
                                                 print("Target account not found.")
                                         elif option == 4:
                                             account.check_details()
                                         elif option == 5:
                                             acc_num = int(input("Enter your account number: "))
-                                            password = hash_password(input("Enter your password: "))
-                                            cursor.execute("SELECT * FROM accounts WHERE acc_num=? AND password=?", (acc_num, password))
-                                            account_details = cursor.fetchone()
+                                            password = input("Enter your password: ")
+                                            account_details = authenticate_account(conn, acc_num, password)
                                             if account_details:
                                                 account = BankAccount(account_details[0], account_details[1], conn)
                                                 account.display_transaction_history()
@@ -510,25 +753,17 @@ def main():
                                         else:
                                             print("Invalid choice")
                                 else:
-                                    cursor.execute("SELECT * FROM accounts WHERE acc_num=?", (acc_num,))
-                                    account_details = cursor.fetchone()
+                                    # Increment login attempts for 2FA and read the new count in one statement
+                                    failed_2fa_attempts = record_failed_attempt(conn, acc_num, '2fa')
 
-                                    if account_details:
-                                        cursor.execute("SELECT * FROM accounts WHERE acc_num=?", (acc_num,))
-                                        updated_account_details = cursor.fetchone()
-                                        if updated_account_details[10] < MAX_ATTEMPTS:
+                                    if failed_2fa_attempts is not None:
+                                        if failed_2fa_attempts - 1 < MAX_ATTEMPTS:
                                             print("Authentication failed. Please try again.")
                                         else:
                                             print("Authentication failed.")
-                                        # Increment login attempts for 2FA
-                                        cursor.execute("UPDATE accounts SET incorrect_2fa_attempts = incorrect_2fa_attempts + 1 WHERE acc_num = ?", (acc_num,))
-                                        conn.commit()  # Commit the changes
-                                        # Retrieve the updated account details
-                                        cursor.execute("SELECT * FROM accounts WHERE acc_num=?", (acc_num,))
-                                        updated_account_details = cursor.fetchone()
-                                        if updated_account_details[10] == MAX_ATTEMPTS:
+                                        if failed_2fa_attempts == MAX_ATTEMPTS:
                                             print("Account is locked after" + str(MAX_ATTEMPTS) + " consecutive failed authentication attempts. Please contact admin.")
-                                        if updated_account_details[10] > MAX_ATTEMPTS:
+                                        if failed_2fa_attempts > MAX_ATTEMPTS:
                                             print("Account is locked. Please contact admin.")
                             else:
                                 print("Login successful!")
@@ -554,22 +789,18 @@ def main():
                                     elif option == 3:
                                         amount = int(input("Enter the amount you want to transfer: "))
                                         target_acc_num = int(input("Enter the target account number: "))
-                                        cursor.execute("SELECT * FROM accounts WHERE acc_num=?", (target_acc_num,))
-                                        target_account_details = cursor.fetchone()
+                                        target_account_details = get_account(conn, target_acc_num)
                                         if target_account_details:
                                             target_account = BankAccount(target_account_details[0], target_account_details[1], conn)
                                             account.transfer(amount, target_account)
-                                            account.update_database()
-                                            target_account.update_database()
                                         else:
                                             print("Target account not found.")
                                     elif option == 4:
                                         account.check_details()
                                     elif option == 5:
                                         acc_num = int(input("Enter your account number: "))
-                                        password = hash_password(input("Enter your password: "))
-                                        cursor.execute("SELECT * FROM accounts WHERE acc_num=? AND password=?", (acc_num, password))
-                                        account_details = cursor.fetchone()
+                                        password = input("Enter your password: ")
+                                        account_details = authenticate_account(conn, acc_num, password)
                                         if account_details:
                                             account = BankAccount(account_details[0], account_details[1], conn)
                                             account.display_transaction_history()
@@ -583,20 +814,14 @@ def main():
                                     else:
                                         print("Invalid choice")        
                         else:
-                            cursor.execute("SELECT * FROM accounts WHERE acc_num=?", (acc_num,))
-                            account_details = cursor.fetchone()
+                            # Increment login attempts for password and read the new count in one statement
+                            failed_attempts = record_failed_attempt(conn, acc_num, 'password')
 
-                            if account_details:
+                            if failed_attempts is not None:
                                 print("Incorrect Password")
-                                # Increment login attempts for password
-                                cursor.execute("UPDATE accounts SET incorrect_password_attempts = incorrect_password_attempts + 1 WHERE acc_num = ?", (acc_num,))
-                                conn.commit()  # Commit the changes
-                                # Retrieve the updated account details
-                                cursor.execute("SELECT * FROM accounts WHERE acc_num=?", (acc_num,))
-                                updated_account_details = cursor.fetchone()
-                                if updated_account_details[6] == MAX_ATTEMPTS:
+                                if failed_attempts == MAX_ATTEMPTS:
                                     print("Account is locked after " + str(MAX_ATTEMPTS) + " consecutive failed login attempts. Please contact admin.")
-                                if updated_account_details[6] > MAX_ATTEMPTS:
+                                if failed_attempts > MAX_ATTEMPTS:
                                     print("Account is locked. Please contact admin.")
                             else:
                                 print("Account does not exist")
@@ -615,7 +840,94 @@ def main():
         else:
             print("Invalid choice")
 
-    conn.close()
+# Function to run a session on a pooled connection; used by the session daemon for each client
+def pooled_session():
+    with get_manager().connection() as conn:
+        try:
+            run_session(conn)
+        finally:
+            release_shards()
+
+# Main function to run the banking system
+# group_commit holds the enable_group_commit options when sessions should commit in groups,
+# snapshots the enable_snapshots options when reports should read a snapshot, and limits the
+# enable_limiter options when logins and payments should be rate limited
+def main(shards=None, group_commit=None, snapshots=None, limits=None):
+    conn = prepare_database(shards=shards)
+    if group_commit is not None:
+        enable_group_commit(**group_commit)
+    if snapshots is not None:
+        enable_snapshots(**snapshots)
+    if limits is not None:
+        enable_limiter(**limits)
+    run_session(conn)
+    disable_limiter()
+    disable_snapshots()
+    disable_group_commit()
+    close_shards()
+    close_all()
+    get_verification_pool().shutdown()
+    instrumentation.shutdown()
+
+# Function to keep the system loaded and serve sessions over a Unix socket (see session_daemon.py)
+def run_daemon(socket_path, shards=None, group_commit=None, snapshots=None, limits=None):
+    import session_daemon
+    # Load what sessions import lazily, so no session pays for it
+    import pyotp
+    import qrcode
+    import tabulate
+
+    prepare_database(shards=shards)
+    if group_commit is not None:
+        # Concurrent sessions share one writer per database file, so their commits are batched
+        enable_group_commit(**group_commit)
+    if snapshots is not None:
+        # Admin listings and reports of every session read the same refreshed copy
+        enable_snapshots(**snapshots)
+    if limits is not None:
+        # Every session shares the windows, so throttling holds across concurrent sessions
+        enable_limiter(**limits)
+    # Hand the start-up connection back so the first session reuses it
+    get_manager().release()
+    try:
+        session_daemon.serve(pooled_session, socket_path)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        disable_limiter()
+        disable_snapshots()
+        disable_group_commit()
+        close_shards()
+        close_all()
+        get_verification_pool().shutdown()
+        instrumentation.shutdown()
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Secure Financial Framework")
+    parser.add_argument("--daemon", action="store_true", help="stay resident and serve sessions to bank_session.py clients")
+    parser.add_argument("--socket", default="bank.sock", help="Unix socket for --daemon")
+    parser.add_argument("--shards", type=int, help="keep accounts in this many shard files next to bank.db (see sharding.py)")
+    parser.add_argument("--group-commit", action="store_true", help="commit the writes of concurrent sessions in batches on one writer thread")
+    parser.add_argument("--group-commit-delay", type=float, default=2.0, help="milliseconds a group-commit batch stays open")
+    parser.add_argument("--group-commit-batch", type=int, default=500, help="most writes in one group-commit batch")
+    parser.add_argument("--snapshots", action="store_true", help="serve listings, history and reports from a periodically refreshed copy of the database")
+    parser.add_argument("--snapshot-interval", type=float, default=60.0, help="seconds between snapshot refreshes")
+    parser.add_argument("--snapshot-io-share", type=float, default=0.1, help="largest share of time a snapshot refresh spends copying")
+    parser.add_argument("--limits", action="store_true", help="throttle repeated failed logins and cap the money an account can send per window")
+    parser.add_argument("--login-failures", type=int, default=5, help="failed logins allowed per login window")
+    parser.add_argument("--login-window", type=float, default=300.0, help="seconds of the failed-login window")
+    parser.add_argument("--spend-limit", type=int, help="most an account can withdraw and transfer per spending window (default unlimited)")
+    parser.add_argument("--spend-window", type=float, default=86400.0, help="seconds of the spending window")
+    parser.add_argument("--metrics", help="write statement and operation metrics to this file in Prometheus text format")
+    parser.add_argument("--metrics-interval", type=float, default=instrumentation.DEFAULT_INTERVAL, help="seconds between metrics writes")
+    args = parser.parse_args()
+    if args.metrics:
+        instrumentation.configure(args.metrics, args.metrics_interval)
+    group_commit = {"max_delay": args.group_commit_delay / 1000, "max_batch": args.group_commit_batch} if args.group_commit else None
+    snapshots = {"interval": args.snapshot_interval, "io_share": args.snapshot_io_share} if args.snapshots else None
+    limits = {"login_failures": args.login_failures, "login_window": args.login_window,
+              "spend_limit": args.spend_limit, "spend_window": args.spend_window} if args.limits else None
+    if args.daemon:
+        run_daemon(args.socket, args.shards, group_commit, snapshots, limits)
+    else:
+        main(args.shards, group_commit, snapshots, limits)
@@ -0,0 +1,129 @@
+import csv
+
+from instrumentation import idle
+from schema import LOCKED_CONDITION
+
+DEFAULT_PAGE_SIZE = 500
+ACCOUNT_HEADERS = ["Username", "Account Number", "Balance", "Consecutive Incorrect Password Attempts", "Consecutive Incorrect 2FA Attempts", "Account Status"]
+
+_SELECT = ("SELECT name, acc_num, total_amount, incorrect_password_attempts, incorrect_2fa_attempts, "
+           f"CASE WHEN {LOCKED_CONDITION} THEN 'Locked' ELSE 'Unlocked' END FROM accounts")
+
+# sort_by name -> (column, position of that column in the selected row)
+SORT_COLUMNS = {
+    "acc_num": ("acc_num", 1),
+    "name": ("name", 0),
+    "balance": ("total_amount", 2),
+    "password_attempts": ("incorrect_password_attempts", 3),
+    "2fa_attempts": ("incorrect_2fa_attempts", 4),
+}
+
+
+# Function to return the smallest string greater than every string starting with prefix
+def _prefix_upper_bound(prefix):
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+# Function to translate listing filters into SQL conditions and parameters
+def _build_filters(locked_only=False, min_balance=None, max_balance=None, name_prefix=None,
+                   min_password_attempts=None, min_2fa_attempts=None):
+    conditions = []
+    params = []
+    if locked_only:
+        conditions.append(LOCKED_CONDITION)
+    if min_balance is not None:
+        conditions.append("total_amount >= ?")
+        params.append(min_balance)
+    if max_balance is not None:
+        conditions.append("total_amount <= ?")
+        params.append(max_balance)
+    if name_prefix:
+        # A range instead of LIKE so the name index can be used
+        conditions.append("name >= ? AND name < ?")
+        params.extend([name_prefix, _prefix_upper_bound(name_prefix)])
+    if min_password_attempts:
+        # The "> 0" term lets SQLite pick the partial index on accounts with failed attempts
+        conditions.append("incorrect_password_attempts > 0 AND incorrect_password_attempts >= ?")
+        params.append(min_password_attempts)
+    if min_2fa_attempts:
+        conditions.append("incorrect_2fa_attempts > 0 AND incorrect_2fa_attempts >= ?")
+        params.append(min_2fa_attempts)
+    return conditions, params
+
+
+# Function to fetch one page of the account listing after the keyset position `after`
+# `after` is the (sort value, acc_num) of the last row of the previous page, or None for the first page.
+def fetch_account_page(conn, after=None, page_size=DEFAULT_PAGE_SIZE, sort_by="acc_num", descending=False, **filters):
+    if sort_by not in SORT_COLUMNS:
+        raise ValueError(f"Unknown sort column: {sort_by}")
+    if page_size < 1:
+        raise ValueError("page_size must be at least 1")
+    column = SORT_COLUMNS[sort_by][0]
+    conditions, params = _build_filters(**filters)
+    direction = "DESC" if descending else "ASC"
+    comparison = "<" if descending else ">"
+
+    if after is not None:
+        if column == "acc_num":
+            conditions.append(f"acc_num {comparison} ?")
+            params.append(after[1])
+        else:
+            conditions.append(f"({column}, acc_num) {comparison} (?, ?)")
+            params.extend(after)
+
+    sql = _SELECT
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    if column == "acc_num":
+        sql += f" ORDER BY acc_num {direction} LIMIT ?"
+    else:
+        sql += f" ORDER BY {column} {direction}, acc_num {direction} LIMIT ?"
+    cursor = conn.cursor()
+    cursor.execute(sql, params + [page_size])
+    return cursor.fetchall()
+
+
+# Function to stream the account listing page by page; each page is a separate short query
+# fetch_page replaces fetch_account_page, e.g. with a sharding.ShardRouter's scatter-gather version.
+def iter_account_pages(conn, page_size=DEFAULT_PAGE_SIZE, sort_by="acc_num", descending=False, fetch_page=fetch_account_page, **filters):
+    position = SORT_COLUMNS.get(sort_by, (None, 1))[1]
+    after = None
+    while True:
+        page = fetch_page(conn, after, page_size, sort_by, descending, **filters)
+        if page:
+            yield page
+        if len(page) < page_size:
+            return
+        after = (page[-1][position], page[-1][1])
+
+
+# Function to print the account listing one page at a time, waiting for the admin between pages
+def display_account_pages(conn, page_size=50, **options):
+    # Imported here because tabulate is slow to import and only interactive listings need it
+    from tabulate import tabulate
+
+    shown = 0
+    for page in iter_account_pages(conn, page_size=page_size, **options):
+        print(tabulate(page, headers=ACCOUNT_HEADERS, tablefmt="grid"))
+        shown += len(page)
+        if len(page) == page_size:
+            with idle():
+                choice = input("Press Enter for the next page or 'q' to stop: ").strip().lower()
+            if choice == 'q':
+                return shown
+    if shown == 0:
+        print("No accounts found.")
+    return shown
+
+
+# Function to write the full account listing to a CSV file with constant memory
+# Returns the number of accounts written.
+def export_accounts(conn, path, page_size=DEFAULT_PAGE_SIZE, **options):
+    written = 0
+    with open(path, "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(ACCOUNT_HEADERS)
+        for page in iter_account_pages(conn, page_size=page_size, **options):
+            writer.writerows(page)
+            written += len(page)
+    return written
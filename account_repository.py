@@ -0,0 +1,257 @@
+import collections
+import sqlite3
+import threading
+import time
+
+from connection_pool import account_connection
+from group_commit import commit_write
+from limiter import get_limiter
+
+DEFAULT_CACHE_SIZE = 10000
+# Longest a commit made by another process can go unnoticed, in seconds
+DEFAULT_VALIDATE_INTERVAL = 0.1
+# Connections whose database file is remembered before the list starts over
+MAX_TRACKED_CONNECTIONS = 1024
+
+# Column order of SELECT * FROM accounts, used to patch cached rows in place
+ACCOUNT_COLUMNS = ("name", "acc_num", "total_amount", "total_dep", "total_wit", "total_tra",
+                   "incorrect_password_attempts", "is_locked", "password", "two_factor_enabled",
+                   "incorrect_2fa_attempts")
+_COLUMN_INDEX = {name: index for index, name in enumerate(ACCOUNT_COLUMNS)}
+
+# Which counter a failed or successful authentication step touches
+_ATTEMPT_COLUMNS = {"password": "incorrect_password_attempts", "2fa": "incorrect_2fa_attempts"}
+
+
+class AccountRepository:
+    # Bounded LRU cache of accounts rows keyed by (database file, acc_num), so shards, archives
+    # and other databases open in the same process never see each other's rows.
+    # Writers in this process invalidate (or patch) the rows they change. Commits made by other
+    # processes are caught through PRAGMA data_version on one probe connection per database
+    # file, which moves whenever any other connection has committed to that file. The probe is
+    # read at most once per validate_interval, so cache hits rarely pay for it, and commits
+    # made meanwhile cost at most one clear per interval.
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE, validate=True, validate_interval=DEFAULT_VALIDATE_INTERVAL):
+        self.max_size = max_size
+        self.validate = validate
+        self.validate_interval = validate_interval
+        self.hits = 0
+        self.misses = 0
+        self.clears = 0
+        self._rows = collections.OrderedDict()
+        # id(conn) -> (conn, database key); the connection is kept so a reused id can't match
+        self._paths = {}
+        # database file -> [probe connection, data_version, monotonic time of the last check]
+        self._probes = {}
+        # Bumped on every invalidation so a row read concurrently with a write is not cached
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    # Method to return the file of the database conn has open
+    # A private in-memory or temporary database has no file and is keyed by its connection.
+    def _path_of(self, conn):
+        entry = self._paths.get(id(conn))
+        if entry is not None and entry[0] is conn:
+            return entry[1]
+        path = next((file for _, name, file in conn.execute("PRAGMA database_list") if name == "main"), "") or conn
+        with self._lock:
+            if len(self._paths) >= MAX_TRACKED_CONNECTIONS:
+                self._paths.clear()
+            self._paths[id(conn)] = (conn, path)
+        return path
+
+    # Method to drop every cached row if another connection has committed to the database file
+    # since the last check, checking each file at most once per validate_interval
+    def _check_data_version(self, path):
+        if not isinstance(path, str):
+            # Nobody else can commit to a private in-memory database
+            return
+        now = time.monotonic()
+        with self._lock:
+            probe = self._probes.get(path)
+            if probe is not None and now - probe[2] < self.validate_interval:
+                return
+            if probe is None:
+                # Opened before any row of this file is cached, so its first version is the baseline
+                probe_conn = sqlite3.connect(path, check_same_thread=False)
+                self._probes[path] = [probe_conn, probe_conn.execute("PRAGMA data_version").fetchone()[0], now]
+                return
+            version = probe[0].execute("PRAGMA data_version").fetchone()[0]
+            probe[2] = now
+            if version != probe[1]:
+                probe[1] = version
+                self._rows.clear()
+                self._generation += 1
+                self.clears += 1
+
+    # Method to return the accounts row for acc_num, or None if there is no such account
+    def get(self, conn, acc_num):
+        key = (self._path_of(conn), acc_num)
+        if self.validate:
+            self._check_data_version(key[0])
+        with self._lock:
+            row = self._rows.get(key)
+            if row is not None:
+                self._rows.move_to_end(key)
+                self.hits += 1
+                return row
+            self.misses += 1
+            generation = self._generation
+        row = conn.execute("SELECT * FROM accounts WHERE acc_num=?", (acc_num,)).fetchone()
+        if row is not None:
+            with self._lock:
+                if generation != self._generation:
+                    return row
+                self._rows[key] = row
+                self._rows.move_to_end(key)
+                while len(self._rows) > self.max_size:
+                    self._rows.popitem(last=False)
+        return row
+
+    # Method to write changed column values through to a cached row of conn's database, if it is cached
+    def patch(self, conn, acc_num, **fields):
+        key = (self._path_of(conn), acc_num)
+        with self._lock:
+            row = self._rows.get(key)
+            if row is None:
+                return
+            row = list(row)
+            for name, value in fields.items():
+                row[_COLUMN_INDEX[name]] = value
+            self._rows[key] = tuple(row)
+
+    # Method to forget the cached rows of the given accounts of conn's database
+    def invalidate(self, conn, *acc_nums):
+        path = self._path_of(conn)
+        with self._lock:
+            for acc_num in acc_nums:
+                self._rows.pop((path, acc_num), None)
+            self._generation += 1
+
+    # Method to forget every cached row, and the probes, as the database files may be replaced
+    def invalidate_all(self):
+        with self._lock:
+            self._rows.clear()
+            self._generation += 1
+            probes = [probe[0] for probe in self._probes.values()]
+            self._probes.clear()
+            self._paths.clear()
+        for probe_conn in probes:
+            probe_conn.close()
+
+    # Method to report cache size and hit/miss counters
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._rows),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "clears": self.clears,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
+
+
+_repository = AccountRepository()
+
+
+# Function to return the process-wide account repository
+def get_repository():
+    return _repository
+
+
+# Function to fetch an accounts row through the process-wide cache
+# Like the other account functions here it reads the account's shard when the database is sharded.
+# Failure counters the limiter hasn't written yet are applied to the row.
+def get_account(conn, acc_num):
+    row = _repository.get(account_connection(acc_num, conn), acc_num)
+    limiter = get_limiter()
+    if limiter is not None and row is not None:
+        row = limiter.overlay(row)
+    return row
+
+
+# Function to drop the given accounts from the process-wide cache after writing to them on conn
+def invalidate_accounts(conn, *acc_nums):
+    _repository.invalidate(conn, *acc_nums)
+
+
+# Function to drop every account from the process-wide cache (tables cleared or dropped)
+def invalidate_all_accounts():
+    _repository.invalidate_all()
+
+
+# Function to return the process-wide cache counters
+def cache_stats():
+    return _repository.stats()
+
+
+# Function to advance the account number sequence by count inside the caller's open transaction
+# Returns the range of numbers reserved. The first call seeds the sequence with seed() (by
+# default the highest acc_num in conn's accounts table).
+def advance_account_sequence(conn, count, seed=None):
+    if count < 1:
+        raise ValueError("count must be at least 1")
+    row = conn.execute("SELECT last_acc_num FROM account_sequence").fetchone()
+    if row is not None:
+        last_acc_num = row[0]
+    elif seed is not None:
+        last_acc_num = seed()
+    else:
+        last_acc_num = conn.execute("SELECT IFNULL(MAX(acc_num), 0) FROM accounts").fetchone()[0]
+    conn.execute("INSERT OR REPLACE INTO account_sequence (id, last_acc_num) VALUES (1, ?)", (last_acc_num + count,))
+    return range(last_acc_num + 1, last_acc_num + count + 1)
+
+
+# Function to reserve a block of count consecutive account numbers in one short transaction
+# Each creator (a session, a provisioning worker) takes its own block, so creators never
+# compete for the same number; numbers of a block that end up unused are skipped.
+def reserve_account_numbers(conn, count, seed=None):
+    if conn.in_transaction:
+        conn.commit()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        numbers = advance_account_sequence(conn, count, seed)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return numbers
+
+
+# Function to count a failed password or 2FA attempt in a single statement
+# Returns the new number of consecutive failures, or None if the account doesn't exist. With the
+# limiter enabled the count is kept in memory and written by its flusher, so no commit is made.
+def record_failed_attempt(conn, acc_num, kind="password"):
+    column = _ATTEMPT_COLUMNS[kind]
+    conn = account_connection(acc_num, conn)
+    limiter = get_limiter()
+    if limiter is not None:
+        row = get_account(conn, acc_num)
+        if row is None:
+            return None
+        count = limiter.record_failure(acc_num, column, row[_COLUMN_INDEX[column]])
+        _repository.patch(conn, acc_num, **{column: count})
+        return count
+    row = commit_write(conn, acc_num, lambda conn: conn.execute(f"UPDATE accounts SET {column} = {column} + 1 WHERE acc_num = ? RETURNING {column}", (acc_num,)).fetchone())
+    if row is None:
+        return None
+    _repository.patch(conn, acc_num, **{column: row[0]})
+    return row[0]
+
+
+# Function to clear the consecutive failure counter after a successful attempt
+# Skips the write entirely when the cached row shows there is nothing to reset.
+def reset_failed_attempts(conn, acc_num, kind="password", current=None):
+    column = _ATTEMPT_COLUMNS[kind]
+    if current == 0:
+        return
+    conn = account_connection(acc_num, conn)
+    limiter = get_limiter()
+    if limiter is not None:
+        limiter.record_success(acc_num, column)
+        _repository.patch(conn, acc_num, **{column: 0})
+        return
+    commit_write(conn, acc_num, lambda conn: conn.execute(f"UPDATE accounts SET {column} = 0 WHERE acc_num = ? AND {column} != 0", (acc_num,)))
+    _repository.patch(conn, acc_num, **{column: 0})
@@ -0,0 +1,211 @@
+# Columnar in-memory view of the accounts table for operations that touch every account.
+# Run from the repository root:
+#   python account_table.py [--db bank.db] interest RATE        credit RATE percent interest on positive balances
+#   python account_table.py [--db bank.db] fee AMOUNT           charge a flat fee to every account that can cover it
+#   python account_table.py [--db bank.db] lock-below AMOUNT    lock the accounts whose balance is below AMOUNT
+#
+# Accounts are loaded in acc_num order, a chunk at a time, into one NumPy array per column.
+# An operation computes the new values of a whole chunk at once and queues the matching ledger
+# rows ('interest' and 'fee' rows count towards total_amount only, see reconciliation.py);
+# the chunk is then written back with executemany in one transaction, which also holds the
+# write lock while the chunk is read so no posting can slip in between.
+import argparse
+import itertools
+import math
+import sqlite3
+import time
+
+import numpy as np
+
+from account_repository import invalidate_accounts
+from aggregates import advance_aggregates
+from checkpoints import advance_checkpoints
+from schema import initialize_database
+from sharding import data_paths
+
+DEFAULT_CHUNK_SIZE = 10000
+
+COLUMNS = ("acc_num", "total_amount", "total_dep", "total_wit", "total_tra", "is_locked")
+_TOTALS = ("total_amount", "total_dep", "total_wit", "total_tra")
+_SELECT = ("SELECT acc_num, IFNULL(total_amount, 0), IFNULL(total_dep, 0), IFNULL(total_wit, 0), IFNULL(total_tra, 0), IFNULL(is_locked, 0) "
+           "FROM accounts WHERE acc_num > ? ORDER BY acc_num LIMIT ?")
+
+
+# Function to reject an interest rate that isn't a number or would take more than the whole balance
+def _check_rate(rate):
+    if not math.isfinite(rate) or rate < -100:
+        raise ValueError("The interest rate must be a finite percentage of at least -100")
+
+
+class AccountTable:
+    # One chunk of accounts as NumPy int64 columns named like the accounts columns
+    # Operations change the columns in place and queue ledger rows; write() stores the totals as
+    # deltas from the loaded values, so postings committed meanwhile by others are kept.
+    def __init__(self, rows):
+        data = np.fromiter(itertools.chain.from_iterable(rows), dtype=np.int64, count=len(rows) * len(COLUMNS)).reshape(len(rows), len(COLUMNS))
+        for position, column in enumerate(COLUMNS):
+            setattr(self, column, data[:, position].copy())
+        self._loaded = {column: getattr(self, column).copy() for column in _TOTALS + ("is_locked",)}
+        # Queued ledger rows as (acc_num array, transaction_type, amount array)
+        self._ledger = []
+
+    # Method to load up to `limit` accounts with acc_num > after
+    @classmethod
+    def load(cls, conn, after=0, limit=DEFAULT_CHUNK_SIZE):
+        return cls(conn.execute(_SELECT, (after, limit)).fetchall())
+
+    def __len__(self):
+        return len(self.acc_num)
+
+    # Method to return the selection mask of an operation: every account, or those in `where`
+    def _selection(self, where):
+        if where is None:
+            return np.ones(len(self), dtype=bool)
+        return np.asarray(where, dtype=bool)
+
+    # Method to add signed amounts to the balances and queue their ledger rows; zero amounts are skipped
+    def _post(self, amounts, transaction_type):
+        posted = amounts != 0
+        self.total_amount += amounts
+        self._ledger.append((self.acc_num[posted], transaction_type, amounts[posted]))
+        return int(np.count_nonzero(posted))
+
+    # Method to credit interest of `rate` percent on positive balances, rounded down to whole units
+    # Returns the number of accounts credited.
+    def apply_interest(self, rate, where=None):
+        _check_rate(rate)
+        eligible = self._selection(where) & (self.total_amount > 0)
+        interest = np.floor(self.total_amount * (rate / 100)).astype(np.int64)
+        return self._post(np.where(eligible, interest, 0), "interest")
+
+    # Method to charge a flat fee to the selected accounts, skipping those whose balance can't cover it
+    # Returns (charged, skipped).
+    def charge_fee(self, amount, where=None):
+        selected = self._selection(where)
+        covered = selected & (self.total_amount >= amount)
+        charged = self._post(np.where(covered, -amount, 0), "fee")
+        return charged, int(np.count_nonzero(selected & ~covered))
+
+    # Method to lock the selected unlocked accounts whose balance is below threshold
+    # Returns the number of accounts locked.
+    def lock_below(self, threshold, where=None):
+        newly_locked = self._selection(where) & (self.is_locked == 0) & (self.total_amount < threshold)
+        self.is_locked[newly_locked] = 1
+        return int(np.count_nonzero(newly_locked))
+
+    # Method to write the changed accounts and the queued ledger rows, committing once
+    # Runs in the caller's transaction if one is open (apply_in_chunks opens it before loading).
+    # Returns the number of accounts written.
+    def write(self, conn):
+        deltas = np.stack([getattr(self, column) - self._loaded[column] for column in _TOTALS], axis=1)
+        changed_totals = np.flatnonzero(deltas.any(axis=1))
+        changed_locks = np.flatnonzero(self.is_locked != self._loaded["is_locked"])
+        ledger_rows = [(acc_num, transaction_type, amount)
+                       for accs, transaction_type, amounts in self._ledger
+                       for acc_num, amount in zip(accs.tolist(), amounts.tolist())]
+        touched = np.union1d(self.acc_num[changed_totals], self.acc_num[changed_locks]).tolist()
+        cursor = conn.cursor()
+        if not conn.in_transaction:
+            cursor.execute("BEGIN IMMEDIATE")
+        try:
+            cursor.executemany("INSERT INTO transactions (acc_num, transaction_type, amount) VALUES (?, ?, ?)", ledger_rows)
+            cursor.executemany("UPDATE accounts SET total_amount = total_amount + ?, total_dep = total_dep + ?, total_wit = total_wit + ?, total_tra = total_tra + ? WHERE acc_num = ?",
+                               [tuple(row) + (acc_num,) for row, acc_num in zip(deltas[changed_totals].tolist(), self.acc_num[changed_totals].tolist())])
+            cursor.executemany("UPDATE accounts SET is_locked = ? WHERE acc_num = ?",
+                               zip(self.is_locked[changed_locks].tolist(), self.acc_num[changed_locks].tolist()))
+            advance_checkpoints(conn, {row[0] for row in ledger_rows})
+            advance_aggregates(conn)
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            invalidate_accounts(conn, *touched)
+        self._loaded = {column: getattr(self, column).copy() for column in _TOTALS + ("is_locked",)}
+        self._ledger = []
+        return len(touched)
+
+
+# Function to run operation(table) over every account, one chunk per transaction
+# operation takes an AccountTable and returns a count or a tuple of counts, which are summed
+# over the chunks. Returns a report dict with the accounts read and written and the counts.
+def apply_in_chunks(conn, operation, chunk_size=DEFAULT_CHUNK_SIZE):
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be at least 1")
+    report = {"accounts": 0, "written": 0, "chunks": 0, "result": None, "seconds": 0.0}
+    start = time.perf_counter()
+    after = 0
+    if conn.in_transaction:
+        conn.commit()
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            table = AccountTable.load(conn, after, chunk_size)
+            if not len(table):
+                conn.rollback()
+                break
+            result = operation(table)
+            report["written"] += table.write(conn)
+        except BaseException:
+            conn.rollback()
+            raise
+        report["accounts"] += len(table)
+        report["chunks"] += 1
+        if report["result"] is None:
+            report["result"] = result
+        elif isinstance(result, tuple):
+            report["result"] = tuple(total + count for total, count in zip(report["result"], result))
+        else:
+            report["result"] += result
+        after = int(table.acc_num[-1])
+    report["seconds"] = time.perf_counter() - start
+    return report
+
+
+# Function to credit `rate` percent interest to every account with a positive balance
+def apply_interest(conn, rate, chunk_size=DEFAULT_CHUNK_SIZE):
+    _check_rate(rate)
+    return apply_in_chunks(conn, lambda table: table.apply_interest(rate), chunk_size)
+
+
+# Function to charge a flat fee to every account, skipping those that can't cover it
+def charge_fee(conn, amount, chunk_size=DEFAULT_CHUNK_SIZE):
+    if amount <= 0:
+        raise ValueError("The fee must be positive")
+    return apply_in_chunks(conn, lambda table: table.charge_fee(amount), chunk_size)
+
+
+# Function to lock every account whose balance is below threshold
+def lock_below(conn, threshold, chunk_size=DEFAULT_CHUNK_SIZE):
+    return apply_in_chunks(conn, lambda table: table.lock_below(threshold), chunk_size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply interest, fees or balance locks to every account")
+    parser.add_argument("--db", default="bank.db")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("interest", help="credit RATE percent interest on positive balances").add_argument("rate", type=float)
+    subparsers.add_parser("fee", help="charge a flat fee to every account that can cover it").add_argument("amount", type=int)
+    subparsers.add_parser("lock-below", help="lock the accounts whose balance is below AMOUNT").add_argument("amount", type=int)
+    args = parser.parse_args()
+
+    function = {"interest": apply_interest, "fee": charge_fee, "lock-below": lock_below}[args.command]
+    value = args.rate if args.command == "interest" else args.amount
+    # A sharded database keeps its accounts in the shard files
+    for path in data_paths(args.db):
+        conn = sqlite3.connect(path)
+        try:
+            initialize_database(conn)
+            report = function(conn, value, args.chunk_size)
+        finally:
+            conn.close()
+        if args.command == "fee":
+            charged, skipped = report["result"] or (0, 0)
+            outcome = f"charged {charged}, skipped {skipped} with insufficient funds"
+        else:
+            outcome = f"{'credited' if args.command == 'interest' else 'locked'} {report['result'] or 0}"
+        print(f"{path}: {report['accounts']} accounts in {report['seconds']:.2f}s, {outcome}.")
+
+if __name__ == "__main__":
+    main()
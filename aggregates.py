@@ -0,0 +1,209 @@
+# Per-account, per-day, per-transaction-type aggregates of the ledger for admin analytics.
+# Run from the repository root:
+#   python aggregates.py [--db bank.db] rebuild
+#   python aggregates.py [--db bank.db] daily [--start YYYY-MM-DD] [--end YYYY-MM-DD]
+#   python aggregates.py [--db bank.db] top [--limit N] [--by gross|inflow|outflow|net] [--start ...] [--end ...]
+#   python aggregates.py [--db bank.db] unusual [--day YYYY-MM-DD] [--baseline-days N] [--factor F] [--min-gross AMOUNT]
+#
+# daily_aggregates holds one row per (acc_num, day, transaction_type) with the count, signed
+# total, gross (sum of absolute amounts), min and max of the ledger rows behind it. Every posting
+# path calls advance_aggregates in the transaction that inserts its ledger rows; it folds every
+# row past the transaction_id recorded in aggregate_state, so the aggregates always match the
+# committed ledger and the reports never read the transactions table.
+import argparse
+import datetime
+import heapq
+
+import connection_pool
+from archive import ledger_windows, window_select, window_tables
+from history import format_timestamp
+from schema import initialize_database
+
+TOP_ORDERS = {
+    "gross": "gross",
+    "inflow": "(gross + total) / 2",
+    "outflow": "(gross - total) / 2",
+    "net": "total",
+}
+
+DAILY_VOLUME_HEADERS = ["Day", "Transaction Type", "Count", "Total", "Gross"]
+TOP_ACCOUNT_HEADERS = ["Account Number", "Count", "Inflow", "Outflow", "Net"]
+UNUSUAL_HEADERS = ["Account Number", "Count", "Gross", "Average Daily Count", "Average Daily Gross"]
+
+_AGGREGATE_COLUMNS = "acc_num, substr(timestamp, 1, 10), transaction_type, COUNT(*), SUM(amount), SUM(ABS(amount)), MIN(amount), MAX(amount)"
+_UPSERT = ("ON CONFLICT (acc_num, day, transaction_type) DO UPDATE SET count = count + excluded.count, total = total + excluded.total, "
+           "gross = gross + excluded.gross, min_amount = MIN(min_amount, excluded.min_amount), max_amount = MAX(max_amount, excluded.max_amount)")
+_INSERT = "INSERT INTO daily_aggregates (acc_num, day, transaction_type, count, total, gross, min_amount, max_amount) "
+
+
+# Function to fold the ledger rows committed since the last call into the daily aggregates
+# Runs inside the caller's transaction and doesn't commit, so the aggregates are written
+# atomically with the postings that produced them. Returns the number of aggregate rows written.
+def advance_aggregates(conn):
+    cursor = conn.cursor()
+    row = cursor.execute("SELECT transaction_id FROM aggregate_state").fetchone()
+    last_id = row[0] if row is not None else 0
+    newest = cursor.execute("SELECT MAX(transaction_id) FROM transactions").fetchone()[0]
+    if newest is None or newest <= last_id:
+        return 0
+    cursor.execute(_INSERT + f"SELECT {_AGGREGATE_COLUMNS} FROM transactions WHERE transaction_id > ? AND transaction_id <= ? GROUP BY 1, 2, 3 " + _UPSERT,
+                   (last_id, newest))
+    written = cursor.rowcount
+    cursor.execute("INSERT OR REPLACE INTO aggregate_state (id, transaction_id) VALUES (1, ?)", (newest,))
+    return written
+
+
+# Function to recompute the aggregates from the whole ledger, archived months included
+# The ledger is grouped window by window before the write transaction opens, since archives
+# can't be attached inside one; rows posted meanwhile are folded in before the commit.
+# Returns the number of aggregate rows written.
+def rebuild_aggregates(conn):
+    if conn.in_transaction:
+        conn.commit()
+    newest = conn.execute("SELECT MAX(IFNULL((SELECT MAX(transaction_id) FROM transactions), 0), IFNULL((SELECT MAX(max_id) FROM archive_partitions), 0))").fetchone()[0]
+    rows = []
+    for window in ledger_windows(conn):
+        sql, params = window_select(window_tables(conn, window), _AGGREGATE_COLUMNS, ["transaction_id <= ?"], [newest], window[2], window[3])
+        rows.extend(conn.execute(sql + " GROUP BY 1, 2, 3", params))
+    cursor = conn.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        cursor.execute("DELETE FROM daily_aggregates")
+        cursor.executemany(_INSERT + "VALUES (?, ?, ?, ?, ?, ?, ?, ?) " + _UPSERT, rows)
+        cursor.execute("INSERT OR REPLACE INTO aggregate_state (id, transaction_id) VALUES (1, ?)", (newest,))
+        written = len(rows) + advance_aggregates(conn)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return written
+
+
+# Function to return the connections the reports read: every shard when sharded, else conn,
+# each through its reporting snapshot when snapshots are enabled
+def _data_connections(conn):
+    # Imported here because sharding imports the posting paths, which import this module
+    from snapshots import reporting_connections
+    return reporting_connections(conn)
+
+
+# Function to build the day range condition shared by the reports; end is exclusive
+def _day_range(start, end):
+    conditions = []
+    params = []
+    if start is not None:
+        conditions.append("day >= ?")
+        params.append(format_timestamp(start)[:10])
+    if end is not None:
+        conditions.append("day < ?")
+        params.append(format_timestamp(end)[:10])
+    return " AND ".join(conditions) or "1", params
+
+
+# Function to report the ledger volume per day and transaction type in [start, end)
+# Returns (day, transaction_type, count, total, gross) rows, oldest day first.
+def daily_volume(conn=None, start=None, end=None):
+    where, params = _day_range(start, end)
+    volume = {}
+    for data_conn in _data_connections(conn):
+        for day, transaction_type, count, total, gross in data_conn.execute(
+                f"SELECT day, transaction_type, SUM(count), SUM(total), SUM(gross) FROM daily_aggregates WHERE {where} GROUP BY day, transaction_type", params):
+            sums = volume.setdefault((day, transaction_type), [0, 0, 0])
+            sums[0] += count
+            sums[1] += total
+            sums[2] += gross
+    return [key + tuple(sums) for key, sums in sorted(volume.items())]
+
+
+# Function to report the `limit` accounts that moved the most money in [start, end)
+# by is one of TOP_ORDERS: gross (money in plus money out), inflow, outflow or net.
+# Returns (acc_num, count, inflow, outflow, net) rows, largest first.
+def top_accounts(conn=None, limit=10, start=None, end=None, by="gross"):
+    if by not in TOP_ORDERS:
+        raise ValueError(f"Unknown order {by!r}; use one of {', '.join(TOP_ORDERS)}")
+    where, params = _day_range(start, end)
+    rows = []
+    for data_conn in _data_connections(conn):
+        # Every shard holds distinct accounts, so its own top rows are all a merge needs
+        rows.extend(data_conn.execute(
+            f"SELECT acc_num, count, (gross + total) / 2, (gross - total) / 2, total, {TOP_ORDERS[by]} FROM "
+            f"(SELECT acc_num, SUM(count) AS count, SUM(total) AS total, SUM(gross) AS gross FROM daily_aggregates WHERE {where} GROUP BY acc_num) "
+            "ORDER BY 6 DESC, acc_num LIMIT ?", params + [limit]))
+    return [row[:5] for row in heapq.nsmallest(limit, rows, key=lambda row: (-row[5], row[0]))]
+
+
+# Function to report the accounts whose activity on `day` is far above their own recent average
+# An account is reported when its gross on the day is at least min_gross and its gross or count
+# exceeds `factor` times its daily average over the baseline_days before. day defaults to
+# today (UTC, like the ledger timestamps). Returns (acc_num, count, gross, average_count,
+# average_gross) rows, largest gross first.
+def unusual_activity(conn=None, day=None, baseline_days=30, factor=5.0, min_gross=1000):
+    if baseline_days < 1:
+        raise ValueError("baseline_days must be at least 1")
+    day = datetime.date.fromisoformat(format_timestamp(day)[:10]) if day is not None else datetime.datetime.now(datetime.timezone.utc).date()
+    baseline_start = (day - datetime.timedelta(days=baseline_days)).isoformat()
+    rows = []
+    for data_conn in _data_connections(conn):
+        rows.extend(data_conn.execute(
+            "WITH today AS (SELECT acc_num, SUM(count) AS count, SUM(gross) AS gross FROM daily_aggregates WHERE day = ? GROUP BY acc_num HAVING SUM(gross) >= ?), "
+            "baseline AS (SELECT acc_num, SUM(count) * 1.0 / ? AS count, SUM(gross) * 1.0 / ? AS gross FROM daily_aggregates "
+            "WHERE acc_num IN (SELECT acc_num FROM today) AND day >= ? AND day < ? GROUP BY acc_num) "
+            "SELECT today.acc_num, today.count, today.gross, IFNULL(baseline.count, 0), IFNULL(baseline.gross, 0) FROM today LEFT JOIN baseline USING (acc_num) "
+            "WHERE today.gross > ? * IFNULL(baseline.gross, 0) OR today.count > ? * IFNULL(baseline.count, 0)",
+            (day.isoformat(), min_gross, baseline_days, baseline_days, baseline_start, day.isoformat(), factor, factor)))
+    return sorted(rows, key=lambda row: (-row[2], row[0]))
+
+
+# Function to print report rows as a table
+def display_report(rows, headers):
+    # Imported here because tabulate is slow to import and only interactive listings need it
+    from tabulate import tabulate
+    if rows:
+        print(tabulate(rows, headers=headers, tablefmt="grid"))
+    else:
+        print("No activity found.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Daily ledger aggregates and the reports built on them")
+    parser.add_argument("--db", default="bank.db")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("rebuild", help="recompute the aggregates from the whole ledger")
+    daily = subparsers.add_parser("daily", help="volume per day and transaction type")
+    top = subparsers.add_parser("top", help="the accounts that moved the most money")
+    top.add_argument("--limit", type=int, default=10)
+    top.add_argument("--by", choices=list(TOP_ORDERS), default="gross")
+    for report in (daily, top):
+        report.add_argument("--start", help="first day, YYYY-MM-DD")
+        report.add_argument("--end", help="day after the last, YYYY-MM-DD")
+    unusual = subparsers.add_parser("unusual", help="accounts far above their recent daily average")
+    unusual.add_argument("--day", help="YYYY-MM-DD (default today)")
+    unusual.add_argument("--baseline-days", type=int, default=30)
+    unusual.add_argument("--factor", type=float, default=5.0)
+    unusual.add_argument("--min-gross", type=int, default=1000)
+    args = parser.parse_args()
+
+    # Imported here for the same reason as in _data_connections
+    from sharding import close_shards, configure_shards, data_connections, recorded_shard_count
+
+    initialize_database(connection_pool.configure(args.db).acquire())
+    shard_count = recorded_shard_count(args.db)
+    if shard_count:
+        configure_shards(args.db, shard_count).initialize()
+    try:
+        if args.command == "rebuild":
+            written = sum(rebuild_aggregates(conn) for conn in data_connections())
+            print(f"Wrote {written} aggregate rows.")
+        elif args.command == "daily":
+            display_report(daily_volume(start=args.start, end=args.end), DAILY_VOLUME_HEADERS)
+        elif args.command == "top":
+            display_report(top_accounts(limit=args.limit, start=args.start, end=args.end, by=args.by), TOP_ACCOUNT_HEADERS)
+        else:
+            display_report(unusual_activity(day=args.day, baseline_days=args.baseline_days, factor=args.factor, min_gross=args.min_gross), UNUSUAL_HEADERS)
+    finally:
+        close_shards()
+        connection_pool.close_all()
+
+
+if __name__ == "__main__":
+    main()
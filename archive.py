@@ -0,0 +1,222 @@
+# Hot/cold partitioning of the transactions table.
+# Run from the repository root:
+#   python archive.py [--db bank.db] archive CUTOFF [--directory DIR] [--vacuum]
+#   python archive.py [--db bank.db] list
+#
+# Rows older than a cutoff move out of bank.db into one SQLite file per month
+# (bank_archive/transactions_YYYY_MM.db by default), recorded in archive_partitions. Readers
+# (history, statements, checkpoints) split a date range into windows and ATTACH only the
+# monthly files those windows need.
+import argparse
+import datetime
+import os
+import sqlite3
+
+from schema import initialize_database
+
+# SQLite allows 10 attached databases by default; leave room for callers' own attachments
+MAX_ATTACHED_PARTITIONS = 8
+
+_LEDGER_COLUMNS = "transaction_id, acc_num, transaction_type, amount, timestamp"
+
+
+# Function to return the first day of a 'YYYY-MM' month and of the month after it
+def _month_bounds(month):
+    first = datetime.date(int(month[:4]), int(month[5:7]), 1)
+    following = (first + datetime.timedelta(days=32)).replace(day=1)
+    return first.isoformat(), following.isoformat()
+
+
+# Function to return the schema name a month's archive is attached under
+def _schema_name(month):
+    return "archive_" + month.replace("-", "_")
+
+
+# Function to return the archive directory used when none is given: <database name>_archive
+def default_directory(conn):
+    for _, name, path in conn.execute("PRAGMA database_list"):
+        if name == "main" and path:
+            return os.path.splitext(path)[0] + "_archive"
+    raise ValueError("An in-memory database needs an explicit archive directory")
+
+
+# Function to attach a month's archive file to the connection, returning its schema name
+# Archives attached earlier are detached once MAX_ATTACHED_PARTITIONS are in use. Must be
+# called outside a transaction, as SQLite doesn't allow ATTACH/DETACH inside one.
+def attach_partition(conn, month, path):
+    name = _schema_name(month)
+    attached = [row[1] for row in conn.execute("PRAGMA database_list")]
+    if name in attached:
+        return name
+    archives = [schema for schema in attached if schema.startswith("archive_")]
+    if len(archives) >= MAX_ATTACHED_PARTITIONS:
+        for schema in archives:
+            conn.execute(f"DETACH DATABASE {schema}")
+    conn.execute(f"ATTACH DATABASE ? AS {name}", (path,))
+    return name
+
+
+# Function to list the archived months as (month, path, month_start, month_end, min_id, max_id, row_count)
+def list_partitions(conn):
+    return conn.execute("SELECT month, path, month_start, month_end, min_id, max_id, row_count FROM archive_partitions ORDER BY month_start").fetchall()
+
+
+# Function to split [start, end) into ledger windows, oldest first
+# Returns (month, path, window_start, window_end) tuples with None for open bounds. Windows
+# over an archived month have its month and path set and read that archive together with the
+# hot table, since rows with an older timestamp can still be posted after the month was
+# archived; every other window has month None and reads only the hot table. Without archives
+# this is the single window (None, None, start, end).
+def ledger_windows(conn, start=None, end=None):
+    partitions = conn.execute("SELECT month, path, month_start, month_end FROM archive_partitions "
+                              "WHERE month_end > IFNULL(?, '') AND (? IS NULL OR month_start < ?) ORDER BY month_start",
+                              (start, end, end)).fetchall()
+    windows = []
+    position = start
+    for month, path, month_start, month_end in partitions:
+        if position is None or position < month_start:
+            windows.append((None, None, position, month_start))
+        windows.append((month, path, month_start if position is None else max(position, month_start),
+                        month_end if end is None else min(end, month_end)))
+        position = month_end
+    if position is None or end is None or position < end:
+        windows.append((None, None, position, end))
+    return windows
+
+
+# Function to return the tables a window reads, attaching its archive if it has one
+def window_tables(conn, window):
+    if window[0] is None:
+        return ["transactions"]
+    return ["transactions", attach_partition(conn, window[0], window[1]) + ".transactions"]
+
+
+# Function to build a SELECT of `columns` over the rows of `tables` matching `conditions` inside a window
+# Returns (sql, params); callers append ORDER BY / LIMIT. With several tables the rows are
+# combined with UNION ALL in a subquery, so `columns` may use any ledger column.
+def window_select(tables, columns, conditions, params, window_start=None, window_end=None):
+    conditions = list(conditions)
+    params = list(params)
+    if window_start is not None:
+        conditions.append("timestamp >= ?")
+        params.append(window_start)
+    if window_end is not None:
+        conditions.append("timestamp < ?")
+        params.append(window_end)
+    where = " AND ".join(conditions) if conditions else "1"
+    if len(tables) == 1:
+        return f"SELECT {columns} FROM {tables[0]} WHERE {where}", params
+    union = " UNION ALL ".join(f"SELECT {_LEDGER_COLUMNS} FROM {table} WHERE {where}" for table in tables)
+    return f"SELECT {columns} FROM ({union})", params * len(tables)
+
+
+# Function to create the ledger table and its index in an attached archive
+def _create_partition_table(conn, schema):
+    conn.execute(f'''CREATE TABLE IF NOT EXISTS {schema}.transactions
+                 (transaction_id INTEGER PRIMARY KEY,
+                  acc_num INTEGER,
+                  transaction_type TEXT,
+                  amount INTEGER,
+                  timestamp DATETIME)''')
+    conn.execute(f'''CREATE INDEX IF NOT EXISTS {schema}.idx_transactions_acc_time
+                 ON transactions (acc_num, timestamp, transaction_id, transaction_type, amount)''')
+
+
+# Function to move every transaction older than `cutoff` into per-month archive files
+# cutoff is a 'YYYY-MM-DD[ HH:MM:SS]' string or a date/datetime. Each month is copied and
+# deleted in one transaction; the copy uses INSERT OR IGNORE, so if the files end up out of
+# step (WAL mode doesn't commit attached databases atomically) rerunning finishes the move.
+# Accounts without balance checkpoint state get it first, and the daily aggregates are brought
+# up to date, so neither ever needs the archived rows. Not available on a sharded database.
+# Returns {month: rows moved}.
+def archive_before(conn, cutoff, directory=None):
+    # Imported here because checkpoints and aggregates read the ledger through this module
+    from aggregates import advance_aggregates
+    from checkpoints import advance_checkpoints
+    from sharding import is_sharded
+
+    # The catalog of a sharded database holds no ledger, and archives are dropped through it
+    if is_sharded(conn):
+        raise ValueError("Sharded databases can't be archived")
+    cutoff = str(cutoff)
+    directory = os.path.abspath(directory or default_directory(conn))
+    os.makedirs(directory, exist_ok=True)
+    if conn.in_transaction:
+        conn.commit()
+    months = [row[0] for row in conn.execute("SELECT DISTINCT substr(timestamp, 1, 7) FROM transactions WHERE timestamp < ? ORDER BY 1", (cutoff,))]
+
+    moved = {}
+    for month in months:
+        month_start, month_end = _month_bounds(month)
+        upper = min(month_end, cutoff)
+        path = os.path.join(directory, f"transactions_{month.replace('-', '_')}.db")
+        schema = attach_partition(conn, month, path)
+        _create_partition_table(conn, schema)
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            cursor.execute("SELECT DISTINCT acc_num FROM transactions WHERE timestamp >= ? AND timestamp < ? "
+                           "AND acc_num NOT IN (SELECT acc_num FROM balance_checkpoint_state)", (month_start, upper))
+            advance_checkpoints(conn, [row[0] for row in cursor.fetchall()])
+            advance_aggregates(conn)
+            cursor.execute(f"INSERT OR IGNORE INTO {schema}.transactions SELECT {_LEDGER_COLUMNS} FROM main.transactions WHERE timestamp >= ? AND timestamp < ?",
+                           (month_start, upper))
+            cursor.execute("DELETE FROM main.transactions WHERE timestamp >= ? AND timestamp < ?", (month_start, upper))
+            moved[month] = cursor.rowcount
+            cursor.execute(f"SELECT MIN(transaction_id), MAX(transaction_id), COUNT(*) FROM {schema}.transactions")
+            min_id, max_id, row_count = cursor.fetchone()
+            cursor.execute("INSERT OR REPLACE INTO archive_partitions (month, path, month_start, month_end, min_id, max_id, row_count) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                           (month, path, month_start, month_end, min_id, max_id, row_count))
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+    return moved
+
+
+# Function to delete every archive file and forget the partitions; used when the ledger is cleared
+# Must be called outside a transaction. Returns the number of partitions removed.
+def drop_archives(conn):
+    partitions = conn.execute("SELECT month, path FROM archive_partitions").fetchall()
+    attached = [row[1] for row in conn.execute("PRAGMA database_list")]
+    for month, path in partitions:
+        if _schema_name(month) in attached:
+            conn.execute(f"DETACH DATABASE {_schema_name(month)}")
+        for file in (path, path + "-journal", path + "-wal", path + "-shm"):
+            if os.path.exists(file):
+                os.remove(file)
+    conn.execute("DELETE FROM archive_partitions")
+    conn.commit()
+    return len(partitions)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move old transactions into monthly archive databases")
+    parser.add_argument("--db", default="bank.db")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    archive = subparsers.add_parser("archive", help="archive every transaction older than CUTOFF")
+    archive.add_argument("cutoff", help="'YYYY-MM-DD[ HH:MM:SS]'")
+    archive.add_argument("--directory", help="where the monthly files go (default: <db>_archive)")
+    archive.add_argument("--vacuum", action="store_true", help="VACUUM the main database afterwards to return the freed space")
+    subparsers.add_parser("list", help="list the archived months")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    try:
+        initialize_database(conn)
+        if args.command == "archive":
+            moved = archive_before(conn, args.cutoff, args.directory)
+            for month, rows in moved.items():
+                print(f"{month}: moved {rows} transactions")
+            print(f"Archived {sum(moved.values())} transactions from {len(moved)} months.")
+            if args.vacuum:
+                conn.execute("VACUUM")
+        else:
+            for month, path, _, _, min_id, max_id, row_count in list_partitions(conn):
+                print(f"{month}: {row_count} transactions (ids {min_id}-{max_id}) in {path}")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+import concurrent.futures
+import concurrent.futures.process
+import hashlib
+import hmac
+import itertools
+import multiprocessing
+import os
+import threading
+import time
+
+from account_repository import get_account, invalidate_accounts
+from connection_pool import account_connection
+from instrumentation import timed
+
+MAX_ATTEMPTS = 3
+
+# Cost settings for the password KDF. Stored hashes carry their own parameters, so the
+# current setting can be raised at any time and accounts are upgraded on their next login.
+KDF_COSTS = {
+    "low": {"algorithm": "scrypt", "n": 2 ** 12, "r": 8, "p": 1},
+    "interactive": {"algorithm": "scrypt", "n": 2 ** 14, "r": 8, "p": 1},
+    "high": {"algorithm": "scrypt", "n": 2 ** 15, "r": 8, "p": 1},
+    "pbkdf2": {"algorithm": "pbkdf2_sha256", "iterations": 600000},
+}
+DEFAULT_KDF_COST = "interactive"
+SALT_BYTES = 16
+KEY_BYTES = 32
+
+_kdf_params = dict(KDF_COSTS[DEFAULT_KDF_COST])
+
+
+# Function to choose the KDF cost used for new hashes (a KDF_COSTS name or a params dict)
+def set_kdf_cost(cost):
+    global _kdf_params
+    _kdf_params = dict(KDF_COSTS[cost] if isinstance(cost, str) else cost)
+
+
+# Function to run the KDF with explicit parameters
+def _derive(password, salt, params):
+    if params["algorithm"] == "scrypt":
+        n, r, p = params["n"], params["r"], params["p"]
+        return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r + 2 ** 20, dklen=KEY_BYTES)
+    if params["algorithm"] == "pbkdf2_sha256":
+        return hashlib.pbkdf2_hmac("sha256", password.encode(), salt, params["iterations"], dklen=KEY_BYTES)
+    raise ValueError(f"Unknown KDF algorithm: {params['algorithm']}")
+
+
+# Function to encode the KDF parameters, salt and key in one string for the password column
+def _encode(params, salt, key):
+    if params["algorithm"] == "scrypt":
+        fields = [params["algorithm"], str(params["n"]), str(params["r"]), str(params["p"])]
+    else:
+        fields = [params["algorithm"], str(params["iterations"])]
+    return "$".join(fields + [salt.hex(), key.hex()])
+
+
+# Function to split a stored hash into (params, salt, key); legacy SHA-256 hashes give params None
+def _decode(stored):
+    fields = stored.split("$")
+    if fields[0] == "scrypt" and len(fields) == 6:
+        params = {"algorithm": "scrypt", "n": int(fields[1]), "r": int(fields[2]), "p": int(fields[3])}
+    elif fields[0] == "pbkdf2_sha256" and len(fields) == 4:
+        params = {"algorithm": "pbkdf2_sha256", "iterations": int(fields[1])}
+    else:
+        return None, None, stored
+    return params, bytes.fromhex(fields[-2]), bytes.fromhex(fields[-1])
+
+
+# Function to hash the given password using SHA-256 algorithm (pre-KDF format, kept for migration)
+def legacy_hash_password(password):
+    hashed_password = hashlib.sha256(password.encode()).hexdigest()
+    return hashed_password
+
+
+# Function to hash the given password with a fresh salt using the current KDF cost
+def hash_password(password, params=None):
+    params = params or _kdf_params
+    salt = os.urandom(SALT_BYTES)
+    return _encode(params, salt, _derive(password, salt, params))
+
+
+# Function to check a password against a stored hash in either the KDF or the legacy format
+def verify_password(password, stored):
+    if not stored:
+        return False
+    params, salt, key = _decode(stored)
+    if params is None:
+        return hmac.compare_digest(legacy_hash_password(password), stored)
+    return hmac.compare_digest(_derive(password, salt, params), key)
+
+
+# Function to verify a password and, if it matches an outdated hash, compute its replacement
+# Returns (matches, new_hash_or_None). Runs in worker processes, so it must stay module-level.
+def verify_and_upgrade(password, stored, params=None):
+    if not verify_password(password, stored):
+        return False, None
+    params = params or _kdf_params
+    if _decode(stored)[0] != params:
+        return True, hash_password(password, params)
+    return True, None
+
+
+class VerificationPool:
+    # Runs password verification in worker processes so a memory-hard KDF doesn't
+    # serialise logins behind the GIL; sized to the machine's cores by default
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self._executor = None
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.completed = 0
+        self.peak_queue_depth = 0
+        self.total_seconds = 0.0
+
+    # Method to start the worker processes on first use
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # spawn keeps the workers independent of any threads or open connections in this process
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn"))
+            return self._executor
+
+    # Method to record a finished verification
+    def _done(self, started):
+        with self._lock:
+            self.completed += 1
+            self.total_seconds += time.perf_counter() - started
+
+    # Method to queue a verification and return a future resolving to (matches, new_hash_or_None)
+    def submit(self, password, stored):
+        executor = self._get_executor()
+        with self._lock:
+            self.submitted += 1
+            self.peak_queue_depth = max(self.peak_queue_depth, self.submitted - self.completed)
+        started = time.perf_counter()
+        future = executor.submit(verify_and_upgrade, password, stored, dict(_kdf_params))
+        future.add_done_callback(lambda _future: self._done(started))
+        return future
+
+    # Method to verify a password in the pool and wait for the result
+    def verify(self, password, stored):
+        return self.submit(password, stored).result()
+
+    # Method to hash many passwords across the worker processes with the current KDF cost
+    # Returns an iterator of the hashes in order; the work is queued before it is iterated.
+    def hash_passwords(self, passwords, chunksize=16):
+        passwords = list(passwords)
+        return self._get_executor().map(hash_password, passwords, itertools.repeat(dict(_kdf_params), len(passwords)), chunksize=chunksize)
+
+    # Method to report queue depth and throughput counters
+    def metrics(self):
+        with self._lock:
+            return {
+                "workers": self.max_workers,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "queue_depth": self.submitted - self.completed,
+                "peak_queue_depth": self.peak_queue_depth,
+                "avg_verify_ms": self.total_seconds / self.completed * 1000 if self.completed else 0.0,
+            }
+
+    # Method to stop the worker processes
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
+_verification_pool = None
+_verification_pool_lock = threading.Lock()
+
+
+# Function to return the process-wide verification pool
+def get_verification_pool():
+    global _verification_pool
+    with _verification_pool_lock:
+        if _verification_pool is None:
+            _verification_pool = VerificationPool()
+        return _verification_pool
+
+
+# Function to verify a password in the process-wide pool, so concurrent sessions don't queue
+# behind each other's KDF; returns (matches, new_hash_or_None) like verify_and_upgrade
+# Falls back to verifying on the calling thread when no worker process can be started.
+def pooled_verify_and_upgrade(password, stored):
+    pool = get_verification_pool()
+    try:
+        return pool.verify(password, stored)
+    except (OSError, concurrent.futures.process.BrokenProcessPool) as e:
+        # Drop the broken executor so the next login tries to start the workers again
+        pool.shutdown()
+        print(f"Password verification pool unavailable ({e}); verifying inline.")
+        return verify_and_upgrade(password, stored)
+
+
+# Function to look up an account by number and password, upgrading an outdated hash on success
+# Returns the full accounts row, or None if the account doesn't exist or the password is wrong.
+@timed("login")
+def authenticate_account(conn, acc_num, password):
+    conn = account_connection(acc_num, conn)
+    account_details = get_account(conn, acc_num)
+    if account_details is None:
+        return None
+    matches, new_hash = pooled_verify_and_upgrade(password, account_details[8])
+    if not matches:
+        return None
+    if new_hash is not None:
+        conn.execute("UPDATE accounts SET password=? WHERE acc_num=? AND password=?", (new_hash, acc_num, account_details[8]))
+        conn.commit()
+        invalidate_accounts(conn, acc_num)
+    return account_details
+
+
+# Function to check the admin password, upgrading an outdated hash on success
+@timed("admin_login")
+def verify_admin_password(conn, password):
+    cursor = conn.cursor()
+    cursor.execute("SELECT password FROM admin")
+    for (stored,) in cursor.fetchall():
+        matches, new_hash = pooled_verify_and_upgrade(password, stored)
+        if matches:
+            if new_hash is not None:
+                cursor.execute("UPDATE admin SET password=? WHERE password=?", (new_hash, stored))
+                conn.commit()
+            return True
+    return False
+
+
+# Function to tell whether an account is locked, either by the admin or by too many failed attempts
+def is_account_locked(is_locked, incorrect_password_attempts, incorrect_2fa_attempts):
+    return is_locked == 1 or incorrect_password_attempts >= MAX_ATTEMPTS or incorrect_2fa_attempts >= MAX_ATTEMPTS
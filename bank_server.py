@@ -0,0 +1,208 @@
+# Line-delimited JSON server in front of bank_service.
+# Each request is one line: {"id": 1, "op": "deposit", "params": {"session": "...", "amount": 100}}
+# and gets back one line: {"id": 1, "ok": true, ...}. The blocking sqlite work runs in a bounded
+# thread pool, so a single event loop can keep thousands of client connections open.
+import argparse
+import asyncio
+import concurrent.futures
+import itertools
+import json
+
+import bank_service
+from auth import get_verification_pool
+import instrumentation
+from connection_pool import close_all, configure, get_connection
+from limiter import DEFAULT_LOGIN_FAILURES, DEFAULT_LOGIN_WINDOW, DEFAULT_SPEND_WINDOW, disable_limiter, enable_limiter
+from schema import initialize_database
+from sharding import close_shards, configure_shards, recorded_shard_count
+from snapshots import DEFAULT_IO_SHARE, DEFAULT_REFRESH_INTERVAL, disable_snapshots, enable_snapshots
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+DEFAULT_WORKERS = 8
+DEFAULT_MAX_PENDING = 1024
+MAX_LINE = 64 * 1024
+
+
+# Function run on an executor thread: dispatch one request using that thread's pooled connection
+def _execute(op, params):
+    try:
+        return bank_service.dispatch(op, params)
+    except Exception as e:
+        return {"ok": False, "error": f"Internal error: {e}"}
+
+
+class BankServer:
+    # snapshots holds the snapshots.enable_snapshots options when listings and history should
+    # be served from a reporting snapshot, limits the limiter.enable_limiter options when logins
+    # and payments should be rate limited
+    def __init__(self, db_path="bank.db", profile="wal", max_workers=DEFAULT_WORKERS, max_pending=DEFAULT_MAX_PENDING, shards=None, snapshots=None, limits=None):
+        self.db_path = db_path
+        self.profile = profile
+        self.shards = shards
+        self.snapshots = snapshots
+        self.limits = limits
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="bank-worker")
+        # Caps how many requests may wait for a worker; readers pause once it is reached
+        self.pending = asyncio.Semaphore(max_pending)
+        self.server = None
+
+    # Method to answer one decoded request
+    async def _handle_request(self, request):
+        if not isinstance(request, dict) or not isinstance(request.get("op"), str):
+            return {"ok": False, "error": "Invalid request"}
+        async with self.pending:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, _execute, request["op"], request.get("params") or {})
+
+    # Method to serve one client connection until it disconnects
+    async def _handle_client(self, reader, writer):
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    # Line longer than the stream limit
+                    writer.write(b'{"ok": false, "error": "Request too large"}\n')
+                    break
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                except json.JSONDecodeError:
+                    response = {"ok": False, "error": "Invalid JSON"}
+                    request = None
+                else:
+                    response = await self._handle_request(request)
+                if isinstance(request, dict) and "id" in request:
+                    response = dict(response, id=request["id"])
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    # Method to prepare the database and start listening
+    async def start(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        configure(self.db_path, self.profile)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, lambda: initialize_database(get_connection()))
+        shards = self.shards or recorded_shard_count(self.db_path)
+        if shards:
+            # Completes cross-shard transfers a crash left half done before serving anyone
+            await loop.run_in_executor(self.executor, configure_shards(self.db_path, shards, self.profile).initialize)
+        if self.snapshots is not None:
+            enable_snapshots(**self.snapshots)
+        if self.limits is not None:
+            await loop.run_in_executor(self.executor, lambda: enable_limiter(**self.limits))
+        self.server = await asyncio.start_server(self._handle_client, host, port, limit=MAX_LINE)
+        return self.server.sockets[0].getsockname()[:2]
+
+    # Method to stop listening and release the worker threads and connections
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        self.executor.shutdown(wait=True)
+        disable_limiter()
+        disable_snapshots()
+        get_verification_pool().shutdown()
+        close_shards()
+        close_all()
+        instrumentation.shutdown()
+
+
+class BankClient:
+    # Async client for BankServer; one request in flight per client connection
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+        self._ids = itertools.count(1)
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port, limit=MAX_LINE)
+        return self
+
+    # Method to send one operation and wait for its result
+    async def call(self, op, **params):
+        request_id = next(self._ids)
+        self.writer.write(json.dumps({"id": request_id, "op": op, "params": params}).encode() + b"\n")
+        await self.writer.drain()
+        line = await self.reader.readline()
+        if not line:
+            raise ConnectionError("Server closed the connection")
+        return json.loads(line)
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            await self.writer.wait_closed()
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+# Function to run the server until interrupted
+async def _serve_forever(args):
+    if args.metrics:
+        instrumentation.configure(args.metrics, args.metrics_interval)
+    snapshots = {"interval": args.snapshot_interval, "io_share": args.snapshot_io_share} if args.snapshots else None
+    limits = {"login_failures": args.login_failures, "login_window": args.login_window,
+              "spend_limit": args.spend_limit, "spend_window": args.spend_window} if args.limits else None
+    server = BankServer(args.db, args.profile, args.workers, args.max_pending, args.shards, snapshots, limits)
+    host, port = await server.start(args.host, args.port)
+    print(f"Serving on {host}:{port}")
+    try:
+        await server.server.serve_forever()
+    finally:
+        await server.stop()
+
+
+# Function to send a single request from the command line and print the result
+async def _call_once(args):
+    async with BankClient(args.host, args.port) as client:
+        result = await client.call(args.op, **json.loads(args.params))
+    print(json.dumps(result, indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JSON API server for the banking system")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    serve = subparsers.add_parser("serve", help="run the server")
+    serve.add_argument("--db", default="bank.db")
+    serve.add_argument("--profile", default="wal")
+    serve.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    serve.add_argument("--max-pending", type=int, default=DEFAULT_MAX_PENDING)
+    serve.add_argument("--shards", type=int, help="keep accounts in this many shard files next to the database (see sharding.py)")
+    serve.add_argument("--snapshots", action="store_true", help="serve account listings and history from a periodically refreshed copy of the database")
+    serve.add_argument("--snapshot-interval", type=float, default=DEFAULT_REFRESH_INTERVAL, help="seconds between snapshot refreshes")
+    serve.add_argument("--snapshot-io-share", type=float, default=DEFAULT_IO_SHARE, help="largest share of time a snapshot refresh spends copying")
+    serve.add_argument("--limits", action="store_true", help="throttle repeated failed logins and cap the money an account can send per window")
+    serve.add_argument("--login-failures", type=int, default=DEFAULT_LOGIN_FAILURES, help="failed logins allowed per login window")
+    serve.add_argument("--login-window", type=float, default=DEFAULT_LOGIN_WINDOW, help="seconds of the failed-login window")
+    serve.add_argument("--spend-limit", type=int, help="most an account can withdraw and transfer per spending window (default unlimited)")
+    serve.add_argument("--spend-window", type=float, default=DEFAULT_SPEND_WINDOW, help="seconds of the spending window")
+    serve.add_argument("--metrics", help="write statement and operation metrics to this file in Prometheus text format")
+    serve.add_argument("--metrics-interval", type=float, default=instrumentation.DEFAULT_INTERVAL, help="seconds between metrics writes")
+    call = subparsers.add_parser("call", help="send one request to a running server")
+    call.add_argument("op")
+    call.add_argument("params", nargs="?", default="{}", help="JSON object of parameters")
+    for sub in (serve, call):
+        sub.add_argument("--host", default=DEFAULT_HOST)
+        sub.add_argument("--port", type=int, default=DEFAULT_PORT)
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(_serve_forever(args) if args.command == "serve" else _call_once(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
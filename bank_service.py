@@ -0,0 +1,452 @@
+import datetime
+import functools
+import inspect
+import math
+import secrets
+import sqlite3
+import threading
+
+from account_listing import SORT_COLUMNS, fetch_account_page
+from account_repository import cache_stats, get_account, invalidate_accounts, invalidate_all_accounts, record_failed_attempt, reset_failed_attempts
+from archive import drop_archives
+from auth import MAX_ATTEMPTS, hash_password, is_account_locked, pooled_verify_and_upgrade
+from bulk_posting import post_batch
+from connection_pool import account_connection, resolve_connection
+from history import iter_history_pages
+from instrumentation import operation
+from limiter import forget_account, limiter_stats, login_retry_after, release_spending, reserve_spending, reset_limiter
+from provisioning import create_accounts
+from schema import LEDGER_TYPES
+from snapshots import reporting_connection, reporting_staleness
+from sharding import data_connections, get_router
+from transfer_engine import transfer_funds
+
+MAX_PAGE_SIZE = 500
+
+# Logged-in sessions: token -> ("user", acc_num) or ("admin", None)
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+# Function to build a successful result
+def _ok(**data):
+    data["ok"] = True
+    return data
+
+
+# Function to build a failed result carrying a human readable message
+def _error(message):
+    return {"ok": False, "error": message}
+
+
+# Function to open a session and return its token
+def _new_session(kind, acc_num=None):
+    token = secrets.token_hex(16)
+    with _sessions_lock:
+        _sessions[token] = (kind, acc_num)
+    return token
+
+
+# Function to look up a session, returning (kind, acc_num) or None
+def _get_session(token):
+    with _sessions_lock:
+        return _sessions.get(token)
+
+
+# Function to resolve a user session token to its account number, or None if it isn't valid
+def _session_account(token):
+    session = _get_session(token)
+    if session is None or session[0] != "user":
+        return None
+    return session[1]
+
+
+# Function to tell whether a token belongs to a logged-in admin
+def _is_admin(token):
+    session = _get_session(token)
+    return session is not None and session[0] == "admin"
+
+
+# Function to tell whether a value is an integer (JSON true/false are bools, not numbers)
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+# Function to check that an amount is a positive integer
+def _valid_amount(amount):
+    return _is_int(amount) and amount > 0
+
+
+# Function to check that an optional parameter is None or an integer
+def _optional_int(value):
+    return value is None or _is_int(value)
+
+
+# Function to check that a listing position is [sort value, acc_num]; only names sort as text
+def _valid_position(after, sort_by):
+    if not isinstance(after, (list, tuple)) or len(after) != 2 or not _is_int(after[1]):
+        return False
+    return isinstance(after[0], str) if sort_by == "name" else _is_int(after[0])
+
+
+# Function to check that an optional date bound is None, a 'YYYY-MM-DD[ HH:MM:SS]' string or a date
+def _optional_date(value):
+    return value is None or isinstance(value, (str, datetime.date))
+
+
+# Function to verify a password in the process pool, storing the upgraded hash if one comes back
+# update_sql must take (new_hash, old_hash) parameters and only replace the old hash.
+def _verify(conn, password, stored, update_sql, key=()):
+    matches, new_hash = pooled_verify_and_upgrade(password, stored)
+    if matches and new_hash is not None:
+        conn.execute(update_sql, (new_hash, *key, stored))
+        conn.commit()
+        invalidate_accounts(conn, *key)
+    return matches
+
+
+# Function to check a password against the admin table
+def _admin_password_matches(conn, password):
+    cursor = conn.cursor()
+    cursor.execute("SELECT password FROM admin")
+    return any(_verify(conn, password, stored, "UPDATE admin SET password=? WHERE password=?") for (stored,) in cursor.fetchall())
+
+
+# Function to check a password against an account's stored hash
+def _account_password_matches(conn, acc_num, password, stored):
+    return _verify(conn, password, stored, "UPDATE accounts SET password=? WHERE acc_num=? AND password=?", (acc_num,))
+
+
+# Function to read an account's balances as a dict
+def _account_summary(conn, acc_num):
+    row = get_account(conn, acc_num)
+    if row is None:
+        return None
+    return {"name": row[0], "acc_num": row[1], "total_amount": row[2], "total_dep": row[3],
+            "total_wit": row[4], "total_tra": row[5], "is_locked": bool(row[7])}
+
+
+# Function to log a user in, applying the same lockout rules as the interactive menu
+def login(acc_num, password, conn=None):
+    # A throttled account is turned away before its password is hashed or anything is written
+    retry_after = login_retry_after(acc_num)
+    if retry_after:
+        return _error(f"Too many failed attempts. Try again in {math.ceil(retry_after)} seconds.")
+    conn = account_connection(acc_num, conn)
+    row = get_account(conn, acc_num)
+    if row is None:
+        return _error("Account does not exist")
+    password_attempts, is_locked, stored_password, two_factor_enabled, twofa_attempts = row[6:11]
+
+    if not _account_password_matches(conn, acc_num, password, stored_password):
+        failed_attempts = record_failed_attempt(conn, acc_num, 'password')
+        if failed_attempts is not None and failed_attempts >= MAX_ATTEMPTS:
+            return _error("Incorrect Password. Account is locked. Please contact admin.")
+        return _error("Incorrect Password")
+    if is_account_locked(is_locked, password_attempts, twofa_attempts):
+        return _error("Account is locked. Please contact admin.")
+    if two_factor_enabled:
+        return _error("Two-Factor Authentication is enabled for this account; use the interactive client to log in.")
+
+    reset_failed_attempts(conn, acc_num, 'password', password_attempts)
+    return _ok(session=_new_session("user", acc_num), account=_account_summary(conn, acc_num))
+
+
+# Function to log an admin in with the admin password
+def admin_login(password, conn=None):
+    conn = resolve_connection(conn)
+    if not _admin_password_matches(conn, password):
+        return _error("Unauthorized access.")
+    return _ok(session=_new_session("admin"))
+
+
+# Function to end a user or admin session
+def logout(session):
+    with _sessions_lock:
+        removed = _sessions.pop(session, None)
+    if removed is None:
+        return _error("Not logged in.")
+    return _ok()
+
+
+# Function to deposit into the logged-in account
+def deposit(session, amount, conn=None):
+    acc_num = _session_account(session)
+    if acc_num is None:
+        return _error("Not logged in.")
+    if not _valid_amount(amount):
+        return _error("Invalid amount")
+    conn = account_connection(acc_num, conn)
+    _posted, rejects = post_batch(conn, [(acc_num, 'deposit', amount)])
+    if rejects:
+        return _error(rejects[0][4])
+    return _ok(account=_account_summary(conn, acc_num))
+
+
+# Function to withdraw from the logged-in account
+def withdraw(session, amount, conn=None):
+    acc_num = _session_account(session)
+    if acc_num is None:
+        return _error("Not logged in.")
+    if not _valid_amount(amount):
+        return _error("Invalid amount")
+    ticket, message = reserve_spending(acc_num, amount)
+    if ticket is None:
+        return _error(message)
+    conn = account_connection(acc_num, conn)
+    _posted, rejects = post_batch(conn, [(acc_num, 'withdrawal', amount)])
+    if rejects:
+        release_spending(acc_num, ticket)
+        return _error(rejects[0][4])
+    return _ok(account=_account_summary(conn, acc_num))
+
+
+# Function to transfer from the logged-in account to another account
+def transfer(session, target_acc_num, amount, conn=None):
+    acc_num = _session_account(session)
+    if acc_num is None:
+        return _error("Not logged in.")
+    if not _is_int(target_acc_num):
+        return _error("Invalid target account")
+    if not _valid_amount(amount):
+        return _error("Invalid amount")
+    ticket, message = reserve_spending(acc_num, amount)
+    if ticket is None:
+        return _error(message)
+    conn = account_connection(acc_num, conn)
+    router = get_router()
+    if router is not None:
+        success, message = router.transfer(acc_num, target_acc_num, amount)
+    else:
+        success, message = transfer_funds(conn, acc_num, target_acc_num, amount)
+    if not success:
+        release_spending(acc_num, ticket)
+        return _error(message)
+    return _ok(account=_account_summary(conn, acc_num))
+
+
+# Function to return the logged-in account's balances
+def details(session, conn=None):
+    acc_num = _session_account(session)
+    if acc_num is None:
+        return _error("Not logged in.")
+    account = _account_summary(account_connection(acc_num, conn), acc_num)
+    if account is None:
+        return _error("Account not found.")
+    return _ok(account=account)
+
+
+# Function to return one page of the logged-in account's history
+# Pass the returned next_after_id back as after_id to fetch the following page. With reporting
+# snapshots enabled the page comes from the snapshot; staleness is its age in seconds.
+def history(session, after_id=None, start=None, end=None, transaction_types=None, page_size=100, conn=None):
+    acc_num = _session_account(session)
+    if acc_num is None:
+        return _error("Not logged in.")
+    if not _is_int(page_size):
+        return _error("Invalid page_size")
+    if not _optional_int(after_id):
+        return _error("Invalid after_id")
+    if not (_optional_date(start) and _optional_date(end)):
+        return _error("Invalid start or end; use 'YYYY-MM-DD[ HH:MM:SS]'")
+    # A string would be taken character by character and silently match nothing
+    if transaction_types is not None and (not isinstance(transaction_types, (list, tuple))
+                                          or not all(isinstance(kind, str) and kind in LEDGER_TYPES for kind in transaction_types)):
+        return _error(f"Invalid transaction_types; use a list of {', '.join(LEDGER_TYPES)}")
+    page_size = max(1, min(page_size, MAX_PAGE_SIZE))
+    conn = reporting_connection(acc_num, conn)
+    try:
+        page = next(iter_history_pages(conn, acc_num, after_id=after_id, start=start, end=end,
+                                       transaction_types=transaction_types, page_size=page_size), [])
+    except ValueError as e:
+        return _error(str(e))
+    transactions = [{"transaction_id": row[0], "transaction_type": row[1], "amount": row[2], "timestamp": row[3]} for row in page]
+    next_after_id = page[-1][0] if len(page) == page_size else None
+    return _ok(transactions=transactions, next_after_id=next_after_id, staleness=reporting_staleness())
+
+
+# Function to create a new account (admin only)
+def create_account(session, name, password, conn=None):
+    if not _is_admin(session):
+        return _error("Unauthorized access.")
+    try:
+        acc_num = create_accounts(resolve_connection(conn), [(name, hash_password(password))])[0]
+    except sqlite3.OperationalError as e:
+        return _error(f"Error: {e}")
+    return _ok(acc_num=acc_num)
+
+
+# Function to delete an account given its password (admin only)
+def delete_account(session, acc_num, password, conn=None):
+    if not _is_admin(session):
+        return _error("Unauthorized access.")
+    conn = account_connection(acc_num, conn)
+    cursor = conn.cursor()
+    row = get_account(conn, acc_num)
+    if row is None or not _account_password_matches(conn, acc_num, password, row[8]):
+        return _error("Account not found or incorrect password.")
+    cursor.execute("DELETE FROM accounts WHERE acc_num=?", (acc_num,))
+    conn.commit()
+    invalidate_accounts(conn, acc_num)
+    return _ok()
+
+
+# Function to list accounts one page at a time with optional filters and sort order (admin only)
+# Pass the returned next_after back as after to fetch the following page. Reads the reporting
+# snapshots when enabled, like history.
+def list_accounts(session, after=None, limit=100, sort_by="acc_num", descending=False, locked_only=False,
+                  min_balance=None, max_balance=None, name_prefix=None, min_password_attempts=None,
+                  min_2fa_attempts=None, conn=None):
+    if not _is_admin(session):
+        return _error("Unauthorized access.")
+    if not isinstance(sort_by, str) or sort_by not in SORT_COLUMNS:
+        return _error(f"Unknown sort column: {sort_by}")
+    if not _is_int(limit) or not (after is None or _valid_position(after, sort_by)):
+        return _error("Invalid paging parameters")
+    if not all(_optional_int(value) for value in (min_balance, max_balance, min_password_attempts, min_2fa_attempts)):
+        return _error("Invalid filter; balances and attempt counts must be integers")
+    if name_prefix is not None and not isinstance(name_prefix, str):
+        return _error("Invalid name_prefix")
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    router = get_router()
+    fetch_page = functools.partial(router.fetch_account_page, from_snapshot=True) if router is not None else fetch_account_page
+    try:
+        rows = fetch_page(reporting_connection(conn=conn), after, limit, sort_by, bool(descending),
+                          locked_only=locked_only, min_balance=min_balance, max_balance=max_balance,
+                          name_prefix=name_prefix, min_password_attempts=min_password_attempts,
+                          min_2fa_attempts=min_2fa_attempts)
+    except ValueError as e:
+        return _error(str(e))
+    accounts = [{"name": row[0], "acc_num": row[1], "total_amount": row[2], "incorrect_password_attempts": row[3],
+                 "incorrect_2fa_attempts": row[4], "locked": row[5] == "Locked"} for row in rows]
+    next_after = None
+    if len(rows) == limit:
+        next_after = [rows[-1][SORT_COLUMNS[sort_by][1]], rows[-1][1]]
+    return _ok(accounts=accounts, next_after=next_after, staleness=reporting_staleness())
+
+
+# Function to lock an account (admin only)
+def lock_account(session, acc_num, conn=None):
+    if not _is_admin(session):
+        return _error("Unauthorized access.")
+    conn = account_connection(acc_num, conn)
+    cursor = conn.cursor()
+    cursor.execute("UPDATE accounts SET is_locked=1 WHERE acc_num=?", (acc_num,))
+    conn.commit()
+    invalidate_accounts(conn, acc_num)
+    if cursor.rowcount == 0:
+        return _error("Account not found.")
+    return _ok()
+
+
+# Function to unlock an account, setting a new password and clearing failed attempts (admin only)
+def unlock_account(session, acc_num, new_password, conn=None):
+    if not _is_admin(session):
+        return _error("Unauthorized access.")
+    # Unwritten failure counters would otherwise be overlaid on the reset row
+    forget_account(acc_num)
+    conn = account_connection(acc_num, conn)
+    cursor = conn.cursor()
+    cursor.execute("UPDATE accounts SET is_locked=0, password=?, incorrect_password_attempts=0, incorrect_2fa_attempts=0 WHERE acc_num=?",
+                   (hash_password(new_password), acc_num))
+    conn.commit()
+    invalidate_accounts(conn, acc_num)
+    if cursor.rowcount == 0:
+        return _error("Account not found.")
+    return _ok()
+
+
+# Function to change the admin password (admin only)
+def change_admin_password(session, current_password, new_password, conn=None):
+    if not _is_admin(session):
+        return _error("Unauthorized access.")
+    conn = resolve_connection(conn)
+    if not _admin_password_matches(conn, current_password):
+        return _error("Incorrect admin password. Password change failed.")
+    conn.execute("UPDATE admin SET password=?", (hash_password(new_password),))
+    conn.commit()
+    return _ok()
+
+
+# Function to remove all accounts and transactions (admin only, password confirmed)
+def clear_tables(session, password, conn=None):
+    if not _is_admin(session):
+        return _error("Unauthorized access.")
+    conn = resolve_connection(conn)
+    if not _admin_password_matches(conn, password):
+        return _error("Unauthorized access.")
+    if conn.in_transaction:
+        conn.commit()
+    drop_archives(conn)
+    for data_conn in data_connections(conn):
+        data_conn.execute("DELETE FROM accounts")
+        data_conn.execute("DELETE FROM transactions")
+        data_conn.execute("DELETE FROM balance_checkpoints")
+        data_conn.execute("DELETE FROM balance_checkpoint_state")
+        data_conn.execute("DELETE FROM daily_aggregates")
+        data_conn.execute("DELETE FROM aggregate_state")
+        if get_router() is not None:
+            data_conn.execute("DELETE FROM transfer_outbox")
+            data_conn.execute("DELETE FROM transfer_inbox")
+        data_conn.commit()
+    conn.execute("DELETE FROM import_progress")
+    conn.execute("DELETE FROM account_sequence")
+    conn.execute("DELETE FROM limiter_state")
+    conn.commit()
+    reset_limiter()
+    invalidate_all_accounts()
+    return _ok()
+
+
+# Function to report the account row cache counters (admin only)
+def account_cache_stats(session):
+    if not _is_admin(session):
+        return _error("Unauthorized access.")
+    return _ok(cache=cache_stats())
+
+
+# Function to report the limiter's counters, None when limits are off (admin only)
+def limit_stats(session):
+    if not _is_admin(session):
+        return _error("Unauthorized access.")
+    return _ok(limiter=limiter_stats())
+
+
+# Operations reachable through the service API, by name
+OPERATIONS = {
+    "login": login,
+    "admin_login": admin_login,
+    "logout": logout,
+    "deposit": deposit,
+    "withdraw": withdraw,
+    "transfer": transfer,
+    "details": details,
+    "history": history,
+    "create_account": create_account,
+    "delete_account": delete_account,
+    "list_accounts": list_accounts,
+    "lock_account": lock_account,
+    "unlock_account": unlock_account,
+    "change_admin_password": change_admin_password,
+    "clear_tables": clear_tables,
+    "account_cache_stats": account_cache_stats,
+    "limit_stats": limit_stats,
+}
+
+
+# Function to run a named operation with keyword arguments, turning bad requests into error results
+def dispatch(op, params, conn=None):
+    handler = OPERATIONS.get(op)
+    if handler is None:
+        return _error(f"Unknown operation: {op}")
+    if not isinstance(params, dict) or "conn" in params:
+        return _error(f"Invalid parameters for {op}")
+    signature = inspect.signature(handler)
+    try:
+        signature.bind(**params)
+    except TypeError as e:
+        return _error(f"Invalid parameters for {op}: {e}")
+    with operation(op):
+        if "conn" in signature.parameters:
+            return handler(conn=conn, **params)
+        return handler(**params)
@@ -0,0 +1,62 @@
+# Thin client for the session daemon (see session_daemon.py): relays this terminal to a
+# session served by the already-running daemon. Run from the repository root:
+#   python bank_session.py [--socket bank.sock]
+# It deliberately imports only a few standard library modules (no argparse) so it starts about
+# as fast as the interpreter itself. Without a running daemon it starts the program directly.
+import codecs
+import os
+import socket
+import sys
+import threading
+
+DEFAULT_SOCKET = "bank.sock"
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Secure Financial Framework.py")
+
+
+# Function to copy the terminal's input to the socket until stdin closes
+def _forward_input(sock):
+    try:
+        for line in sys.stdin:
+            sock.sendall(line.encode("utf-8"))
+        sock.shutdown(socket.SHUT_WR)
+    except OSError:
+        pass
+
+
+# Function to run one session through the daemon; returns False if no daemon is listening
+def connect(socket_path=DEFAULT_SOCKET):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        sock.close()
+        return False
+    threading.Thread(target=_forward_input, args=(sock,), daemon=True).start()
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    try:
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            sys.stdout.write(decoder.decode(data))
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sock.close()
+    return True
+
+
+def main():
+    args = sys.argv[1:]
+    if args[:1] in (["-h"], ["--help"]) or (args and (args[0] != "--socket" or len(args) != 2)):
+        print("usage: bank_session.py [--socket PATH]")
+        sys.exit(0 if args[:1] in (["-h"], ["--help"]) else 2)
+    socket_path = args[1] if args else DEFAULT_SOCKET
+    if not connect(socket_path):
+        # No daemon: run the program in this process instead
+        os.execv(sys.executable, [sys.executable, SCRIPT])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+# Compares point-in-time balance lookups through checkpoints against summing the full history.
+# Run from the repository root:  python -m benchmarks.bench_checkpoints --accounts 20 --transactions 200000
+import argparse
+import datetime
+import random
+import sqlite3
+import time
+
+from benchmarks.common import make_database, percentile, remove_database
+from checkpoints import CHECKPOINT_EVERY_ROWS, balance_at, rebuild_checkpoints
+
+START = datetime.datetime(2024, 1, 1)
+
+
+# Function to fill the ledger with random postings spread evenly over a year
+def _fill_ledger(conn, num_accounts, num_transactions, rng):
+    step = 365 * 24 * 3600 / num_transactions
+    rows = ((rng.randint(1, num_accounts), "deposit", rng.randint(-500, 1000),
+             (START + datetime.timedelta(seconds=int(n * step))).strftime("%Y-%m-%d %H:%M:%S"))
+            for n in range(num_transactions))
+    conn.executemany("INSERT INTO transactions (acc_num, transaction_type, amount, timestamp) VALUES (?, ?, ?, ?)", rows)
+    conn.commit()
+
+
+# Function to time a balance lookup function over the given queries
+def _time_queries(queries, lookup):
+    latencies = []
+    results = []
+    for acc_num, at in queries:
+        start = time.perf_counter()
+        results.append(lookup(acc_num, at))
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return results, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark point-in-time balance queries")
+    parser.add_argument("--accounts", type=int, default=20)
+    parser.add_argument("--transactions", type=int, default=200000)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--every-rows", type=int, default=CHECKPOINT_EVERY_ROWS)
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    path = make_database(args.accounts, 0)
+    conn = sqlite3.connect(path)
+    try:
+        _fill_ledger(conn, args.accounts, args.transactions, rng)
+        start = time.perf_counter()
+        written = rebuild_checkpoints(conn, every_rows=args.every_rows)
+        rebuild_seconds = time.perf_counter() - start
+
+        queries = [(rng.randint(1, args.accounts),
+                    (START + datetime.timedelta(seconds=rng.randint(0, 365 * 24 * 3600))).strftime("%Y-%m-%d %H:%M:%S"))
+                   for _ in range(args.queries)]
+
+        def full_sum(acc_num, at):
+            return conn.execute("SELECT IFNULL(SUM(amount), 0) FROM transactions WHERE acc_num=? AND timestamp <= ?", (acc_num, at)).fetchone()[0]
+
+        expected, full_latencies = _time_queries(queries, full_sum)
+        actual, checkpoint_latencies = _time_queries(queries, lambda acc_num, at: balance_at(conn, acc_num, at))
+        if expected != actual:
+            raise AssertionError("checkpoint balances differ from the full-history sums")
+    finally:
+        conn.close()
+        remove_database(path)
+
+    print(f"ledger rows: {args.transactions}, accounts: {args.accounts}, checkpoints: {written} (rebuild {rebuild_seconds:.2f}s)")
+    print(f"{'method':>12} {'queries/sec':>12} {'p50 ms':>8} {'p99 ms':>8}")
+    for name, latencies in (("full sum", full_latencies), ("checkpoint", checkpoint_latencies)):
+        print(f"{name:>12} {len(latencies) / sum(latencies):>12.1f} {percentile(latencies, 50) * 1000:>8.3f} {percentile(latencies, 99) * 1000:>8.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+# Group commit benchmark: BankAccount deposits from rising numbers of concurrent sessions,
+# each session committing on its own versus all of them going through the group-commit writer.
+# Run from the repository root:  python -m benchmarks.bench_group_commit --threads 1,4,16,64
+# Both modes use the wal_full profile, so every commit is fsynced.
+import argparse
+import random
+import threading
+import time
+
+import connection_pool
+import group_commit
+from benchmarks.common import load_main_module, make_database, percentile, remove_database
+
+PROFILE = "wal_full"
+
+
+# Function run by each session thread: deposits into random accounts, timing each one
+def _session(bank, num_accounts, count, latencies, commits, seed):
+    rng = random.Random(seed)
+    conn = connection_pool.get_connection()
+    local = []
+    committed = 0
+
+    def count_commits(sql):
+        nonlocal committed
+        if sql == "COMMIT":
+            committed += 1
+
+    conn.set_trace_callback(count_commits)
+    try:
+        for _ in range(count):
+            start = time.perf_counter()
+            bank.BankAccount(None, rng.randint(1, num_accounts), conn).deposit(rng.randint(1, 100))
+            local.append(time.perf_counter() - start)
+    finally:
+        conn.set_trace_callback(None)
+        connection_pool.get_manager().release()
+    latencies.extend(local)
+    commits.append(committed)
+
+
+# Function to run one round and return its statistics; grouped routes the writes through the writer
+def run(num_threads, grouped, num_accounts, deposits_per_thread, max_delay, max_batch):
+    bank = load_main_module()
+    path = make_database(num_accounts, 1000)
+    connection_pool.configure(path, PROFILE)
+    latencies = []
+    commits = []
+    try:
+        if grouped:
+            group_commit.enable_group_commit(max_delay, max_batch, PROFILE)
+        threads = [threading.Thread(target=_session, args=(bank, num_accounts, deposits_per_thread, latencies, commits, n))
+                   for n in range(num_threads)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        if grouped:
+            stats = group_commit.writer_stats()[path]
+            total_commits = stats["batches"]
+        else:
+            total_commits = sum(commits)
+    finally:
+        group_commit.disable_group_commit()
+        connection_pool.close_all()
+        remove_database(path)
+
+    latencies.sort()
+    return {
+        "threads": num_threads,
+        "mode": "group" if grouped else "own",
+        "ops": len(latencies),
+        "ops_per_sec": len(latencies) / elapsed if elapsed else 0.0,
+        "commits_per_sec": total_commits / elapsed if elapsed else 0.0,
+        "ops_per_commit": len(latencies) / total_commits if total_commits else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark group commit against per-session commits")
+    parser.add_argument("--threads", default="1,4,16,64", help="comma separated session counts")
+    parser.add_argument("--accounts", type=int, default=10000)
+    parser.add_argument("--deposits", type=int, default=200, help="deposits per session")
+    parser.add_argument("--delay", type=float, default=group_commit.DEFAULT_MAX_DELAY * 1000, help="group-commit window in milliseconds")
+    parser.add_argument("--batch", type=int, default=group_commit.DEFAULT_MAX_BATCH, help="most writes per group commit")
+    args = parser.parse_args()
+
+    print(f"{'threads':>8} {'mode':>6} {'ops':>7} {'ops/sec':>9} {'commits/sec':>12} {'ops/commit':>11} {'p50 ms':>8} {'p99 ms':>8}")
+    for num_threads in (int(n) for n in args.threads.split(",")):
+        for grouped in (False, True):
+            result = run(num_threads, grouped, args.accounts, args.deposits, args.delay / 1000, args.batch)
+            print(f"{result['threads']:>8} {result['mode']:>6} {result['ops']:>7} {result['ops_per_sec']:>9.1f} {result['commits_per_sec']:>12.1f} "
+                  f"{result['ops_per_commit']:>11.1f} {result['p50_ms']:>8.2f} {result['p99_ms']:>8.2f}")
+
+if __name__ == "__main__":
+    main()
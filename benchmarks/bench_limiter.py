@@ -0,0 +1,98 @@
+# Failed-login storm benchmark: concurrent sessions recording bad passwords against random
+# accounts, with every failure committed on its own versus counted by the in-memory limiter.
+# Run from the repository root:  python -m benchmarks.bench_limiter --threads 1,8,32
+# Only the bookkeeping of a failure is timed; the password hash is left out, as it is the same
+# in both modes. With the limiter every attempt is also checked against the throttle first.
+import argparse
+import random
+import threading
+import time
+
+import connection_pool
+import limiter
+from account_repository import record_failed_attempt
+from benchmarks.common import make_database, percentile, remove_database
+
+PROFILE = "wal_full"
+
+
+# Function run by each session thread: fails logins on random accounts, timing each attempt
+def _session(num_accounts, count, latencies, throttled, seed):
+    rng = random.Random(seed)
+    conn = connection_pool.get_connection()
+    local = []
+    turned_away = 0
+    try:
+        for _ in range(count):
+            acc_num = rng.randint(1, num_accounts)
+            start = time.perf_counter()
+            if limiter.login_retry_after(acc_num):
+                turned_away += 1
+            else:
+                record_failed_attempt(conn, acc_num, 'password')
+            local.append(time.perf_counter() - start)
+    finally:
+        connection_pool.get_manager().release()
+    latencies.extend(local)
+    throttled.append(turned_away)
+
+
+# Function to run one round and return its statistics; limited turns the limiter on
+def run(num_threads, limited, num_accounts, attempts_per_thread, login_failures):
+    path = make_database(num_accounts, 1000)
+    connection_pool.configure(path, PROFILE)
+    latencies = []
+    throttled = []
+    try:
+        if limited:
+            limiter.enable_limiter(login_failures=login_failures, profile=PROFILE)
+        threads = [threading.Thread(target=_session, args=(num_accounts, attempts_per_thread, latencies, throttled, n))
+                   for n in range(num_threads)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        if limited:
+            # One commit per flush, as the counters and the windows share the database file
+            limiter.get_limiter().flush()
+            total_commits = limiter.limiter_stats()["flushes"]
+        else:
+            # Every recorded failure commits on its own
+            total_commits = len(latencies) - sum(throttled)
+    finally:
+        limiter.disable_limiter()
+        connection_pool.close_all()
+        remove_database(path)
+
+    latencies.sort()
+    return {
+        "threads": num_threads,
+        "mode": "limiter" if limited else "commit",
+        "attempts": len(latencies),
+        "throttled": sum(throttled),
+        "attempts_per_sec": len(latencies) / elapsed if elapsed else 0.0,
+        "commits": total_commits,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark failed-login bookkeeping with and without the limiter")
+    parser.add_argument("--threads", default="1,8,32", help="comma separated session counts")
+    parser.add_argument("--accounts", type=int, default=1000)
+    parser.add_argument("--attempts", type=int, default=500, help="failed logins per session")
+    parser.add_argument("--login-failures", type=int, default=limiter.DEFAULT_LOGIN_FAILURES)
+    args = parser.parse_args()
+
+    print(f"{'threads':>8} {'mode':>8} {'attempts':>9} {'throttled':>10} {'attempts/sec':>13} {'commits':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    for num_threads in (int(n) for n in args.threads.split(",")):
+        for limited in (False, True):
+            result = run(num_threads, limited, args.accounts, args.attempts, args.login_failures)
+            print(f"{result['threads']:>8} {result['mode']:>8} {result['attempts']:>9} {result['throttled']:>10} {result['attempts_per_sec']:>13.1f} "
+                  f"{result['commits']:>8} {result['p50_ms']:>8.2f} {result['p99_ms']:>8.2f}")
+
+if __name__ == "__main__":
+    main()
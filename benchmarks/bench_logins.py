@@ -0,0 +1,56 @@
+# Measures password verification throughput (logins/sec) at each KDF cost setting,
+# inline on one thread and through the process pool used by the service layer.
+# Run from the repository root:  python -m benchmarks.bench_logins --costs low,interactive,high
+import argparse
+import concurrent.futures
+import time
+
+import auth
+
+
+# Function to time verifications of the given hashes in the calling thread
+def _serial_rate(password, hashes, count):
+    start = time.perf_counter()
+    for n in range(count):
+        auth.verify_password(password, hashes[n % len(hashes)])
+    return count / (time.perf_counter() - start)
+
+
+# Function to time verifications submitted all at once to a verification pool
+def _pooled_rate(pool, password, hashes, count):
+    # Warm the worker processes up so their start-up isn't counted
+    concurrent.futures.wait([pool.submit(password, hashes[0]) for _ in range(pool.max_workers)])
+    start = time.perf_counter()
+    futures = [pool.submit(password, hashes[n % len(hashes)]) for n in range(count)]
+    concurrent.futures.wait(futures)
+    elapsed = time.perf_counter() - start
+    if not all(future.result()[0] for future in futures):
+        raise AssertionError("verification failed")
+    return count / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark login verification per KDF cost")
+    parser.add_argument("--costs", default="low,interactive,high,pbkdf2", help="comma separated KDF_COSTS names")
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=None, help="pool size (default: number of cores)")
+    args = parser.parse_args()
+
+    password = "correct horse battery staple"
+    print(f"{'cost':>12} {'serial/sec':>11} {'pooled/sec':>11} {'workers':>8} {'peak queue':>11} {'avg ms':>8}")
+    for cost in args.costs.split(","):
+        auth.set_kdf_cost(cost)
+        hashes = [auth.hash_password(password) for _ in range(8)]
+        serial = _serial_rate(password, hashes, max(1, args.logins // 4))
+        pool = auth.VerificationPool(args.workers)
+        try:
+            pooled = _pooled_rate(pool, password, hashes, args.logins)
+            metrics = pool.metrics()
+        finally:
+            pool.shutdown()
+        print(f"{cost:>12} {serial:>11.1f} {pooled:>11.1f} {metrics['workers']:>8} "
+              f"{metrics['peak_queue_depth']:>11} {metrics['avg_verify_ms']:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
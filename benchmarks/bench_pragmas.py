@@ -0,0 +1,83 @@
+# Compares connection PRAGMA profiles under a mixed read/write load.
+# Run from the repository root:  python -m benchmarks.bench_pragmas --profiles rollback,wal --threads 4
+import argparse
+import random
+import threading
+import time
+
+from benchmarks.common import make_database, percentile, remove_database
+from connection_pool import ConnectionManager
+from history import iter_history_pages
+from transfer_engine import transfer_funds
+
+
+# Function run by each worker thread: a random mix of history reads and transfers
+def _worker(manager, num_accounts, ops, read_ratio, reads, writes, seed):
+    rng = random.Random(seed)
+    local_reads = []
+    local_writes = []
+    with manager.connection() as conn:
+        for _ in range(ops):
+            from_acc, to_acc = rng.sample(range(1, num_accounts + 1), 2)
+            start = time.perf_counter()
+            if rng.random() < read_ratio:
+                conn.execute("SELECT total_amount FROM accounts WHERE acc_num=?", (from_acc,)).fetchone()
+                next(iter_history_pages(conn, from_acc, page_size=20), None)
+                local_reads.append(time.perf_counter() - start)
+            else:
+                transfer_funds(conn, from_acc, to_acc, 1)
+                local_writes.append(time.perf_counter() - start)
+    reads.extend(local_reads)
+    writes.extend(local_writes)
+
+
+# Function to benchmark one profile and return its statistics
+def run(profile, num_threads, num_accounts, ops_per_thread, read_ratio):
+    path = make_database(num_accounts, 1000000)
+    manager = ConnectionManager(path, profile)
+    reads = []
+    writes = []
+    try:
+        # Seed some history so reads have pages to return
+        with manager.connection() as conn:
+            for n in range(num_accounts):
+                transfer_funds(conn, n % num_accounts + 1, (n + 1) % num_accounts + 1, 1)
+        threads = [threading.Thread(target=_worker, args=(manager, num_accounts, ops_per_thread, read_ratio, reads, writes, n))
+                   for n in range(num_threads)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        manager.close_all()
+        remove_database(path)
+
+    reads.sort()
+    writes.sort()
+    return {
+        "profile": profile,
+        "ops_per_sec": (len(reads) + len(writes)) / elapsed if elapsed else 0.0,
+        "read_p99_ms": percentile(reads, 99) * 1000,
+        "write_p99_ms": percentile(writes, 99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare PRAGMA profiles on mixed read/write load")
+    parser.add_argument("--profiles", default="rollback,wal_full,wal", help="comma separated profile names")
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--accounts", type=int, default=1000)
+    parser.add_argument("--ops", type=int, default=1000, help="operations per thread")
+    parser.add_argument("--read-ratio", type=float, default=0.8)
+    args = parser.parse_args()
+
+    print(f"{'profile':>10} {'ops/sec':>10} {'read p99 ms':>12} {'write p99 ms':>13}")
+    for profile in args.profiles.split(","):
+        result = run(profile, args.threads, args.accounts, args.ops, args.read_ratio)
+        print(f"{result['profile']:>10} {result['ops_per_sec']:>10.1f} {result['read_p99_ms']:>12.2f} {result['write_p99_ms']:>13.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# Measures import cost of the third-party modules and the time from launching a session to
+# its first prompt (answered with Exit), run directly and through the session daemon.
+# Run from the repository root:  python -m benchmarks.bench_startup --runs 10
+import argparse
+import os
+import shutil
+import signal
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.common import make_database
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(ROOT, "Secure Financial Framework.py")
+CLIENT = os.path.join(ROOT, "bank_session.py")
+MODULES = ["tabulate", "pyotp", "qrcode", "numpy"]
+
+
+# Function to time a command `runs` times, feeding it `stdin`; returns the sorted timings in ms
+def _time_command(command, runs, cwd, stdin=""):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=cwd, input=stdin, text=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        timings.append((time.perf_counter() - start) * 1000)
+    return sorted(timings)
+
+
+# Function to start the session daemon in `directory` and wait for its socket
+def _start_daemon(directory):
+    daemon = subprocess.Popen([sys.executable, SCRIPT, "--daemon"], cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    socket_path = os.path.join(directory, "bank.sock")
+    deadline = time.monotonic() + 30
+    while not os.path.exists(socket_path):
+        if daemon.poll() is not None or time.monotonic() > deadline:
+            daemon.kill()
+            raise RuntimeError("session daemon did not start")
+        time.sleep(0.05)
+    return daemon
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark module import and session start-up time")
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="bank_bench_startup_")
+    try:
+        path = make_database(100, 1000, os.path.join(directory, "bank.db"))
+        conn = sqlite3.connect(path)
+        conn.execute("INSERT INTO admin VALUES ('')")
+        conn.commit()
+        conn.close()
+
+        print(f"{'measurement':>28} {'median ms':>10} {'min ms':>8}")
+        baseline = _time_command([sys.executable, "-c", "pass"], args.runs, directory)
+        print(f"{'interpreter start':>28} {statistics.median(baseline):>10.1f} {baseline[0]:>8.1f}")
+        for module in MODULES:
+            timings = _time_command([sys.executable, "-c", f"import {module}"], args.runs, directory)
+            extra = statistics.median(timings) - statistics.median(baseline)
+            print(f"{'import ' + module:>28} {extra:>10.1f} {timings[0] - baseline[0]:>8.1f}")
+
+        direct = _time_command([sys.executable, SCRIPT], args.runs, directory, "3\n")
+        print(f"{'direct session':>28} {statistics.median(direct):>10.1f} {direct[0]:>8.1f}")
+        daemon = _start_daemon(directory)
+        try:
+            warm = _time_command([sys.executable, CLIENT], args.runs, directory, "3\n")
+        finally:
+            daemon.send_signal(signal.SIGINT)
+            daemon.wait()
+        print(f"{'session through daemon':>28} {statistics.median(warm):>10.1f} {warm[0]:>8.1f}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
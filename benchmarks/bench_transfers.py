@@ -0,0 +1,83 @@
+# Multi-threaded throughput benchmark for the atomic transfer engine.
+# Run from the repository root:  python -m benchmarks.bench_transfers --threads 1,2,4,8
+import argparse
+import random
+import sqlite3
+import threading
+import time
+
+from benchmarks.common import make_database, percentile, remove_database
+from transfer_engine import transfer_funds
+
+
+# Function run by each worker thread: perform transfers between random accounts and time each one
+def _worker(path, num_accounts, count, amount, latencies, failures, seed):
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path, timeout=1.0)
+    local = []
+    failed = 0
+    for _ in range(count):
+        from_acc, to_acc = rng.sample(range(1, num_accounts + 1), 2)
+        start = time.perf_counter()
+        success, _message = transfer_funds(conn, from_acc, to_acc, amount)
+        local.append(time.perf_counter() - start)
+        if not success:
+            failed += 1
+    conn.close()
+    latencies.extend(local)
+    failures.append(failed)
+
+
+# Function to run one benchmark round with the given number of threads and return its statistics
+def run(num_threads, num_accounts, transfers_per_thread, amount, balance):
+    path = make_database(num_accounts, balance)
+    latencies = []
+    failures = []
+    try:
+        threads = [threading.Thread(target=_worker, args=(path, num_accounts, transfers_per_thread, amount, latencies, failures, n))
+                   for n in range(num_threads)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        # Money is only moved, never created or destroyed
+        conn = sqlite3.connect(path)
+        total = conn.execute("SELECT SUM(total_amount) FROM accounts").fetchone()[0]
+        conn.close()
+        if total != num_accounts * balance:
+            raise AssertionError(f"balance drift detected: {total} != {num_accounts * balance}")
+    finally:
+        remove_database(path)
+
+    latencies.sort()
+    return {
+        "threads": num_threads,
+        "transfers": len(latencies),
+        "rejected": sum(failures),
+        "transfers_per_sec": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark concurrent transfers")
+    parser.add_argument("--threads", default="1,2,4,8", help="comma separated thread counts")
+    parser.add_argument("--accounts", type=int, default=1000)
+    parser.add_argument("--transfers", type=int, default=500, help="transfers per thread")
+    parser.add_argument("--amount", type=int, default=10)
+    parser.add_argument("--balance", type=int, default=1000000)
+    args = parser.parse_args()
+
+    print(f"{'threads':>8} {'transfers':>10} {'rejected':>9} {'xfers/sec':>10} {'p50 ms':>8} {'p99 ms':>8}")
+    for num_threads in (int(n) for n in args.threads.split(",")):
+        result = run(num_threads, args.accounts, args.transfers, args.amount, args.balance)
+        print(f"{result['threads']:>8} {result['transfers']:>10} {result['rejected']:>9} "
+              f"{result['transfers_per_sec']:>10.1f} {result['p50_ms']:>8.2f} {result['p99_ms']:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
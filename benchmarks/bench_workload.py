@@ -0,0 +1,294 @@
+# Load generator for the banking workflows: drives a weighted mix of logins, deposits,
+# withdrawals, transfers, history reads and admin listings through BankAccount and the module
+# functions from several threads or processes against a synthetic database.
+# Run from the repository root:
+#   python -m benchmarks.bench_workload --accounts 10000 --transactions 200000 --workers 8 --output run.json
+#   python -m benchmarks.bench_workload ... --compare baseline.json
+import argparse
+import concurrent.futures
+import contextlib
+import datetime
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import random
+import sqlite3
+import threading
+import time
+
+from account_listing import fetch_account_page
+from auth import KDF_COSTS, authenticate_account, get_verification_pool, hash_password, set_kdf_cost
+from benchmarks.common import load_main_module, make_database, percentile, remove_database
+from bulk_posting import post_batch
+from connection_pool import ConnectionManager
+import instrumentation
+import sharding
+
+PASSWORD = "benchmark-password"
+DEFAULT_MIX = "login=10,deposit=25,withdraw=20,transfer=20,history=20,listing=5"
+OPERATIONS = ("login", "deposit", "withdraw", "transfer", "history", "listing")
+
+
+# Function to parse "op=weight,..." into a dict of weights
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        op, _, weight = part.partition("=")
+        if op not in OPERATIONS:
+            raise ValueError(f"Unknown operation in mix: {op}")
+        mix[op] = float(weight or 1)
+    return mix
+
+
+# Function to build a benchmark database: funded accounts sharing one password hash and a seeded ledger
+def build_database(num_accounts, num_transactions, balance, kdf_cost, seed=0, path=None):
+    path = make_database(num_accounts, 0, path)
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute("UPDATE accounts SET password=?", (hash_password(PASSWORD, KDF_COSTS[kdf_cost]),))
+        conn.execute("INSERT INTO admin VALUES (?)", (hash_password(PASSWORD, KDF_COSTS[kdf_cost]),))
+        conn.commit()
+        # Opening balances first, then random postings, all through the real posting path
+        post_batch(conn, ((acc_num, "deposit", balance) for acc_num in range(1, num_accounts + 1)))
+        rng = random.Random(seed)
+        postings = ((rng.randint(1, num_accounts), rng.choice(("deposit", "withdrawal")), rng.randint(1, 100))
+                    for _ in range(max(0, num_transactions - num_accounts)))
+        post_batch(conn, postings, chunk_size=5000)
+    finally:
+        conn.close()
+    return path
+
+
+# Function to return the size in bytes of a database together with its WAL file and any shard files
+def database_size(path, shards=None):
+    paths = [path] + (sharding.shard_paths(path, shards) if shards else [])
+    return sum(os.path.getsize(name + suffix) for name in paths for suffix in ("", "-wal") if os.path.exists(name + suffix))
+
+
+# Function to perform one operation of the given kind the way an interactive session does
+def _perform(bank, conn, op, rng, num_accounts):
+    acc_num = rng.randint(1, num_accounts)
+    if op == "login":
+        details = authenticate_account(conn, acc_num, PASSWORD)
+        bank.BankAccount(details[0], details[1], conn)
+    elif op == "deposit":
+        account = bank.BankAccount(None, acc_num, conn)
+        account.deposit(rng.randint(1, 100))
+        account.update_database()
+    elif op == "withdraw":
+        account = bank.BankAccount(None, acc_num, conn)
+        account.withdraw(rng.randint(1, 100))
+        account.update_database()
+    elif op == "transfer":
+        target = acc_num % num_accounts + 1
+        bank.BankAccount(None, acc_num, conn).transfer(rng.randint(1, 100), bank.BankAccount(None, target, conn))
+    elif op == "history":
+        list(itertools.islice(bank.BankAccount(None, acc_num, conn).get_transaction_history(page_size=20), 20))
+    else:
+        router = sharding.get_router()
+        fetch_page = router.fetch_account_page if router is not None else fetch_account_page
+        fetch_page(conn, page_size=50, sort_by="balance", descending=True)
+
+
+# Function run by each worker (thread or process): `ops` operations drawn from the mix
+# Returns ({op: [latency seconds]}, commits). quiet swallows what BankAccount prints (such as
+# insufficient funds); thread workers are silenced by the caller instead, as stdout is shared.
+# With shards, process workers open the shards themselves; thread workers share the caller's router.
+# kdf_cost must match the stored hashes, or every first login re-hashes its password and times that.
+def run_worker(path, profile, mix, ops, num_accounts, seed, quiet=False, shards=None, kdf_cost=None):
+    bank = load_main_module()
+    if kdf_cost is not None:
+        set_kdf_cost(kdf_cost)
+    router = sharding.get_router()
+    owns_router = shards and router is None
+    if owns_router:
+        router = sharding.configure_shards(path, shards, profile)
+    rng = random.Random(seed)
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    latencies = {name: [] for name in names}
+    commits = 0
+
+    def count_commits(sql):
+        nonlocal commits
+        if sql == "COMMIT":
+            commits += 1
+
+    manager = ConnectionManager(path, profile)
+    conn = manager.acquire()
+    # Account writes go to the shards, so that is where the commits are counted
+    connections = router.shard_connections() if router is not None else [conn]
+    # When instrumentation is on it owns the trace callback and counts the commits itself
+    if instrumentation.get_metrics() is None:
+        for connection in connections:
+            connection.set_trace_callback(count_commits)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()) if quiet else contextlib.nullcontext():
+            for op in rng.choices(names, weights, k=ops):
+                start = time.perf_counter()
+                _perform(bank, conn, op, rng, num_accounts)
+                latencies[op].append(time.perf_counter() - start)
+    finally:
+        for connection in connections:
+            connection.set_trace_callback(None)
+        manager.close_all()
+        if owns_router:
+            sharding.close_shards()
+        elif router is not None:
+            router.release()
+    return latencies, commits
+
+
+# Function run in each worker process: run_worker, then stop the process's verification pool
+# Logins verify in that pool, and a spawned worker can't exit while its processes wait for work.
+def run_process_worker(*args):
+    try:
+        return run_worker(*args)
+    finally:
+        get_verification_pool().shutdown()
+
+
+# Function to run one load round and return its results as a dict
+# With metrics_path (thread mode only) the run is instrumented and its metrics written there.
+# With shards the database is split into that many shard files before the run.
+def run(num_accounts, num_transactions, workers, ops_per_worker, mix, mode="thread", profile="wal", kdf_cost="low", balance=1000000,
+        metrics_path=None, shards=None):
+    if metrics_path and mode != "thread":
+        raise ValueError("Metrics can only be collected in thread mode")
+    # Logins verify at the cost the hashes were stored with instead of upgrading them
+    set_kdf_cost(kdf_cost)
+    path = build_database(num_accounts, num_transactions, balance, kdf_cost)
+    if shards:
+        sharding.split_database(path, shards)
+        if mode == "thread":
+            sharding.configure_shards(path, shards, profile)
+    metrics = instrumentation.configure(metrics_path, interval=3600) if metrics_path else None
+    try:
+        size_before = database_size(path, shards)
+        start = time.perf_counter()
+        if mode == "process":
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+                futures = [pool.submit(run_process_worker, path, profile, mix, ops_per_worker, num_accounts, n, True, shards, kdf_cost) for n in range(workers)]
+                outcomes = [future.result() for future in futures]
+        else:
+            outcomes = [None] * workers
+
+            def _thread(n):
+                outcomes[n] = run_worker(path, profile, mix, ops_per_worker, num_accounts, n, shards=shards)
+
+            threads = [threading.Thread(target=_thread, args=(n,)) for n in range(workers)]
+            with contextlib.redirect_stdout(io.StringIO()):
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+        elapsed = time.perf_counter() - start
+        size_after = database_size(path, shards)
+        if metrics is not None:
+            commits = metrics.statement_counts().get("COMMIT", 0)
+            instrumentation.shutdown()
+        else:
+            commits = sum(outcome[1] for outcome in outcomes)
+    finally:
+        sharding.close_shards()
+        get_verification_pool().shutdown()
+        remove_database(path)
+        for shard_path in sharding.shard_paths(path, shards) if shards else []:
+            remove_database(shard_path)
+
+    total_ops = workers * ops_per_worker
+    operations = {}
+    for op in mix:
+        latencies = sorted(itertools.chain.from_iterable(outcome[0][op] for outcome in outcomes))
+        operations[op] = {
+            "count": len(latencies),
+            "ops_per_sec": len(latencies) / elapsed if elapsed else 0.0,
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p95_ms": percentile(latencies, 95) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+        }
+    return {
+        "config": {"accounts": num_accounts, "transactions": num_transactions, "workers": workers, "ops_per_worker": ops_per_worker,
+                   "mix": mix, "mode": mode, "profile": profile, "kdf_cost": kdf_cost, "instrumented": bool(metrics_path),
+                   "shards": shards},
+        "environment": {"python": platform.python_version(), "sqlite": sqlite3.sqlite_version, "platform": platform.platform(),
+                        "cpus": os.cpu_count(), "time": datetime.datetime.now().isoformat(timespec="seconds")},
+        "total": {"ops": total_ops, "seconds": elapsed, "ops_per_sec": total_ops / elapsed if elapsed else 0.0,
+                  "commits": commits, "commits_per_op": commits / total_ops if total_ops else 0.0,
+                  "db_bytes_before": size_before, "db_bytes_after": size_after,
+                  "db_growth_bytes_per_op": (size_after - size_before) / total_ops if total_ops else 0.0},
+        "operations": operations,
+    }
+
+
+# Function to print a result set as a table
+def print_results(results):
+    total = results["total"]
+    print(f"{'operation':>10} {'count':>8} {'ops/sec':>10} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for op, stats in results["operations"].items():
+        print(f"{op:>10} {stats['count']:>8} {stats['ops_per_sec']:>10.1f} {stats['p50_ms']:>8.2f} {stats['p95_ms']:>8.2f} {stats['p99_ms']:>8.2f}")
+    print(f"{'total':>10} {total['ops']:>8} {total['ops_per_sec']:>10.1f}")
+    print(f"commits/op: {total['commits_per_op']:.2f}   db growth: {total['db_bytes_after'] - total['db_bytes_before']} bytes "
+          f"({total['db_growth_bytes_per_op']:.1f} bytes/op)")
+
+
+# Function to print how a run compares with a saved baseline; returns the regressions found
+# A regression is throughput down or p95 latency up by more than `tolerance` (a fraction).
+def compare(results, baseline, tolerance=0.10):
+    regressions = []
+    print(f"{'operation':>10} {'ops/sec':>10} {'baseline':>10} {'change':>8} {'p95 ms':>8} {'baseline':>9} {'change':>8}")
+    rows = [("total", results["total"], baseline["total"], None, None)]
+    rows += [(op, stats, baseline["operations"][op], stats["p95_ms"], baseline["operations"][op]["p95_ms"])
+             for op, stats in results["operations"].items() if op in baseline["operations"]]
+    for op, stats, base, p95, base_p95 in rows:
+        rate_change = stats["ops_per_sec"] / base["ops_per_sec"] - 1 if base["ops_per_sec"] else 0.0
+        line = f"{op:>10} {stats['ops_per_sec']:>10.1f} {base['ops_per_sec']:>10.1f} {rate_change:>+8.1%}"
+        if rate_change < -tolerance:
+            regressions.append(f"{op}: throughput {rate_change:+.1%}")
+        if p95 is not None:
+            p95_change = p95 / base_p95 - 1 if base_p95 else 0.0
+            line += f" {p95:>8.2f} {base_p95:>9.2f} {p95_change:>+8.1%}"
+            if p95_change > tolerance:
+                regressions.append(f"{op}: p95 latency {p95_change:+.1%}")
+        print(line)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-generation benchmark for the banking workflows")
+    parser.add_argument("--accounts", type=int, default=1000)
+    parser.add_argument("--transactions", type=int, default=20000, help="ledger rows to seed the database with")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--ops", type=int, default=500, help="operations per worker")
+    parser.add_argument("--mode", choices=("thread", "process"), default="thread")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="comma separated op=weight pairs")
+    parser.add_argument("--profile", default="wal", help="connection_pool PRAGMA profile")
+    parser.add_argument("--kdf-cost", default="low", choices=sorted(KDF_COSTS))
+    parser.add_argument("--shards", type=int, help="split the database into this many shards (see sharding.py)")
+    parser.add_argument("--metrics", help="instrument the run and write its metrics to this file (thread mode)")
+    parser.add_argument("--output", help="save the results as JSON")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="allowed slowdown before flagging a regression")
+    args = parser.parse_args()
+
+    results = run(args.accounts, args.transactions, args.workers, args.ops, parse_mix(args.mix), args.mode, args.profile, args.kdf_cost,
+                  metrics_path=args.metrics, shards=args.shards)
+    print_results(results)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+        print(f"Results saved to {args.output}")
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
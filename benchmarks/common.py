@@ -0,0 +1,53 @@
+import importlib.util
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+
+from schema import initialize_database
+
+_load_lock = threading.Lock()
+
+
+# Function to create a fresh database file with the banking schema and funded accounts
+def make_database(num_accounts, balance, path=None):
+    if path is None:
+        fd, path = tempfile.mkstemp(prefix="bank_bench_", suffix=".db")
+        os.close(fd)
+    conn = sqlite3.connect(path)
+    initialize_database(conn)
+    conn.executemany("INSERT INTO accounts (name, acc_num, total_amount, total_dep, total_wit, total_tra, incorrect_password_attempts, is_locked, password, two_factor_enabled, incorrect_2fa_attempts) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                     ((f"user{n}", n, balance, balance, 0, 0, 0, 0, "", 0, 0) for n in range(1, num_accounts + 1)))
+    conn.commit()
+    conn.close()
+    return path
+
+
+# Function to remove a benchmark database together with any journal/WAL side files
+def remove_database(path):
+    for suffix in ("", "-journal", "-wal", "-shm"):
+        try:
+            os.remove(path + suffix)
+        except FileNotFoundError:
+            pass
+
+
+# Function to return the pct-th percentile (nearest rank) of an already sorted list
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[rank]
+
+
+# Function to import "Secure Financial Framework.py" (its file name isn't a valid module name)
+def load_main_module():
+    with _load_lock:
+        if "secure_financial_framework" not in sys.modules:
+            path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Secure Financial Framework.py")
+            spec = importlib.util.spec_from_file_location("secure_financial_framework", path)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            sys.modules["secure_financial_framework"] = module
+        return sys.modules["secure_financial_framework"]
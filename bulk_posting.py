@@ -0,0 +1,98 @@
+import sqlite3
+
+from account_repository import invalidate_accounts
+from aggregates import advance_aggregates
+from checkpoints import advance_checkpoints
+
+DEFAULT_CHUNK_SIZE = 1000
+
+# SQLite caps the number of bound parameters per statement, so account lookups are split up
+_LOOKUP_BATCH = 500
+
+
+# Function to load the current totals of the given accounts inside the open transaction
+def _load_balances(cursor, acc_nums):
+    balances = {}
+    acc_nums = list(acc_nums)
+    for start in range(0, len(acc_nums), _LOOKUP_BATCH):
+        batch = acc_nums[start:start + _LOOKUP_BATCH]
+        placeholders = ",".join("?" * len(batch))
+        cursor.execute(f"SELECT acc_num, total_amount FROM accounts WHERE acc_num IN ({placeholders})", batch)
+        for acc_num, total_amount in cursor.fetchall():
+            balances[acc_num] = total_amount
+    return balances
+
+
+# Function to check and apply one chunk of postings, writing it in a single transaction
+def _post_chunk(conn, chunk, offset, rejects):
+    cursor = conn.cursor()
+    if not conn.in_transaction:
+        # Take the write lock up front so the balances read below cannot change before the updates
+        cursor.execute("BEGIN IMMEDIATE")
+    # Per-account deltas for total_amount, total_dep and total_wit; set before the try so the
+    # finally below can run even if loading the balances fails
+    deltas = {}
+    try:
+        balances = _load_balances(cursor, {posting[0] for posting in chunk})
+        ledger_rows = []
+
+        for index, (acc_num, transaction_type, amount) in enumerate(chunk, start=offset):
+            if acc_num not in balances:
+                rejects.append((index, acc_num, transaction_type, amount, "Account not found"))
+                continue
+            if not isinstance(amount, int) or isinstance(amount, bool) or amount <= 0:
+                rejects.append((index, acc_num, transaction_type, amount, "Invalid amount"))
+                continue
+
+            delta = deltas.setdefault(acc_num, [0, 0, 0])
+            if transaction_type == 'deposit':
+                balances[acc_num] += amount
+                delta[0] += amount
+                delta[1] += amount
+                ledger_rows.append((acc_num, 'deposit', amount))
+            elif transaction_type == 'withdrawal':
+                if amount > balances[acc_num]:
+                    rejects.append((index, acc_num, transaction_type, amount, "Insufficient funds"))
+                    continue
+                balances[acc_num] -= amount
+                delta[0] -= amount
+                delta[2] += amount
+                ledger_rows.append((acc_num, 'withdrawal', -amount))
+            else:
+                rejects.append((index, acc_num, transaction_type, amount, "Unknown transaction type"))
+
+        cursor.executemany("INSERT INTO transactions (acc_num, transaction_type, amount) VALUES (?, ?, ?)", ledger_rows)
+        cursor.executemany("UPDATE accounts SET total_amount = total_amount + ?, total_dep = total_dep + ?, total_wit = total_wit + ? WHERE acc_num = ?",
+                           [(d[0], d[1], d[2], acc_num) for acc_num, d in deltas.items() if d != [0, 0, 0]])
+        advance_checkpoints(conn, {row[0] for row in ledger_rows})
+        advance_aggregates(conn)
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    finally:
+        invalidate_accounts(conn, *deltas)
+    return len(ledger_rows)
+
+
+# Function to post many deposits/withdrawals, committing once per chunk
+# postings is an iterable of (acc_num, transaction_type, amount) with transaction_type
+# 'deposit' or 'withdrawal' and a positive integer amount. Rows are applied in order, so a
+# withdrawal can be covered by an earlier deposit in the same batch.
+# Returns (posted_count, rejects) where each reject is (index, acc_num, transaction_type, amount, reason).
+def post_batch(conn, postings, chunk_size=DEFAULT_CHUNK_SIZE):
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be at least 1")
+    posted = 0
+    rejects = []
+    chunk = []
+    offset = 0
+    for posting in postings:
+        chunk.append(tuple(posting))
+        if len(chunk) == chunk_size:
+            posted += _post_chunk(conn, chunk, offset, rejects)
+            offset += len(chunk)
+            chunk = []
+    if chunk:
+        posted += _post_chunk(conn, chunk, offset, rejects)
+    return posted, rejects
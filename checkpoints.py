@@ -0,0 +1,164 @@
+# Periodic balance checkpoints for point-in-time balance queries.
+# Run from the repository root:
+#   python checkpoints.py [--db bank.db] rebuild
+#   python checkpoints.py [--db bank.db] balance ACC_NUM "YYYY-MM-DD HH:MM:SS"
+import argparse
+import datetime
+import sqlite3
+
+from archive import ledger_windows, window_select, window_tables
+from history import format_timestamp, iter_history_pages
+from schema import initialize_database
+
+# A checkpoint is written after this many ledger rows of an account...
+CHECKPOINT_EVERY_ROWS = 1000
+# ...or once this many seconds of ledger time have passed since the account's last checkpoint
+CHECKPOINT_EVERY_SECONDS = 7 * 24 * 60 * 60
+
+_REBUILD_FETCH = 5000
+
+
+# Function to parse an SQLite CURRENT_TIMESTAMP string
+def _parse_timestamp(value):
+    return datetime.datetime.fromisoformat(value)
+
+
+# Function to fold an account's ledger rows into its running balance, emitting checkpoints as it goes
+# state is (timestamp, transaction_id, balance, rows_since_checkpoint, checkpoint_timestamp) and is returned updated.
+def _fold(acc_num, rows, state, checkpoints, every_rows, every_seconds):
+    last_ts, last_id, balance, rows_since, checkpoint_ts = state
+    checkpoint_time = _parse_timestamp(checkpoint_ts) if checkpoint_ts else None
+    for transaction_id, amount, timestamp in rows:
+        balance += amount
+        rows_since += 1
+        last_ts, last_id = timestamp, transaction_id
+        if checkpoint_time is None:
+            # The first ledger row starts the clock for time-based checkpoints
+            checkpoint_time = _parse_timestamp(timestamp)
+            checkpoint_ts = timestamp
+        if rows_since >= every_rows or (_parse_timestamp(timestamp) - checkpoint_time).total_seconds() >= every_seconds:
+            checkpoints.append((acc_num, timestamp, transaction_id, balance))
+            rows_since = 0
+            checkpoint_ts = timestamp
+            checkpoint_time = _parse_timestamp(timestamp)
+    return last_ts, last_id, balance, rows_since, checkpoint_ts
+
+
+# Function to bring the checkpoints of the given accounts up to date with their newest ledger rows
+# Runs inside the caller's transaction and doesn't commit, so the checkpoints are written
+# atomically with the postings that produced them. Only rows after the last processed
+# (timestamp, transaction_id) are read; rows inserted with an older timestamp than that need
+# rebuild_checkpoints.
+def advance_checkpoints(conn, acc_nums, every_rows=None, every_seconds=None):
+    every_rows = every_rows or CHECKPOINT_EVERY_ROWS
+    every_seconds = every_seconds or CHECKPOINT_EVERY_SECONDS
+    cursor = conn.cursor()
+    checkpoints = []
+    states = []
+    for acc_num in set(acc_nums):
+        cursor.execute("SELECT timestamp, transaction_id, balance, rows_since_checkpoint, checkpoint_timestamp FROM balance_checkpoint_state WHERE acc_num=?", (acc_num,))
+        state = cursor.fetchone()
+        if state is None:
+            state = (None, None, 0, 0, None)
+            cursor.execute("SELECT transaction_id, amount, timestamp FROM transactions WHERE acc_num=? ORDER BY timestamp, transaction_id", (acc_num,))
+        else:
+            cursor.execute("SELECT transaction_id, amount, timestamp FROM transactions WHERE acc_num=? AND (timestamp, transaction_id) > (?, ?) ORDER BY timestamp, transaction_id",
+                           (acc_num, state[0], state[1]))
+        new_state = _fold(acc_num, cursor.fetchall(), state, checkpoints, every_rows, every_seconds)
+        if new_state != state:
+            states.append((acc_num,) + new_state)
+    cursor.executemany("INSERT OR REPLACE INTO balance_checkpoints (acc_num, timestamp, transaction_id, balance) VALUES (?, ?, ?, ?)", checkpoints)
+    cursor.executemany("INSERT OR REPLACE INTO balance_checkpoint_state (acc_num, timestamp, transaction_id, balance, rows_since_checkpoint, checkpoint_timestamp) VALUES (?, ?, ?, ?, ?, ?)", states)
+    return len(checkpoints)
+
+
+# Function to return an account's balance after every transaction with timestamp <= at
+# One indexed lookup finds the latest checkpoint at or before `at`; only the ledger rows between
+# that checkpoint and `at` are summed, reading archived months only if that span reaches them.
+# Pass 'YYYY-MM-DD 23:59:59' for the end of a day.
+def balance_at(conn, acc_num, at):
+    at = format_timestamp(at)
+    cursor = conn.cursor()
+    cursor.execute("SELECT timestamp, transaction_id, balance FROM balance_checkpoints WHERE acc_num=? AND timestamp <= ? ORDER BY timestamp DESC, transaction_id DESC LIMIT 1",
+                   (acc_num, at))
+    checkpoint = cursor.fetchone()
+    conditions = ["acc_num = ?", "timestamp <= ?"]
+    params = [acc_num, at]
+    balance = 0
+    if checkpoint is not None:
+        conditions.append("(timestamp, transaction_id) > (?, ?)")
+        params.extend(checkpoint[:2])
+        balance = checkpoint[2]
+    for window in ledger_windows(conn, checkpoint[0] if checkpoint else None):
+        if window[2] is not None and window[2] > at:
+            break
+        sql, sql_params = window_select(window_tables(conn, window), "IFNULL(SUM(amount), 0)", conditions, params, window[2], window[3])
+        balance += cursor.execute(sql, sql_params).fetchone()[0]
+    return balance
+
+
+# Function to recompute checkpoints from scratch for the given accounts (all accounts by default)
+# Streams each account's ledger in pages and commits once per account.
+def rebuild_checkpoints(conn, acc_nums=None, every_rows=None, every_seconds=None):
+    every_rows = every_rows or CHECKPOINT_EVERY_ROWS
+    every_seconds = every_seconds or CHECKPOINT_EVERY_SECONDS
+    if acc_nums is None:
+        acc_nums = [row[0] for row in conn.execute("SELECT acc_num FROM accounts UNION SELECT DISTINCT acc_num FROM transactions ORDER BY 1")]
+    written = 0
+    for acc_num in acc_nums:
+        # Fold the whole ledger (archived months included) before opening the write transaction,
+        # since archives can't be attached inside one
+        checkpoints = []
+        state = (None, None, 0, 0, None)
+        for page in iter_history_pages(conn, acc_num, page_size=_REBUILD_FETCH):
+            state = _fold(acc_num, [(row[0], row[2], row[3]) for row in page], state, checkpoints, every_rows, every_seconds)
+        cursor = conn.cursor()
+        try:
+            cursor.execute("DELETE FROM balance_checkpoints WHERE acc_num=?", (acc_num,))
+            cursor.execute("DELETE FROM balance_checkpoint_state WHERE acc_num=?", (acc_num,))
+            cursor.executemany("INSERT INTO balance_checkpoints (acc_num, timestamp, transaction_id, balance) VALUES (?, ?, ?, ?)", checkpoints)
+            written += len(checkpoints)
+            if state[1] is not None:
+                cursor.execute("INSERT INTO balance_checkpoint_state (acc_num, timestamp, transaction_id, balance, rows_since_checkpoint, checkpoint_timestamp) VALUES (?, ?, ?, ?, ?, ?)",
+                               (acc_num,) + state)
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Balance checkpoint maintenance")
+    parser.add_argument("--db", default="bank.db")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    rebuild = subparsers.add_parser("rebuild", help="recompute all checkpoints from the ledger")
+    rebuild.add_argument("--every-rows", type=int, default=CHECKPOINT_EVERY_ROWS)
+    rebuild.add_argument("--every-seconds", type=int, default=CHECKPOINT_EVERY_SECONDS)
+    balance = subparsers.add_parser("balance", help="print an account's balance at a point in time")
+    balance.add_argument("acc_num", type=int)
+    balance.add_argument("at", help="'YYYY-MM-DD HH:MM:SS'")
+    args = parser.parse_args()
+
+    # Imported here, as sharding itself depends on this module
+    from sharding import account_path, data_paths
+
+    # A sharded database keeps each account's ledger and checkpoints in its shard file
+    paths = data_paths(args.db) if args.command == "rebuild" else [account_path(args.db, args.acc_num)]
+    written = 0
+    for path in paths:
+        conn = sqlite3.connect(path)
+        try:
+            initialize_database(conn)
+            if args.command == "rebuild":
+                written += rebuild_checkpoints(conn, every_rows=args.every_rows, every_seconds=args.every_seconds)
+            else:
+                print(f"Balance of account {args.acc_num} at {args.at}: {balance_at(conn, args.acc_num, args.at)}")
+        finally:
+            conn.close()
+    if args.command == "rebuild":
+        print(f"Wrote {written} checkpoints.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+import contextlib
+import sqlite3
+import threading
+
+from instrumentation import instrument
+
+# Named PRAGMA profiles; journal_mode is applied first because it decides what the others mean
+PRAGMA_PROFILES = {
+    # SQLite's defaults: rollback journal, readers and writers block each other
+    "rollback": {
+        "journal_mode": "DELETE",
+        "synchronous": "FULL",
+        "busy_timeout": 5000,
+    },
+    # Readers never block the writer; commits only fsync at checkpoints
+    "wal": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "mmap_size": 256 * 1024 * 1024,
+        "cache_size": -64 * 1024,  # negative means KiB, i.e. 64 MiB
+        "busy_timeout": 5000,
+        "temp_store": "MEMORY",
+    },
+    # WAL concurrency while still fsyncing on every commit
+    "wal_full": {
+        "journal_mode": "WAL",
+        "synchronous": "FULL",
+        "mmap_size": 256 * 1024 * 1024,
+        "cache_size": -64 * 1024,
+        "busy_timeout": 5000,
+        "temp_store": "MEMORY",
+    },
+}
+
+DEFAULT_PROFILE = "wal"
+DEFAULT_DATABASE = "bank.db"
+CACHED_STATEMENTS = 256
+
+# Read-only statements run once per new connection so the hot statements are already prepared
+WARM_STATEMENTS = [
+    ("SELECT total_amount, total_dep, total_wit, total_tra, incorrect_password_attempts, is_locked, two_factor_enabled, incorrect_2fa_attempts FROM accounts WHERE acc_num=?", (-1,)),
+    ("SELECT * FROM accounts WHERE acc_num=?", (-1,)),
+    ("SELECT * FROM admin WHERE password=?", ("",)),
+]
+
+
+# Function to apply a PRAGMA profile (a profile name or a dict of pragma -> value) to a connection
+def apply_profile(conn, profile):
+    if isinstance(profile, str):
+        profile = PRAGMA_PROFILES[profile]
+    pragmas = dict(profile)
+    journal_mode = pragmas.pop("journal_mode", None)
+    if journal_mode is not None:
+        conn.execute(f"PRAGMA journal_mode={journal_mode}")
+    for name, value in pragmas.items():
+        conn.execute(f"PRAGMA {name}={value}")
+
+
+class ConnectionManager:
+    # Hands every thread its own connection, reusing connections released by finished threads
+    def __init__(self, path=DEFAULT_DATABASE, profile=DEFAULT_PROFILE, max_connections=None,
+                 cached_statements=CACHED_STATEMENTS, warm_statements=WARM_STATEMENTS):
+        self.path = path
+        self.profile = profile
+        self.max_connections = max_connections
+        self.cached_statements = cached_statements
+        self.warm_statements = list(warm_statements)
+        self._local = threading.local()
+        self._idle = []
+        self._all = []
+        self._available = threading.Condition()
+
+    # Method to open a new connection with the configured profile and warm statement cache
+    def _open(self):
+        # check_same_thread is off because a released connection may be picked up by another
+        # thread; the manager still guarantees that only one thread uses it at a time
+        conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=self.cached_statements)
+        apply_profile(conn, self.profile)
+        for sql, params in self.warm_statements:
+            try:
+                conn.execute(sql, params).fetchall()
+            except sqlite3.OperationalError:
+                # The tables may not exist yet on a brand new database
+                pass
+        return instrument(conn)
+
+    # Method to return the calling thread's connection, taking one from the pool if needed
+    def acquire(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            return conn
+        with self._available:
+            while not self._idle and self.max_connections is not None and len(self._all) >= self.max_connections:
+                self._available.wait()
+            if self._idle:
+                conn = self._idle.pop()
+            else:
+                conn = self._open()
+                self._all.append(conn)
+        self._local.conn = conn
+        return conn
+
+    # Method to hand the calling thread's connection back to the pool
+    def release(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            return
+        self._local.conn = None
+        if conn.in_transaction:
+            conn.rollback()
+        with self._available:
+            self._idle.append(conn)
+            self._available.notify()
+
+    # Method to borrow a connection for the duration of a with-block
+    @contextlib.contextmanager
+    def connection(self):
+        owned = getattr(self._local, "conn", None) is None
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            if owned:
+                self.release()
+
+    # Method to close every connection the manager has opened
+    def close_all(self):
+        with self._available:
+            for conn in self._all:
+                conn.close()
+            self._all.clear()
+            self._idle.clear()
+        self._local = threading.local()
+
+
+_default_manager = None
+_default_lock = threading.Lock()
+
+
+# Function to (re)configure the process-wide connection manager
+def configure(path=DEFAULT_DATABASE, profile=DEFAULT_PROFILE, **options):
+    global _default_manager
+    with _default_lock:
+        if _default_manager is not None:
+            _default_manager.close_all()
+        _default_manager = ConnectionManager(path, profile, **options)
+    return _default_manager
+
+
+# Function to return the process-wide connection manager, creating it with defaults if needed
+def get_manager():
+    global _default_manager
+    with _default_lock:
+        if _default_manager is None:
+            _default_manager = ConnectionManager()
+        return _default_manager
+
+
+# Function to return the calling thread's connection from the process-wide manager
+def get_connection():
+    return get_manager().acquire()
+
+
+# Function to use the given connection, or the calling thread's pooled connection if none is given
+def resolve_connection(conn=None):
+    return conn if conn is not None else get_connection()
+
+
+# Function to close all pooled connections of the process-wide manager
+def close_all():
+    with _default_lock:
+        if _default_manager is not None:
+            _default_manager.close_all()
+
+
+_router = None
+
+
+# Function to install (or with None remove) the shard router that account_connection consults
+# The router must provide connection_for(acc_num); see sharding.py.
+def set_router(router):
+    global _router
+    _router = router
+
+
+# Function to return the installed shard router, or None
+def get_router():
+    return _router
+
+
+# Function to return the connection holding an account's rows
+# With a shard router installed this is the calling thread's connection to the account's shard,
+# whatever conn is given; otherwise it is resolve_connection(conn).
+def account_connection(acc_num, conn=None):
+    if _router is not None:
+        return _router.connection_for(acc_num)
+    return resolve_connection(conn)
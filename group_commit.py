@@ -0,0 +1,206 @@
+# Optional group commit: instead of every session committing (and fsyncing) its own writes,
+# sessions hand them to one writer thread per database file, which applies everything that
+# arrives within a short window in a single transaction.
+#
+# A write unit is a function taking the writer's connection. It runs its statements without
+# committing and returns a result. Each unit runs under its own savepoint, so a unit that raises
+# is rolled back alone: its future gets the exception and the rest of the batch still commits.
+# Futures resolve only once the batch's COMMIT has returned; with the default wal_full profile
+# that COMMIT is fsynced, so a resolved future means the write is durable.
+import concurrent.futures
+import queue
+import sqlite3
+import threading
+import time
+
+import connection_pool
+from instrumentation import instrument
+
+DEFAULT_MAX_DELAY = 0.002
+DEFAULT_MAX_BATCH = 500
+DEFAULT_PROFILE = "wal_full"
+
+_CLOSE = object()
+
+
+class GroupCommitWriter:
+    # Applies submitted write units in batches on its own thread and connection
+    # A batch is closed max_delay seconds after its first unit arrived or at max_batch units.
+    def __init__(self, path=connection_pool.DEFAULT_DATABASE, profile=DEFAULT_PROFILE, max_delay=DEFAULT_MAX_DELAY, max_batch=DEFAULT_MAX_BATCH):
+        if max_batch < 1:
+            raise ValueError("max_batch must be at least 1")
+        self.path = path
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        connection_pool.apply_profile(self.conn, profile)
+        instrument(self.conn)
+        self._queue = queue.SimpleQueue()
+        self._closed = False
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.units = 0
+        self.failed = 0
+        self.largest_batch = 0
+        self._thread = threading.Thread(target=self._run, name="group-commit", daemon=True)
+        self._thread.start()
+
+    # Method to queue a write unit and return a future resolving to its result once committed
+    def submit(self, unit):
+        future = concurrent.futures.Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("The group-commit writer is closed")
+            self._queue.put((unit, future))
+        return future
+
+    # Method to run a write unit through the writer and wait until it is committed
+    def execute(self, unit):
+        return self.submit(unit).result()
+
+    # Method to wait for the next batch; returns an empty list once the writer is closed
+    def _collect(self):
+        item = self._queue.get()
+        if item is _CLOSE:
+            return []
+        batch = [item]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _CLOSE:
+                # Finish this batch first; the close marker ends the loop afterwards
+                self._queue.put(_CLOSE)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if not batch:
+                return
+            self._apply(batch)
+
+    # Method to run one batch in a single transaction and resolve its futures after the commit
+    def _apply(self, batch):
+        conn = self.conn
+        applied = []
+        failed = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for unit, future in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                conn.execute("SAVEPOINT write_unit")
+                try:
+                    result = unit(conn)
+                except Exception as e:
+                    conn.execute("ROLLBACK TO write_unit")
+                    conn.execute("RELEASE write_unit")
+                    failed.append((future, e))
+                    continue
+                conn.execute("RELEASE write_unit")
+                applied.append((future, result))
+            conn.commit()
+        except Exception as e:
+            # The transaction itself failed (busy, disk full, ...): nothing of the batch is kept
+            if conn.in_transaction:
+                conn.rollback()
+            with self._lock:
+                self.failed += len(batch)
+            for unit, future in batch:
+                if future.running() or (not future.done() and future.set_running_or_notify_cancel()):
+                    future.set_exception(e)
+            return
+        with self._lock:
+            self.batches += 1
+            self.units += len(applied)
+            self.failed += len(failed)
+            self.largest_batch = max(self.largest_batch, len(batch))
+        for future, result in applied:
+            future.set_result(result)
+        for future, error in failed:
+            future.set_exception(error)
+
+    # Method to report how many batches (commits) and units the writer has handled
+    def stats(self):
+        with self._lock:
+            return {
+                "batches": self.batches,
+                "units": self.units,
+                "failed": self.failed,
+                "largest_batch": self.largest_batch,
+                "units_per_batch": self.units / self.batches if self.batches else 0.0,
+            }
+
+    # Method to apply what is still queued, stop the writer thread and close its connection
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(_CLOSE)
+        self._thread.join()
+        self.conn.close()
+
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+# Function to route the process's account writes through group-commit writers
+# One writer serves the pooled database, or one per shard when the database is sharded (call
+# after sharding.configure_shards).
+def enable_group_commit(max_delay=DEFAULT_MAX_DELAY, max_batch=DEFAULT_MAX_BATCH, profile=DEFAULT_PROFILE):
+    disable_group_commit()
+    router = connection_pool.get_router()
+    paths = router.paths if router is not None else [connection_pool.get_manager().path]
+    with _writers_lock:
+        for path in paths:
+            _writers[path] = GroupCommitWriter(path, profile, max_delay, max_batch)
+
+
+# Function to stop group commit, committing what is still queued
+def disable_group_commit():
+    with _writers_lock:
+        writers = list(_writers.values())
+        _writers.clear()
+    for writer in writers:
+        writer.close()
+
+
+# Function to return the writer for an account's database, or None when group commit is off
+def writer_for(acc_num):
+    if not _writers:
+        return None
+    router = connection_pool.get_router()
+    if router is not None:
+        return _writers.get(router.paths[router.shard_of(acc_num)])
+    return _writers.get(connection_pool.get_manager().path)
+
+
+# Function to run unit(conn) for an account and commit it
+# With group commit enabled the unit runs on the writer's connection as part of a batch;
+# otherwise it runs on conn, which is committed (or rolled back if the unit raises).
+# Returns the unit's result once it is committed.
+def commit_write(conn, acc_num, unit):
+    writer = writer_for(acc_num)
+    if writer is not None:
+        return writer.execute(unit)
+    try:
+        result = unit(conn)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return result
+
+
+# Function to report the counters of every writer, keyed by database path
+def writer_stats():
+    with _writers_lock:
+        return {path: writer.stats() for path, writer in _writers.items()}
@@ -0,0 +1,109 @@
+import datetime
+
+from archive import attach_partition, ledger_windows, window_select, window_tables
+from instrumentation import idle
+
+DEFAULT_PAGE_SIZE = 500
+HISTORY_HEADERS = ["Transaction ID", "Transaction Type", "Amount", "Timestamp"]
+
+
+# Function to turn a date/datetime into the text format SQLite uses for CURRENT_TIMESTAMP
+def format_timestamp(value):
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, datetime.datetime):
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    if isinstance(value, datetime.date):
+        return value.strftime("%Y-%m-%d")
+    raise TypeError(f"Unsupported date bound: {value!r}")
+
+
+# Function to find the (timestamp, transaction_id) key of one of an account's transactions
+# The hot table is checked first, then the archived months whose id range could hold it.
+def _transaction_key(conn, acc_num, transaction_id):
+    row = conn.execute("SELECT timestamp, transaction_id FROM transactions WHERE transaction_id=? AND acc_num=?", (transaction_id, acc_num)).fetchone()
+    if row is not None:
+        return row
+    for month, path in conn.execute("SELECT month, path FROM archive_partitions WHERE ? BETWEEN min_id AND max_id ORDER BY month_start", (transaction_id,)).fetchall():
+        schema = attach_partition(conn, month, path)
+        row = conn.execute(f"SELECT timestamp, transaction_id FROM {schema}.transactions WHERE transaction_id=? AND acc_num=?", (transaction_id, acc_num)).fetchone()
+        if row is not None:
+            return row
+    return None
+
+
+# Function to fetch history one page at a time using keyset pagination on (timestamp, transaction_id)
+# start is inclusive and end is exclusive; both accept 'YYYY-MM-DD[ HH:MM:SS]' strings or date objects.
+# Every page is its own short query, so no read transaction is held open between pages. Archived
+# months are read window by window (see archive.ledger_windows), attaching only the months that
+# overlap [start, end).
+def iter_history_pages(conn, acc_num, after_id=None, start=None, end=None, transaction_types=None, page_size=DEFAULT_PAGE_SIZE):
+    if page_size < 1:
+        raise ValueError("page_size must be at least 1")
+    cursor = conn.cursor()
+    start = format_timestamp(start)
+    end = format_timestamp(end)
+
+    last_key = None
+    if after_id is not None:
+        last_key = _transaction_key(conn, acc_num, after_id)
+        if last_key is None:
+            raise ValueError(f"Transaction {after_id} not found for account {acc_num}")
+
+    conditions = ["acc_num = ?"]
+    params = [acc_num]
+    if transaction_types:
+        transaction_types = list(transaction_types)
+        conditions.append(f"transaction_type IN ({','.join('?' * len(transaction_types))})")
+        params.extend(transaction_types)
+
+    page = []
+    for window in ledger_windows(conn, start, end):
+        if last_key is not None and window[3] is not None and window[3] <= last_key[0]:
+            continue
+        tables = window_tables(conn, window)
+        while True:
+            page_conditions = conditions
+            page_params = params
+            if last_key is not None:
+                page_conditions = conditions + ["(timestamp, transaction_id) > (?, ?)"]
+                page_params = params + list(last_key)
+            sql, sql_params = window_select(tables, "transaction_id, transaction_type, amount, timestamp", page_conditions, page_params, window[2], window[3])
+            wanted = page_size - len(page)
+            cursor.execute(sql + " ORDER BY timestamp, transaction_id LIMIT ?", sql_params + [wanted])
+            rows = cursor.fetchall()
+            if rows:
+                page.extend(rows)
+                last_key = (rows[-1][3], rows[-1][0])
+            if len(page) == page_size:
+                yield page
+                page = []
+            if len(rows) < wanted:
+                break
+    if page:
+        yield page
+
+
+# Function to stream history rows one at a time with the same filters as iter_history_pages
+def iter_transactions(conn, acc_num, **filters):
+    for page in iter_history_pages(conn, acc_num, **filters):
+        yield from page
+
+
+# Function to print history one page at a time, waiting for the user between pages
+def display_history_pages(conn, acc_num, page_size=20, **filters):
+    # Imported here because tabulate is slow to import and only interactive listings need it
+    from tabulate import tabulate
+
+    shown = 0
+    for page in iter_history_pages(conn, acc_num, page_size=page_size, **filters):
+        print(tabulate(page, headers=HISTORY_HEADERS, tablefmt="grid"))
+        shown += len(page)
+        if len(page) == page_size:
+            with idle():
+                choice = input("Press Enter for the next page or 'q' to stop: ").strip().lower()
+            if choice == 'q':
+                return shown
+    if shown == 0:
+        print("No transactions found.")
+    return shown
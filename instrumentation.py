@@ -0,0 +1,418 @@
+# SQL and operation-level instrumentation with metrics in Prometheus text format.
+# Enable it from the command line:
+#   python "Secure Financial Framework.py" --metrics bank.prom [--metrics-interval 15]
+#   python bank_server.py serve --metrics bank.prom
+# or in code with instrumentation.configure("bank.prom") before connections are opened.
+#
+# Every pooled connection gets a trace callback and a progress handler. The trace callback
+# counts each statement under its normalized text (literals replaced by ?) and starts its
+# clock; the statement is timed until the next statement on the same thread, the end of the
+# enclosing operation or a wait for input (see idle()), so the time includes fetching its
+# rows. Statements run outside an operation are counted but not timed, so time spent at a
+# prompt is never charged to them. The progress handler counts virtual machine steps per
+# statement, a measure of work that doesn't depend on timing. Sampled statements are checked
+# with EXPLAIN QUERY PLAN on a separate read-only connection by the exporter thread, off the
+# request path, to flag full table scans.
+import bisect
+import collections
+import contextlib
+import functools
+import os
+import re
+import sqlite3
+import threading
+import time
+import urllib.parse
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# The progress handler runs once per this many virtual machine instructions
+PROGRESS_STEPS = 10000
+# Every statement is explained the first time it is seen and then once per this many executions
+EXPLAIN_EVERY = 1000
+DEFAULT_INTERVAL = 15
+# Distinct statements tracked; any further ones are counted under "other"
+MAX_STATEMENTS = 1000
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b[0-9]+(?:\.[0-9]+)?\b")
+_IN_LISTS = re.compile(r"\bIN \(\?(?:, ?\?)+\)", re.IGNORECASE)
+_EXPLAINABLE = ("SELECT", "UPDATE", "DELETE", "INSERT", "REPLACE", "WITH")
+_DIGITS = b"0123456789"
+_clock = time.perf_counter
+_SHAPE_CACHE_SIZE = 4096
+
+
+# Function to reduce an expanded SQL statement to its shape: literals become ? and IN lists one ?
+def normalize_sql(sql):
+    sql = _LITERALS.sub("?", " ".join(sql.split()))
+    return _IN_LISTS.sub("IN (?)", sql)
+
+
+# Function to return the table a plan step scans without an index, or None
+# Matches 'SCAN accounts' as well as the older 'SCAN TABLE accounts'; scans through an index,
+# of a subquery and of a constant row are not table scans.
+def _scanned_table(detail):
+    if not detail.startswith("SCAN ") or " USING " in detail:
+        return None
+    words = detail.split()
+    name = words[2] if words[1] == "TABLE" and len(words) > 2 else words[1]
+    return None if name.startswith("(") or name == "CONSTANT" else name
+
+
+class _Histogram:
+    __slots__ = ("buckets", "count", "total")
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds):
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+
+class _StatementStats:
+    __slots__ = ("sql", "explainable", "count", "steps", "latency")
+
+    def __init__(self, sql):
+        self.sql = sql
+        self.explainable = sql.upper().startswith(_EXPLAINABLE)
+        self.count = 0
+        self.steps = 0
+        self.latency = _Histogram()
+
+
+class _ThreadState:
+    # Operation nesting depth, the open statement with its start time (None outside operations)
+    # and vm steps, and the time spent waiting on the user so far
+    __slots__ = ("depth", "statement", "start", "steps", "waited")
+
+    def __init__(self):
+        self.depth = 0
+        self.statement = None
+        self.start = None
+        self.steps = 0
+        self.waited = 0.0
+
+
+# Function to escape a Prometheus label value
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Metrics:
+    # Collects statement and operation metrics from every instrumented connection and thread
+    def __init__(self, output_path=None, interval=DEFAULT_INTERVAL, explain_every=EXPLAIN_EVERY):
+        self.output_path = output_path
+        self.interval = interval
+        self.explain_every = explain_every
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # normalized statement -> _StatementStats, and the same stats by statement shape
+        self._statements = {}
+        self._shapes = {}
+        # operation -> [histogram, errors]
+        self._operations = {}
+        # statement -> tables scanned without an index by its last sampled plan
+        self._scans = {}
+        self._plans_sampled = 0
+        # (database path, statement, expanded sql) waiting for EXPLAIN QUERY PLAN
+        self._to_explain = collections.deque(maxlen=100)
+        self._explain_conns = {}
+        self._explain_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._exporter = None
+
+    # Method to return the calling thread's state
+    def _state(self):
+        try:
+            return self._local.state
+        except AttributeError:
+            self._local.state = _ThreadState()
+            return self._local.state
+
+    # Method to hook a connection's trace callback and progress handler into these metrics
+    def instrument(self, conn):
+        path = None
+        for _, name, file in conn.execute("PRAGMA database_list"):
+            if name == "main" and file:
+                path = file
+        conn.set_trace_callback(functools.partial(self._trace, path))
+        conn.set_progress_handler(self._progress, PROGRESS_STEPS)
+        return conn
+
+    # Method to return the stats of an expanded statement
+    # Normalizing takes a regex pass, so it is done once per shape: the text with its digits
+    # dropped, which is far cheaper to compute. Statements that differ only in their digits
+    # (the same query on two archived months, say) are counted together.
+    def _statement(self, sql):
+        shape = sql.encode().translate(None, _DIGITS)
+        stats = self._shapes.get(shape)
+        if stats is None:
+            key = normalize_sql(sql)
+            with self._lock:
+                stats = self._statements.get(key)
+                if stats is None:
+                    if len(self._statements) >= MAX_STATEMENTS:
+                        key = "other"
+                    stats = self._statements.setdefault(key, _StatementStats(key))
+            if len(self._shapes) >= _SHAPE_CACHE_SIZE:
+                self._shapes.clear()
+            self._shapes[shape] = stats
+        return stats
+
+    # Method to record the open statement of a thread as finished at `now`; call with the lock held
+    def _close_statement(self, state, now):
+        statement = state.statement
+        statement.steps += state.steps
+        if state.start is not None:
+            statement.latency.observe(now - state.start)
+        state.statement = None
+
+    # Method called by SQLite as each statement starts
+    def _trace(self, path, sql):
+        now = _clock()
+        try:
+            state = self._local.state
+        except AttributeError:
+            state = self._state()
+        statement = self._shapes.get(sql.encode().translate(None, _DIGITS)) or self._statement(sql)
+        with self._lock:
+            if state.statement is not None:
+                self._close_statement(state, now)
+            statement.count += 1
+            count = statement.count
+        if statement.explainable and path is not None and (count % self.explain_every == 1 or self.explain_every == 1):
+            self._to_explain.append((path, statement.sql, sql))
+        state.statement = statement
+        state.start = now if state.depth else None
+        state.steps = 0
+
+    # Method called by SQLite every PROGRESS_STEPS instructions; returning 0 lets the statement go on
+    def _progress(self):
+        self._local.state.steps += PROGRESS_STEPS
+        return 0
+
+    # Method to wrap a wait on the user: the open statement is closed first and the time spent
+    # waiting is left out of the enclosing operations
+    @contextlib.contextmanager
+    def idle(self):
+        state = self._state()
+        start = time.perf_counter()
+        if state.statement is not None:
+            with self._lock:
+                self._close_statement(state, start)
+        try:
+            yield
+        finally:
+            state.waited += time.perf_counter() - start
+
+    # Method to time a high-level operation; statements it runs are timed too
+    # Nested operations are each timed. An exception counts as an error of the operation.
+    @contextlib.contextmanager
+    def operation(self, name):
+        state = self._state()
+        start = time.perf_counter()
+        if state.statement is not None:
+            with self._lock:
+                self._close_statement(state, start)
+        state.depth += 1
+        waited = state.waited
+        failed = False
+        try:
+            yield
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            now = time.perf_counter()
+            state.depth -= 1
+            with self._lock:
+                if state.statement is not None:
+                    self._close_statement(state, now)
+                entry = self._operations.get(name)
+                if entry is None:
+                    entry = self._operations[name] = [_Histogram(), 0]
+                entry[0].observe(now - start - (state.waited - waited))
+                if failed:
+                    entry[1] += 1
+
+    # Method to run EXPLAIN QUERY PLAN on the sampled statements and record their table scans
+    def explain_pending(self):
+        with self._explain_lock:
+            while self._to_explain:
+                path, key, sql = self._to_explain.popleft()
+                conn = self._explain_conns.get(path)
+                try:
+                    if conn is None:
+                        conn = sqlite3.connect(f"file:{urllib.parse.quote(path)}?mode=ro", uri=True, check_same_thread=False)
+                        self._explain_conns[path] = conn
+                    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+                    plan = conn.execute("EXPLAIN QUERY PLAN " + sql).fetchall()
+                except sqlite3.Error:
+                    # Statements on attached archives or temporary tables can't be explained here
+                    continue
+                scanned = sorted({table for table in map(_scanned_table, (row[3] for row in plan)) if table in tables})
+                with self._lock:
+                    self._plans_sampled += 1
+                    if scanned:
+                        self._scans[key] = scanned
+                    else:
+                        self._scans.pop(key, None)
+
+    # Method to return {statement: [tables scanned without an index]} from the sampled plans
+    def full_scans(self):
+        with self._lock:
+            return {key: list(tables) for key, tables in self._scans.items()}
+
+    # Method to return {statement: executions}, most frequent first
+    def statement_counts(self):
+        with self._lock:
+            counts = {key: stats.count for key, stats in self._statements.items()}
+        return dict(sorted(counts.items(), key=lambda item: -item[1]))
+
+    # Method to render every metric in the Prometheus text exposition format
+    def render(self):
+        lines = []
+
+        def histogram(metric, help_text, label, series):
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} histogram")
+            for value, hist in series:
+                label_text = f'{label}="{_label(value)}"'
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, hist.buckets):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{{{label_text},le="{bound}"}} {cumulative}')
+                lines.append(f'{metric}_bucket{{{label_text},le="+Inf"}} {hist.count}')
+                lines.append(f"{metric}_sum{{{label_text}}} {hist.total:.6f}")
+                lines.append(f"{metric}_count{{{label_text}}} {hist.count}")
+
+        with self._lock:
+            operations = sorted(self._operations.items())
+            statements = sorted(self._statements.items())
+            scans = sorted(self._scans.items())
+            plans_sampled = self._plans_sampled
+            histogram("bank_operation_duration_seconds", "Time taken by high-level banking operations.",
+                      "operation", [(name, entry[0]) for name, entry in operations])
+            lines.append("# HELP bank_operation_errors_total Operations that ended with an exception.")
+            lines.append("# TYPE bank_operation_errors_total counter")
+            for name, entry in operations:
+                lines.append(f'bank_operation_errors_total{{operation="{_label(name)}"}} {entry[1]}')
+            lines.append("# HELP sqlite_statements_total Statements executed, by normalized SQL.")
+            lines.append("# TYPE sqlite_statements_total counter")
+            for key, stats in statements:
+                lines.append(f'sqlite_statements_total{{statement="{_label(key)}"}} {stats.count}')
+            lines.append(f"# HELP sqlite_statement_vm_steps_total Virtual machine steps, counted in units of {PROGRESS_STEPS}.")
+            lines.append("# TYPE sqlite_statement_vm_steps_total counter")
+            for key, stats in statements:
+                lines.append(f'sqlite_statement_vm_steps_total{{statement="{_label(key)}"}} {stats.steps}')
+            histogram("sqlite_statement_duration_seconds", "Time taken by statements run inside an operation.",
+                      "statement", [(key, stats.latency) for key, stats in statements if stats.latency.count])
+        lines.append("# HELP sqlite_statement_full_scan Tables the statement's sampled query plan scans without an index.")
+        lines.append("# TYPE sqlite_statement_full_scan gauge")
+        for key, tables in scans:
+            for table in tables:
+                lines.append(f'sqlite_statement_full_scan{{statement="{_label(key)}",table="{_label(table)}"}} 1')
+        lines.append("# HELP sqlite_query_plans_sampled_total Statements checked with EXPLAIN QUERY PLAN.")
+        lines.append("# TYPE sqlite_query_plans_sampled_total counter")
+        lines.append(f"sqlite_query_plans_sampled_total {plans_sampled}")
+        return "\n".join(lines) + "\n"
+
+    # Method to explain sampled statements and write the metrics file
+    # The file is replaced atomically, as the node_exporter textfile collector expects.
+    def write(self, path=None):
+        path = path or self.output_path
+        self.explain_pending()
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as file:
+            file.write(self.render())
+        os.replace(temp_path, path)
+        return path
+
+    # Method to start a background thread writing the metrics file every `interval` seconds
+    def start_exporter(self):
+        if self._exporter is None and self.output_path:
+            self._stop.clear()
+            self._exporter = threading.Thread(target=self._export_loop, name="metrics-exporter", daemon=True)
+            self._exporter.start()
+
+    def _export_loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except OSError:
+                pass
+
+    # Method to stop the exporter, write the metrics one last time and close the explain connections
+    def close(self):
+        if self._exporter is not None:
+            self._stop.set()
+            self._exporter.join()
+            self._exporter = None
+        if self.output_path:
+            self.write()
+        with self._explain_lock:
+            for conn in self._explain_conns.values():
+                conn.close()
+            self._explain_conns.clear()
+
+
+_metrics = None
+_null_context = contextlib.nullcontext()
+
+
+# Function to turn instrumentation on for connections opened from now on, returning the Metrics
+# With an output path the metrics are written there every `interval` seconds and on shutdown().
+def configure(output_path=None, interval=DEFAULT_INTERVAL, explain_every=EXPLAIN_EVERY):
+    global _metrics
+    if _metrics is not None:
+        _metrics.close()
+    _metrics = Metrics(output_path, interval, explain_every)
+    _metrics.start_exporter()
+    return _metrics
+
+
+# Function to return the active Metrics, or None when instrumentation is off
+def get_metrics():
+    return _metrics
+
+
+# Function to instrument a connection if instrumentation is on; returns the connection
+def instrument(conn):
+    if _metrics is not None:
+        _metrics.instrument(conn)
+    return conn
+
+
+# Function to time a block as the named operation (a no-op when instrumentation is off)
+def operation(name):
+    return _metrics.operation(name) if _metrics is not None else _null_context
+
+
+# Decorator to time every call of a function as the named operation
+def timed(name):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _metrics is None:
+                return func(*args, **kwargs)
+            with _metrics.operation(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# Function to wrap a wait on the user, so it is charged to no statement or operation
+def idle():
+    return _metrics.idle() if _metrics is not None else _null_context
+
+
+# Function to write the metrics one last time and turn instrumentation off
+def shutdown():
+    global _metrics
+    if _metrics is not None:
+        _metrics.close()
+        _metrics = None
@@ -0,0 +1,342 @@
+# Bulk import / replay of external transaction logs into the ledger.
+# Run from the repository root:  python ledger_import.py [--db bank.db] LOG_FILE [--source NAME] [--chunk-size N] [--rejects rejects.csv] [--offline]
+#
+# The log is CSV (with a header row) or JSON Lines, one transaction per row/line with the fields
+# acc_num, transaction_type, amount and optionally timestamp (ISO 8601 such as
+# 'YYYY-MM-DD HH:MM:SS', UTC unless it carries an offset; defaults to now).
+# Amounts are signed the way the transactions table stores them: deposits positive, withdrawals
+# negative, and transfers negative on the sending side and positive on the receiving side. The
+# log is treated as authoritative, so balances are not checked for overdrafts. Timestamps must
+# not go backwards, neither within the log nor behind the newest row already in the ledger, as
+# the balance checkpoints, archives and daily aggregates rely on transaction_id order matching
+# timestamp order; rows that break this are rejected.
+import argparse
+import calendar
+import csv
+import datetime
+import json
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+from account_repository import invalidate_accounts
+from aggregates import advance_aggregates
+from checkpoints import rebuild_checkpoints
+from schema import initialize_database
+from sharding import is_sharded
+
+DEFAULT_CHUNK_SIZE = 50000
+
+_TYPE_CODES = {"deposit": 1, "withdrawal": 2, "transfer": 3}
+_DEPOSIT, _WITHDRAWAL, _TRANSFER = 1, 2, 3
+# Timestamp of the record yielded for a JSONL line that isn't a JSON object
+_MALFORMED = object()
+
+
+# Function to stream (acc_num, transaction_type, amount, timestamp) tuples from a CSV or JSONL log
+# Values are returned as read; conversion and validation happen per batch. A JSONL line that
+# isn't a JSON object still takes its row number: it is yielded with the line's text as its
+# transaction_type and rejected by validate_batch, so one bad line can't stop the import.
+def iter_log(path):
+    with open(path, newline="") as file:
+        if path.lower().endswith((".jsonl", ".ndjson")):
+            for line in file:
+                if line.strip():
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        record = None
+                    if not isinstance(record, dict):
+                        yield None, line.strip(), None, _MALFORMED
+                        continue
+                    yield record.get("acc_num"), record.get("transaction_type"), record.get("amount"), record.get("timestamp")
+        else:
+            for record in csv.DictReader(file):
+                yield record.get("acc_num"), record.get("transaction_type"), record.get("amount"), record.get("timestamp") or None
+
+
+# Function to convert a value to int, returning None if it isn't a whole number
+def _to_int(value):
+    if isinstance(value, bool):
+        return None
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        return None
+    return number if not isinstance(value, float) or value == number else None
+
+
+# Function to convert a log timestamp to whole seconds since the epoch (UTC)
+# Returns None if it isn't an ISO 8601 date or date and time.
+def _to_seconds(value):
+    if not isinstance(value, str):
+        return None
+    try:
+        moment = datetime.datetime.fromisoformat(value.strip())
+    except ValueError:
+        return None
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(datetime.timezone.utc)
+    return calendar.timegm(moment.timetuple())
+
+
+# Function to format seconds since the epoch the way the ledger stores timestamps
+def _format_seconds(seconds):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(seconds))
+
+
+# Function to return the time, in seconds since the epoch, that imported rows must not precede:
+# the newest ledger row's timestamp, or the end of the newest archived month
+def ledger_horizon(conn):
+    newest = conn.execute("SELECT timestamp FROM transactions ORDER BY transaction_id DESC LIMIT 1").fetchone()
+    archived = conn.execute("SELECT MAX(month_end) FROM archive_partitions").fetchone()
+    bounds = [_to_seconds(value) for value in (newest[0] if newest else None, archived[0])]
+    return max((bound for bound in bounds if bound is not None), default=0)
+
+
+# Function to validate one batch of log rows with array operations
+# since is the time (seconds since the epoch) no accepted row may precede and now the time rows
+# without a timestamp get; rows timestamped after now are rejected.
+# Returns (rows, rejects, accs, kinds, amounts, newest); rows are (acc_num, transaction_type, amount, timestamp) and
+# rejects are (row_number, acc_num, transaction_type, amount, reason). The arrays hold the valid
+# rows' account numbers, type codes and amounts for aggregate_effects, and newest is the time
+# the next batch's rows must not precede.
+def validate_batch(batch, first_row, known_accounts, since=0, now=None):
+    now = int(time.time()) if now is None else now
+    count = len(batch)
+    accs = np.zeros(count, dtype=np.int64)
+    amounts = np.zeros(count, dtype=np.int64)
+    kinds = np.zeros(count, dtype=np.int8)
+    stamps = np.full(count, now, dtype=np.int64)
+    parsed = np.ones(count, dtype=bool)
+    malformed = np.zeros(count, dtype=bool)
+    dated = np.ones(count, dtype=bool)
+    for i, (acc_num, transaction_type, amount, timestamp) in enumerate(batch):
+        if timestamp is _MALFORMED:
+            malformed[i] = True
+            parsed[i] = False
+            continue
+        acc_num = _to_int(acc_num)
+        amount = _to_int(amount)
+        if acc_num is None or amount is None:
+            parsed[i] = False
+            continue
+        accs[i] = acc_num
+        amounts[i] = amount
+        kinds[i] = _TYPE_CODES.get(transaction_type, 0)
+        if timestamp is not None:
+            seconds = _to_seconds(timestamp)
+            if seconds is None:
+                dated[i] = False
+            else:
+                stamps[i] = seconds
+
+    # Each check only applies to rows that passed the earlier ones, so a row gets one reason
+    reasons = np.full(count, None, dtype=object)
+    pending = parsed.copy()
+    reasons[~parsed] = "Invalid amount or account number"
+    reasons[malformed] = "Not a JSON object"
+    for failed, reason in ((kinds == 0, "Unknown transaction type"),
+                           (~np.isin(accs, known_accounts), "Account not found"),
+                           ((amounts == 0) | ((kinds == _DEPOSIT) & (amounts < 0)) | ((kinds == _WITHDRAWAL) & (amounts > 0)), "Invalid amount"),
+                           (~dated, "Invalid timestamp"),
+                           (stamps > now, "Timestamp in the future")):
+        failed &= pending
+        reasons[failed] = reason
+        pending &= ~failed
+
+    # A row is out of order when it precedes the newest row accepted before it. A rejected row is
+    # older than that newest row, so taking it into the running maximum changes nothing.
+    candidates = np.flatnonzero(pending)
+    newest = np.maximum.accumulate(np.concatenate(([since], stamps[candidates])))
+    out_of_order = np.zeros(count, dtype=bool)
+    out_of_order[candidates] = stamps[candidates] < newest[:-1]
+    reasons[out_of_order] = "Timestamp out of order"
+    pending &= ~out_of_order
+
+    valid = pending
+    rows = [(int(accs[i]), batch[i][1], int(amounts[i]), _format_seconds(int(stamps[i]))) for i in np.flatnonzero(valid).tolist()]
+    rejects = [(first_row + i, batch[i][0], batch[i][1], batch[i][2], reasons[i]) for i in np.flatnonzero(~valid).tolist()]
+    return rows, rejects, accs[valid], kinds[valid], amounts[valid], int(newest[-1])
+
+
+# Function to sum a batch's balance effects per account
+# Returns rows of (total_amount, total_dep, total_wit, total_tra, acc_num) deltas for executemany.
+def aggregate_effects(accs, kinds, amounts):
+    if len(accs) == 0:
+        return []
+    unique_accs, inverse = np.unique(accs, return_inverse=True)
+    deltas = np.zeros((len(unique_accs), 4), dtype=np.int64)
+    np.add.at(deltas[:, 0], inverse, amounts)
+    np.add.at(deltas[:, 1], inverse, np.where(kinds == _DEPOSIT, amounts, 0))
+    np.add.at(deltas[:, 2], inverse, np.where(kinds == _WITHDRAWAL, -amounts, 0))
+    np.add.at(deltas[:, 3], inverse, np.where((kinds == _TRANSFER) & (amounts < 0), -amounts, 0))
+    return [tuple(row) + (acc_num,) for row, acc_num in zip(deltas.tolist(), unique_accs.tolist())]
+
+
+# Function to drop the secondary indexes of the transactions table, returning their CREATE statements
+def _drop_transaction_indexes(conn):
+    indexes = conn.execute("SELECT name, sql FROM sqlite_master WHERE type='index' AND tbl_name='transactions' AND sql IS NOT NULL").fetchall()
+    for name, _ in indexes:
+        conn.execute(f"DROP INDEX {name}")
+    conn.commit()
+    return [sql for _, sql in indexes]
+
+
+# Function to apply one validated chunk and record progress, all in one transaction
+def _apply_chunk(conn, source, rows_done, rows, effects, imported, rejected):
+    cursor = conn.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        cursor.executemany("INSERT INTO transactions (acc_num, transaction_type, amount, timestamp) VALUES (?, ?, ?, ?)", rows)
+        cursor.executemany("UPDATE accounts SET total_amount = total_amount + ?, total_dep = total_dep + ?, total_wit = total_wit + ?, total_tra = total_tra + ? WHERE acc_num = ?",
+                           effects)
+        advance_aggregates(conn)
+        cursor.execute("UPDATE import_progress SET rows_done=?, rows_imported=?, rows_rejected=?, updated_at=CURRENT_TIMESTAMP WHERE source=?",
+                       (rows_done, imported, rejected, source))
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    finally:
+        invalidate_accounts(conn, *(effect[4] for effect in effects))
+
+
+# Function to open the rejects file of an import, keeping the rejects of rows up to resume_from
+# Rejects are written before their chunk commits, so a crash can leave rejects of rows that are
+# read again on resume; those are dropped here and written anew.
+def _open_rejects(path, resume_from):
+    kept = []
+    if resume_from and os.path.exists(path):
+        with open(path, newline="") as file:
+            kept = [row for row in csv.reader(file) if row and row[0].isdigit() and int(row[0]) <= resume_from]
+    file = open(path, "w", newline="")
+    writer = csv.writer(file)
+    writer.writerow(["row", "acc_num", "transaction_type", "amount", "reason"])
+    writer.writerows(kept)
+    return file
+
+
+# Function to append rejects to the rejects file and make them durable
+def _write_rejects(file, rejects):
+    csv.writer(file).writerows(rejects)
+    file.flush()
+    os.fsync(file.fileno())
+
+
+# Function to import a transaction log, committing once per chunk
+# Progress is stored in import_progress under `source` (the log's absolute path by default) in
+# the same transaction as each chunk, so rerunning after a crash skips the rows already applied.
+# A chunk's rejects are written to rejects_path (as CSV, if given) and synced before the chunk
+# commits, so no committed chunk's rejects can be lost.
+# defer_indexes drops the transactions indexes for the load and rebuilds them at the end
+# (initialize_database recreates them if the process dies first). Only use it offline: while
+# the indexes are gone, every other reader of the database falls back to full scans. The daily
+# aggregates are advanced with each chunk; balance checkpoints of the touched accounts are
+# rebuilt once the load finishes. Not available on a sharded database.
+# Returns a report dict.
+def import_log(conn, path, source=None, chunk_size=DEFAULT_CHUNK_SIZE, defer_indexes=False, rejects_path=None):
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be at least 1")
+    # Progress and timestamp order are tracked per database file, and the catalog holds no accounts
+    if is_sharded(conn):
+        raise ValueError("Logs can't be imported into a sharded database")
+    source = source or os.path.abspath(path)
+    conn.execute("INSERT OR IGNORE INTO import_progress (source, rows_done, rows_imported, rows_rejected, status) VALUES (?, 0, 0, 0, 'running')", (source,))
+    conn.commit()
+    resume_from, imported, rejected, status = conn.execute("SELECT rows_done, rows_imported, rows_rejected, status FROM import_progress WHERE source=?", (source,)).fetchone()
+    report = {"source": source, "status": status, "resumed_from": resume_from, "rows_read": 0, "imported": imported, "rejected": rejected, "seconds": 0.0, "rows_per_sec": 0.0}
+    if status == "done":
+        return report
+
+    known_accounts = np.fromiter((row[0] for row in conn.execute("SELECT acc_num FROM accounts")), dtype=np.int64)
+    known_accounts.sort()
+    index_sql = _drop_transaction_indexes(conn) if defer_indexes else []
+    touched = set()
+    rejects_file = _open_rejects(rejects_path, resume_from) if rejects_path else None
+    since = 0
+
+    start = time.perf_counter()
+    try:
+        batch = []
+        rows_done = 0
+        for record in iter_log(path):
+            rows_done += 1
+            if rows_done <= resume_from:
+                # Already applied before the crash; still note the account for the checkpoint rebuild
+                acc_num = _to_int(record[0])
+                if acc_num is not None:
+                    touched.add(acc_num)
+                continue
+            batch.append(record)
+            if len(batch) == chunk_size:
+                imported, rejected, since = _import_batch(conn, source, batch, rows_done, known_accounts, touched, imported, rejected, since, rejects_file)
+                report["rows_read"] += len(batch)
+                batch = []
+        if batch:
+            imported, rejected, since = _import_batch(conn, source, batch, rows_done, known_accounts, touched, imported, rejected, since, rejects_file)
+            report["rows_read"] += len(batch)
+    finally:
+        if rejects_file:
+            rejects_file.close()
+        for sql in index_sql:
+            conn.execute(sql.replace("CREATE INDEX", "CREATE INDEX IF NOT EXISTS", 1))
+        conn.commit()
+
+    rebuild_checkpoints(conn, sorted(touched))
+    conn.execute("UPDATE import_progress SET status='done', updated_at=CURRENT_TIMESTAMP WHERE source=?", (source,))
+    conn.commit()
+    report["seconds"] = time.perf_counter() - start
+    report["imported"] = imported
+    report["rejected"] = rejected
+    report["rows_per_sec"] = report["rows_read"] / report["seconds"] if report["seconds"] else 0.0
+    report["status"] = "done"
+    return report
+
+
+# Function to validate, aggregate and apply one batch
+# since is the newest timestamp accepted so far; rows must not precede it, nor anything posted
+# to the ledger meanwhile. Returns the updated (imported, rejected, since).
+def _import_batch(conn, source, batch, rows_done, known_accounts, touched, imported, rejected, since, rejects_file):
+    first_row = rows_done - len(batch) + 1
+    since = max(since, ledger_horizon(conn))
+    rows, rejects, accs, kinds, amounts, since = validate_batch(batch, first_row, known_accounts, since)
+    effects = aggregate_effects(accs, kinds, amounts)
+    imported += len(rows)
+    rejected += len(rejects)
+    if rejects_file:
+        _write_rejects(rejects_file, rejects)
+    _apply_chunk(conn, source, rows_done, rows, effects, imported, rejected)
+    touched.update(effect[4] for effect in effects)
+    return imported, rejected, since
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk import a CSV or JSONL transaction log into the ledger")
+    parser.add_argument("--db", default="bank.db")
+    parser.add_argument("log")
+    parser.add_argument("--source", help="name to track progress under (default: the log's absolute path)")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--offline", action="store_true", help="drop the transactions indexes for the load and rebuild them at the end; only when nothing else is using the database")
+    parser.add_argument("--rejects", help="write rejected rows to this CSV file")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    try:
+        initialize_database(conn)
+        report = import_log(conn, args.log, args.source, args.chunk_size, args.offline, args.rejects)
+    finally:
+        conn.close()
+    if report["rows_read"] == 0 and report["status"] == "done":
+        print(f"{report['source']} was already imported ({report['imported']} transactions).")
+        return
+    if report["resumed_from"]:
+        print(f"Resumed after row {report['resumed_from']}.")
+    print(f"Read {report['rows_read']} rows in {report['seconds']:.2f}s ({report['rows_per_sec']:,.0f} rows/sec).")
+    print(f"Imported {report['imported']} transactions, rejected {report['rejected']}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,570 @@
+# In-memory velocity limits: failed logins per window and money spent per window, per account.
+# Run from the repository root:  python limiter.py [--db bank.db] show [--acc-num N]
+#
+# Every check and every update costs the same whatever the traffic:
+# - Failed logins are kept in a ring buffer of the last login_failures failure times. An account
+#   is throttled while the oldest of them is less than login_window seconds old, which is one
+#   comparison. Throttled attempts are turned away before the password is hashed or anything is
+#   written.
+# - Withdrawals and transfers out are summed in a ring of spend_slots time slots covering
+#   spend_window. A payment is refused when it would take the sum past spend_limit. The sum may
+#   include up to one slot more than the window, so the cap is never exceeded.
+#
+# The consecutive failure counters behind the MAX_ATTEMPTS lockout are kept here too while the
+# limiter is enabled: record_failed_attempt and reset_failed_attempts change them in memory and
+# get_account overlays the unwritten values, so lockout decisions see them at once. A flusher
+# thread writes the changed counters and the changed limiter state to SQLite every
+# flush_interval seconds in one transaction per database file. A burst of bad logins therefore
+# costs one commit per interval instead of one per attempt. The limiter state (limiter_state in
+# the pooled database) is loaded back when the limiter is enabled again, so a restart doesn't
+# reset the windows. A crash can lose the last interval of counter changes.
+import argparse
+import json
+import sqlite3
+import threading
+import time
+
+import connection_pool
+from instrumentation import instrument
+
+DEFAULT_LOGIN_FAILURES = 5
+DEFAULT_LOGIN_WINDOW = 300.0
+DEFAULT_SPEND_WINDOW = 86400.0
+DEFAULT_SPEND_SLOTS = 96
+DEFAULT_FLUSH_INTERVAL = 1.0
+DEFAULT_PROFILE = "wal"
+
+# limiter_state.kind of each window
+LOGIN = "login"
+SPEND = "spend"
+
+# Ticket handed out when no spending limit applies; releasing it does nothing
+UNLIMITED = (None, 0)
+
+
+class FailureWindow:
+    # Ring buffer of the times of the last `limit` failures, oldest at `head` once full
+    def __init__(self, limit):
+        self.times = [0.0] * limit
+        self.head = 0
+        self.count = 0
+
+    # Method to record a failure at `now`, overwriting the oldest once the ring is full
+    def record(self, now):
+        self.times[self.head] = now
+        self.head = (self.head + 1) % len(self.times)
+        self.count = min(self.count + 1, len(self.times))
+
+    # Method to return the time the throttle lifts, or 0.0 while the ring isn't full
+    def blocked_until(self, window):
+        if self.count < len(self.times):
+            return 0.0
+        return self.times[self.head] + window
+
+    # Method to tell whether every recorded failure is older than the window
+    def expired(self, window, now):
+        return self.count == 0 or self.times[(self.head - 1) % len(self.times)] + window <= now
+
+    # Method to return the recorded failure times, oldest first
+    def to_state(self):
+        size = len(self.times)
+        return [self.times[(self.head - self.count + n) % size] for n in range(self.count)]
+
+    # Method to build a ring from saved failure times, keeping the newest `limit` of them
+    @classmethod
+    def from_state(cls, limit, times):
+        ring = cls(limit)
+        for moment in times[-limit:]:
+            ring.record(moment)
+        return ring
+
+
+class SpendWindow:
+    # Ring of per-slot sums covering the window; `epoch` numbers the slot `now` falls in
+    def __init__(self, window, slots):
+        self.width = window / slots
+        self.sums = [0] * slots
+        self.epoch = None
+        self.total = 0
+
+    # Method to move the ring up to `now`, clearing the slots that fell out of the window
+    # At most one pass over the slots, however long it has been since the last call.
+    def advance(self, now):
+        epoch = int(now // self.width)
+        if self.epoch is None or epoch - self.epoch >= len(self.sums):
+            self.sums = [0] * len(self.sums)
+            self.total = 0
+        else:
+            for stale in range(self.epoch + 1, epoch + 1):
+                self.total -= self.sums[stale % len(self.sums)]
+                self.sums[stale % len(self.sums)] = 0
+        if self.epoch is None or epoch > self.epoch:
+            self.epoch = epoch
+
+    # Method to add amount to the slot of `now` if the window's total stays within limit
+    # Returns a ticket for release(), or None if the payment would exceed the limit.
+    def reserve(self, amount, limit, now):
+        self.advance(now)
+        if self.total + amount > limit:
+            return None
+        self.sums[self.epoch % len(self.sums)] += amount
+        self.total += amount
+        return (self.epoch, amount)
+
+    # Method to take back a reservation whose payment didn't go through
+    def release(self, ticket):
+        epoch, amount = ticket
+        if self.epoch - len(self.sums) < epoch <= self.epoch:
+            self.sums[epoch % len(self.sums)] -= amount
+            self.total -= amount
+
+    # Method to return the non-empty slots as [slot middle time, sum] pairs
+    # The middle, so the time falls in the same slot when it is read back.
+    def to_state(self):
+        if self.epoch is None:
+            return []
+        size = len(self.sums)
+        return [[(epoch + 0.5) * self.width, self.sums[epoch % size]] for epoch in range(self.epoch - size + 1, self.epoch + 1) if self.sums[epoch % size]]
+
+    # Method to build a ring from saved slots, dropping those older than the window
+    @classmethod
+    def from_state(cls, window, slots, saved, now):
+        ring = cls(window, slots)
+        ring.advance(now)
+        for moment, amount in saved:
+            epoch = int(moment // ring.width)
+            if ring.epoch - slots < epoch <= ring.epoch:
+                ring.sums[epoch % slots] += amount
+                ring.total += amount
+        return ring
+
+
+class Limiter:
+    # Per-account failed-login and spending windows, plus the unwritten failure counters
+    # path is the database holding limiter_state; counters go to the file holding the account.
+    def __init__(self, path=connection_pool.DEFAULT_DATABASE, login_failures=DEFAULT_LOGIN_FAILURES, login_window=DEFAULT_LOGIN_WINDOW,
+                 spend_limit=None, spend_window=DEFAULT_SPEND_WINDOW, spend_slots=DEFAULT_SPEND_SLOTS,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL, profile=DEFAULT_PROFILE):
+        if login_failures < 1:
+            raise ValueError("login_failures must be at least 1")
+        if spend_slots < 1:
+            raise ValueError("spend_slots must be at least 1")
+        if login_window <= 0 or spend_window <= 0:
+            raise ValueError("windows must be longer than zero seconds")
+        self.path = path
+        self.login_failures = login_failures
+        self.login_window = login_window
+        self.spend_limit = spend_limit
+        self.spend_window = spend_window
+        self.spend_slots = spend_slots
+        self.flush_interval = flush_interval
+        self.profile = profile
+        self._failures = {}
+        self._spending = {}
+        # (acc_num, kind) pairs whose window changed since the last flush
+        self._dirty = set()
+        # Counter values not yet committed: (acc_num, column) -> value. Values being written and
+        # values written by the previous flush are still overlaid, since a reader may have
+        # fetched its row just before that commit.
+        self._counters = {}
+        self._flushing = {}
+        self._flushed = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._connections = {}
+        self._stop = threading.Event()
+        self._thread = None
+        self.throttled = 0
+        self.refused = 0
+        self.flushes = 0
+        self.rows_flushed = 0
+
+    # Method to return how many seconds an account must wait before its next login attempt
+    def login_retry_after(self, acc_num, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            ring = self._failures.get(acc_num)
+            wait = ring.blocked_until(self.login_window) - now if ring is not None else 0.0
+            if wait > 0:
+                self.throttled += 1
+                return wait
+        return 0.0
+
+    # Method to count a failed password or 2FA attempt; current is the counter's value so far
+    # Returns the new number of consecutive failures.
+    def record_failure(self, acc_num, column, current, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            ring = self._failures.get(acc_num)
+            if ring is None:
+                ring = self._failures[acc_num] = FailureWindow(self.login_failures)
+            ring.record(now)
+            self._dirty.add((acc_num, LOGIN))
+            # Counted from the newest unwritten value, as current may have been read before a
+            # concurrent failure of the same account was counted
+            key = (acc_num, column)
+            count = max(current, self._counters.get(key, self._flushing.get(key, self._flushed.get(key, current)))) + 1
+            self._counters[key] = count
+        return count
+
+    # Method to clear a consecutive failure counter after a successful attempt
+    # The failure window is left alone: it only empties with time.
+    def record_success(self, acc_num, column):
+        with self._lock:
+            self._counters[(acc_num, column)] = 0
+
+    # Method to apply the unwritten counter values of an account to its accounts row
+    def overlay(self, row):
+        acc_num = row[1]
+        with self._lock:
+            if not (self._counters or self._flushing or self._flushed):
+                return row
+            values = {}
+            for pending in (self._flushed, self._flushing, self._counters):
+                for column in _COUNTER_INDEX:
+                    value = pending.get((acc_num, column))
+                    if value is not None:
+                        values[column] = value
+        if not values:
+            return row
+        row = list(row)
+        for column, value in values.items():
+            row[_COUNTER_INDEX[column]] = value
+        return tuple(row)
+
+    # Method to count amount against the account's spending window
+    # Returns (ticket, None), or (None, message) if the payment would exceed the limit.
+    def reserve(self, acc_num, amount, now=None):
+        if self.spend_limit is None or not isinstance(amount, (int, float)) or amount <= 0:
+            # Nothing to count; the posting path rejects amounts that aren't positive numbers
+            return UNLIMITED, None
+        now = time.time() if now is None else now
+        with self._lock:
+            ring = self._spending.get(acc_num)
+            if ring is None:
+                ring = self._spending[acc_num] = SpendWindow(self.spend_window, self.spend_slots)
+            ticket = ring.reserve(amount, self.spend_limit, now)
+            if ticket is None:
+                self.refused += 1
+                left = max(0, self.spend_limit - ring.total)
+                return None, f"Spending limit reached: {left} of {self.spend_limit} left in the current window."
+            self._dirty.add((acc_num, SPEND))
+        return ticket, None
+
+    # Method to give back a reservation whose payment was rejected
+    def release(self, acc_num, ticket):
+        if ticket is UNLIMITED or ticket is None:
+            return
+        with self._lock:
+            ring = self._spending.get(acc_num)
+            if ring is not None:
+                ring.release(ticket)
+                self._dirty.add((acc_num, SPEND))
+
+    # Method to drop everything held for an account, e.g. once an admin has unlocked it
+    # Waits for a flush in progress, so it can't write old counters over the admin's reset.
+    def forget(self, acc_num):
+        with self._flush_lock, self._lock:
+            self._failures.pop(acc_num, None)
+            self._spending.pop(acc_num, None)
+            for pending in (self._counters, self._flushing, self._flushed):
+                for column in _COUNTER_INDEX:
+                    pending.pop((acc_num, column), None)
+            self._dirty.update(((acc_num, LOGIN), (acc_num, SPEND)))
+
+    # Method to drop every account's windows and counters (tables cleared or dropped)
+    def reset(self):
+        with self._flush_lock, self._lock:
+            self._failures.clear()
+            self._spending.clear()
+            self._dirty.clear()
+            self._counters.clear()
+            self._flushing.clear()
+            self._flushed.clear()
+
+    # Method to return the flusher's connection to a database file, opening it on first use
+    def _connection(self, path):
+        conn = self._connections.get(path)
+        if conn is None:
+            conn = sqlite3.connect(path, check_same_thread=False)
+            connection_pool.apply_profile(conn, self.profile)
+            self._connections[path] = instrument(conn)
+        return conn
+
+    # Method to return the database file holding an account's row
+    def _account_path(self, acc_num):
+        router = connection_pool.get_router()
+        return router.paths[router.shard_of(acc_num)] if router is not None else self.path
+
+    # Method to write the changed counters and windows, one transaction per database file
+    # Windows that have emptied are deleted from memory and from limiter_state.
+    # Returns the number of rows written.
+    def flush(self, now=None):
+        now = time.time() if now is None else now
+        with self._flush_lock:
+            with self._lock:
+                counters, self._counters = self._counters, {}
+                self._flushing = counters
+                dirty, self._dirty = self._dirty, set()
+                saved = []
+                deleted = []
+                for acc_num, kind in dirty:
+                    state = self._state(acc_num, kind, now)
+                    if state:
+                        saved.append((acc_num, kind, json.dumps(state), now))
+                    else:
+                        deleted.append((acc_num, kind))
+            if not (counters or saved or deleted):
+                with self._lock:
+                    self._flushing = {}
+                    self._flushed = {}
+                return 0
+            updates = {}
+            for (acc_num, column), value in counters.items():
+                updates.setdefault(self._account_path(acc_num), {}).setdefault(column, []).append((value, acc_num))
+            statements = {path: [(f"UPDATE accounts SET {column} = ? WHERE acc_num = ?", rows) for column, rows in columns.items()]
+                          for path, columns in updates.items()}
+            statements.setdefault(self.path, []).extend([
+                ("INSERT OR REPLACE INTO limiter_state (acc_num, kind, state, updated_at) VALUES (?, ?, ?, ?)", saved),
+                ("DELETE FROM limiter_state WHERE acc_num = ? AND kind = ?", deleted)])
+            try:
+                for path, path_statements in statements.items():
+                    self._write(path, path_statements)
+            except BaseException:
+                # Put everything back for the next round, keeping values recorded meanwhile
+                with self._lock:
+                    counters.update(self._counters)
+                    self._counters = counters
+                    self._flushing = {}
+                    self._dirty.update(dirty)
+                raise
+            with self._lock:
+                self._flushed = counters
+                self._flushing = {}
+                self.flushes += 1
+                self.rows_flushed += len(counters) + len(saved) + len(deleted)
+            return len(counters) + len(saved) + len(deleted)
+
+    # Method to run (sql, rows) statements with executemany in one committed transaction on the file at path
+    def _write(self, path, statements):
+        statements = [(sql, rows) for sql, rows in statements if rows]
+        if not statements:
+            return
+        conn = self._connection(path)
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            for sql, rows in statements:
+                cursor.executemany(sql, rows)
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+    # Method to return the saved form of a window, or None (dropping it) once it has emptied
+    # Called with the lock held.
+    def _state(self, acc_num, kind, now):
+        if kind == LOGIN:
+            ring = self._failures.get(acc_num)
+            if ring is None or ring.expired(self.login_window, now):
+                self._failures.pop(acc_num, None)
+                return None
+            return ring.to_state()
+        ring = self._spending.get(acc_num)
+        if ring is None:
+            return None
+        ring.advance(now)
+        if ring.total <= 0:
+            self._spending.pop(acc_num, None)
+            return None
+        return ring.to_state()
+
+    # Method to load the windows saved by an earlier run, skipping those that have emptied
+    # Returns the number of windows loaded.
+    def restore(self, now=None):
+        now = time.time() if now is None else now
+        rows = self._connection(self.path).execute("SELECT acc_num, kind, state FROM limiter_state").fetchall()
+        loaded = 0
+        with self._lock:
+            for acc_num, kind, state in rows:
+                state = json.loads(state)
+                if kind == LOGIN:
+                    ring = FailureWindow.from_state(self.login_failures, state)
+                    if ring.expired(self.login_window, now):
+                        continue
+                    self._failures[acc_num] = ring
+                elif kind == SPEND:
+                    ring = SpendWindow.from_state(self.spend_window, self.spend_slots, state, now)
+                    if ring.total <= 0:
+                        continue
+                    self._spending[acc_num] = ring
+                loaded += 1
+        return loaded
+
+    # Method to drop the windows that have emptied without being touched since their last flush
+    def _sweep(self, now):
+        with self._lock:
+            for acc_num in [acc_num for acc_num, ring in self._failures.items() if ring.expired(self.login_window, now)]:
+                self._dirty.add((acc_num, LOGIN))
+            for acc_num, ring in self._spending.items():
+                ring.advance(now)
+                if ring.total <= 0:
+                    self._dirty.add((acc_num, SPEND))
+
+    # Method to flush every flush_interval seconds on a background thread
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="limiter", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        last_sweep = time.monotonic()
+        while not self._stop.wait(self.flush_interval):
+            if time.monotonic() - last_sweep >= self.login_window:
+                self._sweep(time.time())
+                last_sweep = time.monotonic()
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                # Nothing is lost: the changes stay queued for the next round
+                print(f"Limiter flush failed: {e}")
+
+    # Method to stop the flusher, write what is left and close the connections
+    def close(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        try:
+            self.flush()
+        finally:
+            for conn in self._connections.values():
+                conn.close()
+            self._connections.clear()
+
+    # Method to report the number of tracked accounts and the limiter's counters
+    def stats(self):
+        with self._lock:
+            return {
+                "login_windows": len(self._failures),
+                "spend_windows": len(self._spending),
+                "pending_counters": len(self._counters),
+                "throttled": self.throttled,
+                "refused": self.refused,
+                "flushes": self.flushes,
+                "rows_flushed": self.rows_flushed,
+            }
+
+
+# Column positions in SELECT * FROM accounts of the counters the limiter keeps
+_COUNTER_INDEX = {"incorrect_password_attempts": 6, "incorrect_2fa_attempts": 10}
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+# Function to enforce login and spending limits in this process, restoring the saved windows
+# Limits are kept for the pooled database (call after connection_pool.configure and, when
+# sharded, sharding.configure_shards). spend_limit None leaves payments unlimited.
+def enable_limiter(**options):
+    global _limiter
+    disable_limiter()
+    limiter = Limiter(connection_pool.get_manager().path, **options)
+    limiter.restore()
+    limiter.start()
+    with _limiter_lock:
+        _limiter = limiter
+    return limiter
+
+
+# Function to stop enforcing limits, writing what the limiter still holds
+def disable_limiter():
+    global _limiter
+    with _limiter_lock:
+        limiter, _limiter = _limiter, None
+    if limiter is not None:
+        limiter.close()
+
+
+# Function to return the process-wide limiter, or None when limits are off
+def get_limiter():
+    return _limiter
+
+
+# Function to return how many seconds an account must wait before its next login attempt
+def login_retry_after(acc_num):
+    limiter = _limiter
+    return limiter.login_retry_after(acc_num) if limiter is not None else 0.0
+
+
+# Function to count a withdrawal or transfer out against the account's spending limit
+# Returns (ticket, None), or (None, message) when the payment would exceed the limit. Pass the
+# ticket to release_spending if the payment is then rejected.
+def reserve_spending(acc_num, amount):
+    limiter = _limiter
+    return limiter.reserve(acc_num, amount) if limiter is not None else (UNLIMITED, None)
+
+
+# Function to give back a reservation whose payment was rejected
+def release_spending(acc_num, ticket):
+    limiter = _limiter
+    if limiter is not None:
+        limiter.release(acc_num, ticket)
+
+
+# Function to drop the limiter's windows and counters of an account (admin unlock)
+def forget_account(acc_num):
+    limiter = _limiter
+    if limiter is not None:
+        limiter.forget(acc_num)
+
+
+# Function to drop the limiter's windows and counters of every account (tables cleared)
+def reset_limiter():
+    limiter = _limiter
+    if limiter is not None:
+        limiter.reset()
+
+
+# Function to report the limiter's counters, or None when limits are off
+def limiter_stats():
+    limiter = _limiter
+    return limiter.stats() if limiter is not None else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Show the saved login and spending windows")
+    parser.add_argument("--db", default=connection_pool.DEFAULT_DATABASE)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    show = subparsers.add_parser("show", help="list the saved windows that haven't emptied")
+    show.add_argument("--acc-num", type=int)
+    show.add_argument("--login-window", type=float, default=DEFAULT_LOGIN_WINDOW)
+    show.add_argument("--spend-window", type=float, default=DEFAULT_SPEND_WINDOW)
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    try:
+        sql = "SELECT acc_num, kind, state, updated_at FROM limiter_state"
+        params = ()
+        if args.acc_num is not None:
+            sql += " WHERE acc_num = ?"
+            params = (args.acc_num,)
+        now = time.time()
+        for acc_num, kind, state, updated_at in conn.execute(sql + " ORDER BY acc_num, kind", params):
+            state = json.loads(state)
+            if kind == LOGIN:
+                recent = [moment for moment in state if moment + args.login_window > now]
+                if recent:
+                    print(f"{acc_num}: {len(recent)} failed logins in the last {args.login_window:.0f}s")
+            else:
+                spent = sum(amount for moment, amount in state if moment + args.spend_window > now)
+                if spent:
+                    print(f"{acc_num}: {spent} spent in the last {args.spend_window:.0f}s")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
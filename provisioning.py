@@ -0,0 +1,126 @@
+# Bulk creation of accounts, e.g. to onboard a batch of customers.
+# Run from the repository root:
+#   python provisioning.py [--db bank.db] ACCOUNTS_CSV [--chunk-size N] [--output created.csv]
+# ACCOUNTS_CSV has a header row with the columns name and password.
+#
+# Passwords are hashed across the verification pool's worker processes, one chunk ahead of the
+# inserts. Every chunk reserves its own block of account numbers from the account_sequence
+# row (see account_repository.reserve_account_numbers) and is inserted with executemany in one
+# transaction, so several provisioning workers can run side by side without competing for
+# numbers and nothing ever reads MAX(acc_num).
+import argparse
+import csv
+import itertools
+import time
+
+import connection_pool
+from account_repository import advance_account_sequence
+from auth import VerificationPool, get_verification_pool
+from schema import initialize_database
+from sharding import close_shards, configure_shards, get_router, recorded_shard_count
+
+DEFAULT_CHUNK_SIZE = 5000
+
+INSERT_ACCOUNT = ("INSERT INTO accounts (name, acc_num, total_amount, total_dep, total_wit, total_tra, incorrect_password_attempts, is_locked, password, two_factor_enabled, incorrect_2fa_attempts) "
+                  "VALUES (?, ?, 0, 0, 0, 0, 0, 0, ?, 0, 0)")
+
+
+# Function to run executemany(INSERT_ACCOUNT, rows) in one write transaction, reserving the
+# account numbers in it first when numbers is None; returns the account numbers used
+def _insert_accounts(conn, rows, numbers=None):
+    if conn.in_transaction:
+        conn.commit()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if numbers is None:
+            numbers = advance_account_sequence(conn, len(rows))
+        conn.executemany(INSERT_ACCOUNT, [(name, acc_num, password) for (name, password), acc_num in zip(rows, numbers)])
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return list(numbers)
+
+
+# Function to create one chunk of accounts from (name, password hash) rows
+# Returns the account numbers in the order of the rows.
+def create_accounts(conn, rows):
+    router = get_router()
+    if router is None:
+        return _insert_accounts(connection_pool.resolve_connection(conn), rows)
+    # Sharded: the numbers come from the catalog and each shard gets its own rows
+    numbers = router.reserve_account_numbers(len(rows))
+    by_shard = {}
+    for row, acc_num in zip(rows, numbers):
+        shard_rows, shard_numbers = by_shard.setdefault(router.shard_of(acc_num), ([], []))
+        shard_rows.append(row)
+        shard_numbers.append(acc_num)
+    for shard_rows, shard_numbers in by_shard.values():
+        _insert_accounts(router.connection_for(shard_numbers[0]), shard_rows, shard_numbers)
+    return list(numbers)
+
+
+# Function to create accounts from (name, password) pairs, committing once per chunk
+# The passwords of the next chunk are hashed in the verification pool while the current chunk
+# is inserted. Returns the created account numbers in input order.
+def provision_accounts(accounts, conn=None, chunk_size=DEFAULT_CHUNK_SIZE, pool=None):
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be at least 1")
+    conn = connection_pool.resolve_connection(conn)
+    pool = pool or get_verification_pool()
+    accounts = iter(accounts)
+    created = []
+    pending = None
+    while True:
+        chunk = list(itertools.islice(accounts, chunk_size))
+        queued = ([name for name, _ in chunk], pool.hash_passwords(password for _, password in chunk)) if chunk else None
+        if pending is not None:
+            names, hashes = pending
+            created.extend(create_accounts(conn, list(zip(names, hashes))))
+        if queued is None:
+            return created
+        pending = queued
+
+
+# Function to stream (name, password) pairs from a CSV file with name and password columns
+def iter_accounts_csv(path):
+    with open(path, newline="") as file:
+        for record in csv.DictReader(file):
+            yield record["name"], record["password"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Create accounts in bulk from a CSV file of names and passwords")
+    parser.add_argument("--db", default=connection_pool.DEFAULT_DATABASE)
+    parser.add_argument("accounts", help="CSV file with name and password columns")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--workers", type=int, help="password hashing processes (default: one per core)")
+    parser.add_argument("--output", help="write the created account numbers and names to this CSV file")
+    args = parser.parse_args()
+
+    initialize_database(connection_pool.configure(args.db).acquire())
+    shard_count = recorded_shard_count(args.db)
+    if shard_count:
+        configure_shards(args.db, shard_count).initialize()
+    pool = VerificationPool(args.workers)
+    start = time.perf_counter()
+    try:
+        created = provision_accounts(iter_accounts_csv(args.accounts), chunk_size=args.chunk_size, pool=pool)
+    finally:
+        pool.shutdown()
+        close_shards()
+        connection_pool.close_all()
+    seconds = time.perf_counter() - start
+    print(f"Created {len(created)} accounts in {seconds:.2f}s ({len(created) / seconds if seconds else 0:,.0f} accounts/sec).")
+    if created:
+        print(f"Account numbers {created[0]} to {created[-1]}.")
+    if args.output:
+        with open(args.output, "w", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(["acc_num", "name"])
+            writer.writerows(zip(created, (name for name, _ in iter_accounts_csv(args.accounts))))
+        print(f"Account numbers written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
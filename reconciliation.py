@@ -0,0 +1,173 @@
+# Reconciles the running totals in `accounts` against the `transactions` ledger.
+# Run from the repository root:  python reconciliation.py --db bank.db [--workers 4] [--output mismatches.csv]
+#
+# Expected totals per account, given how the posting paths write the ledger:
+#   total_amount = sum of all amounts
+#   total_dep    = sum of 'deposit' amounts
+#   total_wit    = -(sum of 'withdrawal' amounts)      (withdrawals are stored negative)
+#   total_tra    = -(sum of negative 'transfer' amounts)
+import argparse
+import concurrent.futures
+import csv
+import itertools
+import multiprocessing
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+from archive import list_partitions
+from schema import initialize_database
+from sharding import data_paths
+
+FIELDS = ("total_amount", "total_dep", "total_wit", "total_tra")
+FETCH_ROWS = 250000
+
+_DEPOSIT, _WITHDRAWAL, _TRANSFER = 1, 2, 3
+_LEDGER_SQL = ("SELECT acc_num, CASE transaction_type WHEN 'deposit' THEN 1 WHEN 'withdrawal' THEN 2 WHEN 'transfer' THEN 3 ELSE 0 END, amount "
+               "FROM transactions WHERE acc_num >= ? AND acc_num < ? ORDER BY acc_num")
+
+
+# Function to load rows of integers from a cursor into an (n, width) int64 array
+def _to_array(rows, width):
+    return np.fromiter(itertools.chain.from_iterable(rows), dtype=np.int64, count=len(rows) * width).reshape(len(rows), width)
+
+
+# Function to add the ledger rows of one cursor (acc_num, type code, amount, sorted by acc_num) into `ledger`
+# Returns the number of rows read; account numbers missing from acc_nums are added to orphans.
+def _accumulate(cursor, acc_nums, ledger, orphans, fetch_rows):
+    rows_read = 0
+    while True:
+        batch = cursor.fetchmany(fetch_rows)
+        if not batch:
+            return rows_read
+        rows_read += len(batch)
+        data = _to_array(batch, 3)
+        accs, kinds, amounts = data[:, 0], data[:, 1], data[:, 2]
+
+        # Rows arrive sorted by acc_num, so each account is one contiguous run
+        starts = np.flatnonzero(np.r_[True, accs[1:] != accs[:-1]])
+        run_accs = accs[starts]
+        sums = np.stack([
+            np.add.reduceat(amounts, starts),
+            np.add.reduceat(np.where(kinds == _DEPOSIT, amounts, 0), starts),
+            np.add.reduceat(np.where(kinds == _WITHDRAWAL, -amounts, 0), starts),
+            np.add.reduceat(np.where((kinds == _TRANSFER) & (amounts < 0), -amounts, 0), starts),
+        ], axis=1)
+
+        index = np.searchsorted(acc_nums, run_accs)
+        known = index < len(acc_nums)
+        known[known] = acc_nums[index[known]] == run_accs[known]
+        # run_accs is unique within a batch, so plain fancy-index addition is safe
+        ledger[index[known]] += sums[known]
+        orphans.update(run_accs[~known].tolist())
+
+
+# Function to reconcile the accounts with lo <= acc_num < hi; runs in a worker process
+# Returns (accounts_checked, ledger_rows, mismatches, orphan_accounts) where each mismatch is
+# (acc_num, field, stored_value, ledger_value) and orphan_accounts counts acc_nums that have
+# ledger rows but no accounts row. archive_paths are the monthly archive files (see archive.py),
+# which are read after the hot table with their own connections.
+def reconcile_range(db_path, lo, hi, archive_paths=(), fetch_rows=FETCH_ROWS):
+    conn = sqlite3.connect(db_path)
+    try:
+        # One read transaction so both tables are read from the same snapshot
+        conn.execute("BEGIN")
+        rows = conn.execute("SELECT acc_num, total_amount, total_dep, total_wit, total_tra FROM accounts WHERE acc_num >= ? AND acc_num < ? ORDER BY acc_num",
+                            (lo, hi)).fetchall()
+        stored = _to_array(rows, 5)
+        acc_nums = stored[:, 0]
+        # Ledger sums laid out like the stored totals: amount, deposits, withdrawals, transfers out
+        ledger = np.zeros((len(acc_nums), 4), dtype=np.int64)
+        orphans = set()
+        ledger_rows = _accumulate(conn.execute(_LEDGER_SQL, (lo, hi)), acc_nums, ledger, orphans, fetch_rows)
+        conn.rollback()
+    finally:
+        conn.close()
+
+    for path in archive_paths:
+        archive = sqlite3.connect(path)
+        try:
+            ledger_rows += _accumulate(archive.execute(_LEDGER_SQL, (lo, hi)), acc_nums, ledger, orphans, fetch_rows)
+        finally:
+            archive.close()
+
+    mismatches = []
+    differing = np.flatnonzero((stored[:, 1:] != ledger).any(axis=1))
+    for row in differing.tolist():
+        for column, field in enumerate(FIELDS):
+            if stored[row, column + 1] != ledger[row, column]:
+                mismatches.append((int(acc_nums[row]), field, int(stored[row, column + 1]), int(ledger[row, column])))
+    return len(acc_nums), ledger_rows, mismatches, len(orphans)
+
+
+# Function to split the account number space into contiguous ranges for the workers
+def _ranges(conn, chunks):
+    lo = conn.execute("SELECT MIN(m) FROM (SELECT MIN(acc_num) AS m FROM accounts UNION ALL SELECT MIN(acc_num) FROM transactions)").fetchone()[0]
+    hi = conn.execute("SELECT MAX(m) FROM (SELECT MAX(acc_num) AS m FROM accounts UNION ALL SELECT MAX(acc_num) FROM transactions)").fetchone()[0]
+    if lo is None:
+        return []
+    bounds = np.unique(np.linspace(lo, hi + 1, chunks + 1).astype(np.int64)).tolist()
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+# Function to reconcile the whole database across a process pool and return a report dict
+# A sharded database is reconciled shard by shard, each shard holding its accounts' ledger.
+def reconcile(db_path, workers=None, chunks=None):
+    workers = workers or os.cpu_count() or 1
+    chunks = chunks or workers * 4
+    tasks = []
+    for path in data_paths(db_path):
+        conn = sqlite3.connect(path)
+        try:
+            initialize_database(conn)
+            archive_paths = [partition[1] for partition in list_partitions(conn)]
+            tasks.extend((path, lo, hi, archive_paths) for lo, hi in _ranges(conn, chunks))
+        finally:
+            conn.close()
+
+    start = time.perf_counter()
+    report = {"accounts_checked": 0, "ledger_rows": 0, "mismatches": [], "orphan_ledger_accounts": 0}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = [pool.submit(reconcile_range, *task) for task in tasks]
+        for future in futures:
+            accounts_checked, ledger_rows, mismatches, orphans = future.result()
+            report["accounts_checked"] += accounts_checked
+            report["ledger_rows"] += ledger_rows
+            report["mismatches"].extend(mismatches)
+            report["orphan_ledger_accounts"] += orphans
+    report["mismatched_accounts"] = len({mismatch[0] for mismatch in report["mismatches"]})
+    report["seconds"] = time.perf_counter() - start
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reconcile account totals against the transaction ledger")
+    parser.add_argument("--db", default="bank.db")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: number of cores)")
+    parser.add_argument("--chunks", type=int, default=None, help="account ranges to split the work into")
+    parser.add_argument("--output", help="write mismatches to this CSV file")
+    args = parser.parse_args()
+
+    report = reconcile(args.db, args.workers, args.chunks)
+    rate = report["ledger_rows"] / report["seconds"] if report["seconds"] else 0.0
+    print(f"Checked {report['accounts_checked']} accounts and {report['ledger_rows']} ledger rows "
+          f"in {report['seconds']:.2f}s ({rate:,.0f} rows/sec).")
+    print(f"Mismatched accounts: {report['mismatched_accounts']}")
+    if report["orphan_ledger_accounts"]:
+        print(f"Ledger rows for {report['orphan_ledger_accounts']} account numbers with no account (deleted accounts).")
+    for acc_num, field, stored, ledger in report["mismatches"][:20]:
+        print(f"  account {acc_num}: {field} = {stored}, ledger says {ledger}")
+    if len(report["mismatches"]) > 20:
+        print(f"  ... {len(report['mismatches']) - 20} more")
+    if args.output:
+        with open(args.output, "w", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(["acc_num", "field", "stored", "ledger"])
+            writer.writerows(report["mismatches"])
+        print(f"Mismatches written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+from auth import MAX_ATTEMPTS
+
+# Lock status as SQL. Used verbatim both by the partial index below and by the account listing
+# queries, because SQLite only uses a partial index when the query repeats its WHERE clause.
+LOCKED_CONDITION = f"(is_locked = 1 OR incorrect_password_attempts >= {MAX_ATTEMPTS} OR incorrect_2fa_attempts >= {MAX_ATTEMPTS})"
+
+# Values the ledger's transaction_type column takes. Only append to it: statements.py numbers
+# the types by their position here in its columnar files.
+LEDGER_TYPES = ("deposit", "withdrawal", "transfer", "interest", "fee")
+
+
+# Function to create the tables used by the banking system if they don't exist already
+def initialize_database(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS accounts
+                 (name TEXT, acc_num INTEGER PRIMARY KEY, total_amount INTEGER,
+                 total_dep INTEGER, total_wit INTEGER, total_tra INTEGER,
+                 incorrect_password_attempts INTEGER DEFAULT 0, is_locked INTEGER DEFAULT 0,
+                 password TEXT, two_factor_enabled INTEGER DEFAULT 0,
+                 incorrect_2fa_attempts INTEGER DEFAULT 0)''')
+
+    conn.execute('''CREATE TABLE IF NOT EXISTS admin
+                     (password TEXT PRIMARY KEY)''')
+
+    conn.execute('''CREATE TABLE IF NOT EXISTS transactions
+                 (transaction_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  acc_num INTEGER,
+                  transaction_type TEXT,
+                  amount INTEGER,
+                  timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                  FOREIGN KEY (acc_num) REFERENCES accounts(acc_num))''')
+
+    # Per-account history is read in (timestamp, transaction_id) order; carrying the type and
+    # amount in the index as well lets history queries be answered from the index alone
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_transactions_acc_time
+                 ON transactions (acc_num, timestamp, transaction_id, transaction_type, amount)''')
+
+    # Lets archive.py find the rows older than a cutoff without scanning the whole table
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_transactions_time ON transactions (timestamp)")
+
+    # Months of the ledger moved out to archive files by archive.py
+    conn.execute('''CREATE TABLE IF NOT EXISTS archive_partitions
+                 (month TEXT PRIMARY KEY,
+                  path TEXT,
+                  month_start TEXT,
+                  month_end TEXT,
+                  min_id INTEGER,
+                  max_id INTEGER,
+                  row_count INTEGER,
+                  archived_at DATETIME DEFAULT CURRENT_TIMESTAMP)''')
+
+    # Periodic per-account balance snapshots (see checkpoints.py). A checkpoint holds the
+    # ledger balance after every transaction up to and including (timestamp, transaction_id).
+    conn.execute('''CREATE TABLE IF NOT EXISTS balance_checkpoints
+                 (acc_num INTEGER,
+                  timestamp DATETIME,
+                  transaction_id INTEGER,
+                  balance INTEGER,
+                  PRIMARY KEY (acc_num, timestamp, transaction_id)) WITHOUT ROWID''')
+
+    # How far checkpointing has got for each account, so new postings are folded in incrementally
+    conn.execute('''CREATE TABLE IF NOT EXISTS balance_checkpoint_state
+                 (acc_num INTEGER PRIMARY KEY,
+                  timestamp DATETIME,
+                  transaction_id INTEGER,
+                  balance INTEGER,
+                  rows_since_checkpoint INTEGER,
+                  checkpoint_timestamp DATETIME)''')
+
+    # Ledger totals per account, day and transaction type (see aggregates.py), kept up to date
+    # by every posting path; the day index serves the daily volume and top-account reports
+    conn.execute('''CREATE TABLE IF NOT EXISTS daily_aggregates
+                 (acc_num INTEGER,
+                  day TEXT,
+                  transaction_type TEXT,
+                  count INTEGER,
+                  total INTEGER,
+                  gross INTEGER,
+                  min_amount INTEGER,
+                  max_amount INTEGER,
+                  PRIMARY KEY (acc_num, day, transaction_type)) WITHOUT ROWID''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_daily_aggregates_day ON daily_aggregates (day, transaction_type, acc_num, count, total, gross)")
+
+    # The last transaction_id folded into daily_aggregates
+    conn.execute("CREATE TABLE IF NOT EXISTS aggregate_state (id INTEGER PRIMARY KEY CHECK (id = 1), transaction_id INTEGER)")
+
+    # Saved login and spending windows of the limiter (see limiter.py), one row per account and kind
+    conn.execute('''CREATE TABLE IF NOT EXISTS limiter_state
+                 (acc_num INTEGER,
+                  kind TEXT,
+                  state TEXT,
+                  updated_at REAL,
+                  PRIMARY KEY (acc_num, kind)) WITHOUT ROWID''')
+
+    # The last account number handed out (see account_repository.reserve_account_numbers)
+    conn.execute("CREATE TABLE IF NOT EXISTS account_sequence (id INTEGER PRIMARY KEY CHECK (id = 1), last_acc_num INTEGER)")
+
+    # How far each bulk import has got (see ledger_import.py), so an interrupted load can resume
+    conn.execute('''CREATE TABLE IF NOT EXISTS import_progress
+                 (source TEXT PRIMARY KEY,
+                  rows_done INTEGER,
+                  rows_imported INTEGER,
+                  rows_rejected INTEGER,
+                  status TEXT,
+                  updated_at DATETIME DEFAULT CURRENT_TIMESTAMP)''')
+
+    # Indexes behind the admin account listing filters and sort orders. The failed-attempt
+    # and locked indexes are partial, so they only hold the few accounts that match.
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_accounts_balance ON accounts (total_amount)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_accounts_name ON accounts (name)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_accounts_password_attempts ON accounts (incorrect_password_attempts) WHERE incorrect_password_attempts > 0")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_accounts_2fa_attempts ON accounts (incorrect_2fa_attempts) WHERE incorrect_2fa_attempts > 0")
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_accounts_locked ON accounts (acc_num) WHERE {LOCKED_CONDITION}")
+    conn.commit()
@@ -0,0 +1,111 @@
+# Serves interactive banking sessions from one long-running process over a Unix socket.
+# Start the daemon:   python "Secure Financial Framework.py" --daemon [--socket bank.sock]
+# Start a session:    python bank_session.py [--socket bank.sock]
+#
+# The daemon imports everything, opens the database and checks the schema once; each client
+# connection then gets its own thread whose print()/input() go to that connection.
+import io
+import os
+import socket
+import socketserver
+import stat
+import sys
+import threading
+import traceback
+
+from bank_session import DEFAULT_SOCKET
+
+
+class _ThreadStream:
+    # Stands in for sys.stdin/sys.stdout so each session thread reads and writes its own connection
+    def __init__(self, default):
+        self._default = default
+        self._local = threading.local()
+
+    def redirect(self, stream):
+        self._local.stream = stream
+
+    def _target(self):
+        return getattr(self._local, "stream", None) or self._default
+
+    def write(self, text):
+        return self._target().write(text)
+
+    def readline(self, *args):
+        return self._target().readline(*args)
+
+    def flush(self):
+        self._target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self._target(), name)
+
+
+class _SessionHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        reader = io.TextIOWrapper(self.rfile, encoding="utf-8", newline=None)
+        writer = io.TextIOWrapper(self.wfile, encoding="utf-8", write_through=True)
+        sys.stdin.redirect(reader)
+        sys.stdout.redirect(writer)
+        try:
+            self.server.session()
+        except (EOFError, ConnectionError):
+            # The client went away mid-session
+            pass
+        except Exception:
+            traceback.print_exc(file=sys.__stderr__)
+        finally:
+            sys.stdin.redirect(None)
+            sys.stdout.redirect(None)
+
+
+class _SessionServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+# Function to remove a socket left behind by a daemon that is no longer running
+# Raises RuntimeError if a daemon still answers on it, or if the path isn't a socket.
+def _remove_stale_socket(socket_path):
+    try:
+        mode = os.stat(socket_path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise RuntimeError(f"{socket_path} exists and is not a socket")
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(socket_path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        # Nobody is listening: the daemon that made it has exited
+        try:
+            os.remove(socket_path)
+        except FileNotFoundError:
+            pass
+        return
+    finally:
+        probe.close()
+    raise RuntimeError(f"A daemon is already serving sessions on {socket_path}")
+
+
+# Function to serve session() to every client that connects to socket_path, until interrupted
+# session is called on a new thread per connection with sys.stdin/sys.stdout bound to it.
+def serve(session, socket_path=DEFAULT_SOCKET):
+    if not isinstance(sys.stdout, _ThreadStream):
+        sys.stdin = _ThreadStream(sys.stdin)
+        sys.stdout = _ThreadStream(sys.stdout)
+    _remove_stale_socket(socket_path)
+    # Sessions act with the daemon's access to the database, so only its owner may connect.
+    # The socket is created with owner-only permissions rather than changed after the bind,
+    # which would leave a moment in which anyone could connect.
+    umask = os.umask(0o077)
+    try:
+        server = _SessionServer(socket_path, _SessionHandler)
+    finally:
+        os.umask(umask)
+    server.session = session
+    print(f"Serving sessions on {socket_path}", file=sys.__stdout__, flush=True)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(socket_path)
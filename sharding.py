@@ -0,0 +1,503 @@
+# Horizontal sharding of accounts and their ledger across several SQLite files.
+# Run from the repository root:
+#   python sharding.py [--db bank.db] split N     move the accounts of a single-file database into N shards
+#   python sharding.py [--db bank.db] status      accounts, transactions and unfinished transfers per shard
+#   python sharding.py [--db bank.db] recover     finish cross-shard transfers interrupted by a crash
+# and start the program on the sharded database with
+#   python "Secure Financial Framework.py" --shards N
+#
+# bank.db stays the catalog: it keeps the admin password, the shard layout and the account
+# number sequence. Account n and all its rows (ledger, balance checkpoints) live in shard
+# n % N, the file bank_shard<n % N>.db next to the catalog. Every shard has its own write lock,
+# so writes to accounts on different shards run in parallel. Transaction ids are unique
+# within a shard only.
+#
+# A transfer between two shards is a local two-phase commit. Phase one opens a write
+# transaction on both shards (in shard order, so two transfers can't deadlock) and makes every
+# check: the debit goes through and the target account exists. Phase two commits the source
+# shard together with an entry in its transfer_outbox, which is the decision, then commits the
+# credit on the target shard together with an entry in its transfer_inbox. Delivered outbox
+# entries are deleted by the next transfer out of the same shard, inside its own transaction,
+# and their inbox entries, no longer needed once the outbox entry is gone, by the next credit
+# to the target shard. If the process dies between the two commits, complete_transfers() (run
+# whenever the shards are opened) delivers every outbox entry whose credit is missing from the
+# target's inbox, and prunes the inbox entries a crash left behind.
+import argparse
+import concurrent.futures
+import functools
+import heapq
+import itertools
+import os
+import sqlite3
+import threading
+
+import connection_pool
+from account_listing import DEFAULT_PAGE_SIZE, SORT_COLUMNS, fetch_account_page
+from account_repository import invalidate_accounts, reserve_account_numbers
+from aggregates import advance_aggregates
+from checkpoints import advance_checkpoints
+from connection_pool import ConnectionManager, DEFAULT_DATABASE, DEFAULT_PROFILE
+from schema import initialize_database
+from snapshots import snapshot_connection
+from transfer_engine import MAX_RETRIES, backoff, is_busy_error, transfer_funds
+
+DEFAULT_SHARDS = 4
+
+# Tables whose rows belong to one account and so move to that account's shard
+_SHARDED_TABLES = ("accounts", "transactions", "balance_checkpoints", "balance_checkpoint_state", "daily_aggregates")
+
+
+# Function to return the paths of the shard files of a catalog database
+def shard_paths(path, shard_count):
+    root, ext = os.path.splitext(path)
+    return [f"{root}_shard{n}{ext or '.db'}" for n in range(shard_count)]
+
+
+# Function to create the catalog's own tables
+def _initialize_catalog(conn):
+    conn.execute("CREATE TABLE IF NOT EXISTS shard_layout (shard INTEGER PRIMARY KEY, path TEXT)")
+    conn.commit()
+
+
+# Function to create a shard's tables: the usual schema plus the cross-shard transfer logs
+def _initialize_shard(conn):
+    initialize_database(conn)
+    # Transfers this shard debited whose credit may not have reached the target shard yet
+    conn.execute('''CREATE TABLE IF NOT EXISTS transfer_outbox
+                 (xid INTEGER PRIMARY KEY AUTOINCREMENT,
+                  from_acc_num INTEGER,
+                  to_acc_num INTEGER,
+                  amount INTEGER,
+                  created_at DATETIME DEFAULT CURRENT_TIMESTAMP)''')
+    # Credits this shard received, keyed by the source shard's outbox entry so none is applied twice
+    conn.execute('''CREATE TABLE IF NOT EXISTS transfer_inbox
+                 (source_shard INTEGER,
+                  xid INTEGER,
+                  to_acc_num INTEGER,
+                  amount INTEGER,
+                  PRIMARY KEY (source_shard, xid)) WITHOUT ROWID''')
+    conn.commit()
+
+
+# Function to return the highest account number on a shard
+def _max_acc_num(conn):
+    return conn.execute("SELECT IFNULL(MAX(acc_num), 0) FROM accounts").fetchone()[0]
+
+
+# Function to apply the credit of an outbox entry on the target shard, once, and commit it
+# Runs in the transaction the caller already has open on conn (phase two of a transfer) or
+# opens one (recovery). cleared lists (source_shard, xid) inbox entries whose outbox entry has
+# been deleted; they are removed in the same transaction.
+def _deliver(conn, source_shard, xid, to_acc_num, amount, cleared=()):
+    try:
+        if not conn.in_transaction:
+            conn.execute("BEGIN IMMEDIATE")
+        conn.executemany("DELETE FROM transfer_inbox WHERE source_shard = ? AND xid = ?", cleared)
+        cursor = conn.execute("INSERT OR IGNORE INTO transfer_inbox (source_shard, xid, to_acc_num, amount) VALUES (?, ?, ?, ?)",
+                              (source_shard, xid, to_acc_num, amount))
+        if cursor.rowcount:
+            conn.execute("UPDATE accounts SET total_amount = total_amount + ? WHERE acc_num = ?", (amount, to_acc_num))
+            conn.execute("INSERT INTO transactions (acc_num, transaction_type, amount) VALUES (?, 'transfer', ?)", (to_acc_num, amount))
+            advance_checkpoints(conn, (to_acc_num,))
+            advance_aggregates(conn)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        invalidate_accounts(conn, to_acc_num)
+
+
+class ShardRouter:
+    # Routes account-scoped work to the shard holding the account. The catalog is reached
+    # through the process-wide connection_pool manager, so configure() it for the same path.
+    def __init__(self, path=DEFAULT_DATABASE, shard_count=DEFAULT_SHARDS, profile=DEFAULT_PROFILE):
+        if shard_count < 1:
+            raise ValueError("shard_count must be at least 1")
+        self.path = path
+        self.paths = shard_paths(path, shard_count)
+        self.managers = [ConnectionManager(shard_path, profile) for shard_path in self.paths]
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        # (xid, target shard) of the outbox entries per source shard whose credit has been
+        # committed; the next transfer from that shard deletes them in its own transaction
+        # instead of paying a commit for each
+        self._delivered = [[] for _ in self.managers]
+        # (source shard, xid) of the inbox entries per target shard whose outbox entry has been
+        # deleted; the next credit to that shard deletes them the same way
+        self._cleared = [[] for _ in self.managers]
+        self._delivered_lock = threading.Lock()
+
+    # Method to return the index of the shard holding an account
+    def shard_of(self, acc_num):
+        return acc_num % len(self.managers)
+
+    # Method to return the calling thread's connection to the shard holding an account
+    def connection_for(self, acc_num):
+        return self.managers[self.shard_of(acc_num)].acquire()
+
+    # Method to return the calling thread's connection to every shard, in shard order
+    def shard_connections(self):
+        return [manager.acquire() for manager in self.managers]
+
+    # Method to hand the calling thread's shard connections back to their pools
+    def release(self):
+        for manager in self.managers:
+            manager.release()
+
+    # Method to return the calling thread's catalog connection
+    def catalog_connection(self):
+        return connection_pool.get_connection()
+
+    # Method to create the tables, check the layout and finish interrupted transfers
+    # A catalog that isn't laid out yet must not hold accounts (split_database moves them).
+    # Returns the number of transfers completed.
+    def initialize(self):
+        catalog = self.catalog_connection()
+        initialize_database(catalog)
+        _initialize_catalog(catalog)
+        layout = catalog.execute("SELECT COUNT(*) FROM shard_layout").fetchone()[0]
+        if layout and layout != len(self.managers):
+            raise ValueError(f"{self.path} is laid out in {layout} shards, not {len(self.managers)}")
+        if not layout:
+            # Shards start out empty, so accounts already in the catalog would become unreachable
+            if catalog.execute("SELECT 1 FROM accounts LIMIT 1").fetchone() is not None:
+                raise ValueError(f"{self.path} holds accounts that aren't sharded yet; move them with "
+                                 f"python sharding.py --db {self.path} split {len(self.managers)}")
+            catalog.executemany("INSERT INTO shard_layout (shard, path) VALUES (?, ?)",
+                                [(n, os.path.basename(shard_path)) for n, shard_path in enumerate(self.paths)])
+            catalog.commit()
+        for conn in self.shard_connections():
+            _initialize_shard(conn)
+        return self.complete_transfers()
+
+    # Method to run func(shard connection, *args) on every shard in parallel
+    # Returns the results in shard order. Each shard is queried on a pool thread through that
+    # thread's own pooled connection, or its connection to the shard's reporting snapshot with
+    # from_snapshot (see snapshots.py) when the shard has one.
+    def scatter(self, func, *args, from_snapshot=False):
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(self.managers), thread_name_prefix="shard")
+        futures = [self._executor.submit(self._run_on_shard, n, func, args, from_snapshot) for n in range(len(self.managers))]
+        return [future.result() for future in futures]
+
+    def _run_on_shard(self, n, func, args, from_snapshot=False):
+        conn = snapshot_connection(self.paths[n]) if from_snapshot else None
+        return func(conn or self.managers[n].acquire(), *args)
+
+    # Method to fetch one page of the account listing from all shards
+    # Takes the arguments of account_listing.fetch_account_page so it can stand in for it; conn
+    # is ignored. Each shard returns its own first page_size rows after `after` and the sorted
+    # pages are merged, which yields exactly the page a single database would. from_snapshot
+    # reads the shards' reporting snapshots instead of the live files.
+    def fetch_account_page(self, conn=None, after=None, page_size=DEFAULT_PAGE_SIZE, sort_by="acc_num", descending=False, from_snapshot=False, **filters):
+        fetch = functools.partial(fetch_account_page, after=after, page_size=page_size, sort_by=sort_by, descending=descending, **filters)
+        pages = self.scatter(fetch, from_snapshot=from_snapshot)
+        position = SORT_COLUMNS[sort_by][1]
+        rows = heapq.merge(*pages, key=lambda row: (row[position], row[1]), reverse=descending)
+        return list(itertools.islice(rows, page_size))
+
+    # Method to reserve count consecutive account numbers from the catalog's sequence
+    # The sequence starts after the highest account number found on any shard.
+    def reserve_account_numbers(self, count):
+        return reserve_account_numbers(self.catalog_connection(), count, lambda: max(self.scatter(_max_acc_num)))
+
+    # Method to hand out the next account number from the catalog's sequence
+    def allocate_account_number(self):
+        return self.reserve_account_numbers(1)[0]
+
+    # Method to move funds between two accounts on any shards, retrying while a shard is busy
+    # Returns (success, message) like transfer_engine.transfer_funds, which handles transfers
+    # within one shard.
+    def transfer(self, from_acc_num, to_acc_num, amount, max_retries=MAX_RETRIES):
+        if self.shard_of(from_acc_num) == self.shard_of(to_acc_num):
+            return transfer_funds(self.connection_for(from_acc_num), from_acc_num, to_acc_num, amount, max_retries)
+        if not isinstance(amount, int) or isinstance(amount, bool) or amount <= 0:
+            return False, "Invalid amount"
+        attempt = 0
+        while True:
+            try:
+                return self._transfer_across(from_acc_num, to_acc_num, amount)
+            except sqlite3.OperationalError as e:
+                # Only phase one can be busy (phase two runs under locks already held), so a
+                # retry never repeats a transfer that was decided
+                if not is_busy_error(e) or attempt >= max_retries:
+                    raise
+                backoff(attempt)
+                attempt += 1
+
+    # Method to run one cross-shard transfer through both phases
+    def _transfer_across(self, from_acc_num, to_acc_num, amount):
+        source_shard = self.shard_of(from_acc_num)
+        target_shard = self.shard_of(to_acc_num)
+        source = self.managers[source_shard].acquire()
+        target = self.connection_for(to_acc_num)
+        for conn in (source, target):
+            if conn.in_transaction:
+                conn.commit()
+        ordered = (source, target) if source_shard < target_shard else (target, source)
+        delivered = []
+        try:
+            # Phase one: write-lock both shards and make every check
+            for conn in ordered:
+                conn.execute("BEGIN IMMEDIATE")
+            cursor = source.execute("UPDATE accounts SET total_amount = total_amount - ?, total_tra = total_tra + ? WHERE acc_num = ? AND total_amount >= ?",
+                                    (amount, amount, from_acc_num, amount))
+            if cursor.rowcount == 0:
+                found = source.execute("SELECT 1 FROM accounts WHERE acc_num = ?", (from_acc_num,)).fetchone()
+                source.rollback()
+                target.rollback()
+                return False, "Insufficient funds" if found else "Source account not found."
+            if target.execute("SELECT 1 FROM accounts WHERE acc_num = ?", (to_acc_num,)).fetchone() is None:
+                source.rollback()
+                target.rollback()
+                return False, "Target account not found."
+            source.execute("INSERT INTO transactions (acc_num, transaction_type, amount) VALUES (?, 'transfer', ?)", (from_acc_num, -amount))
+            advance_checkpoints(source, (from_acc_num,))
+            advance_aggregates(source)
+            with self._delivered_lock:
+                delivered, self._delivered[source_shard] = self._delivered[source_shard], []
+            source.executemany("DELETE FROM transfer_outbox WHERE xid = ?", ((done,) for done, _ in delivered))
+            xid = source.execute("INSERT INTO transfer_outbox (from_acc_num, to_acc_num, amount) VALUES (?, ?, ?)",
+                                 (from_acc_num, to_acc_num, amount)).lastrowid
+            # Phase two: the source commit, outbox entry included, decides the transfer
+            source.commit()
+        except BaseException:
+            source.rollback()
+            target.rollback()
+            with self._delivered_lock:
+                # The cleanup rolled back with the rest; leave it to the next transfer
+                self._delivered[source_shard].extend(delivered)
+            raise
+        finally:
+            invalidate_accounts(source, from_acc_num)
+        with self._delivered_lock:
+            for done, done_target in delivered:
+                self._cleared[done_target].append((source_shard, done))
+            cleared, self._cleared[target_shard] = self._cleared[target_shard], []
+        # From here on the transfer happens: a failure leaves the credit to complete_transfers
+        try:
+            _deliver(target, source_shard, xid, to_acc_num, amount, cleared)
+        except BaseException:
+            with self._delivered_lock:
+                self._cleared[target_shard].extend(cleared)
+            raise
+        with self._delivered_lock:
+            self._delivered[source_shard].append((xid, target_shard))
+        return True, "Transfer successful."
+
+    # Method to deliver the credits of outbox entries left behind by interrupted transfers
+    # Safe to run while transfers are in flight. Returns the number of entries completed.
+    def complete_transfers(self):
+        completed = 0
+        for source_shard, manager in enumerate(self.managers):
+            source = manager.acquire()
+            entries = source.execute("SELECT xid, to_acc_num, amount FROM transfer_outbox ORDER BY xid").fetchall()
+            for xid, to_acc_num, amount in entries:
+                _deliver(self.connection_for(to_acc_num), source_shard, xid, to_acc_num, amount)
+                source.execute("DELETE FROM transfer_outbox WHERE xid = ?", (xid,))
+                source.commit()
+                with self._delivered_lock:
+                    self._cleared[self.shard_of(to_acc_num)].append((source_shard, xid))
+                completed += 1
+        self.prune_inbox()
+        return completed
+
+    # Method to delete the inbox entries whose outbox entry is gone, such as those whose
+    # deletion was still pending when the process stopped; returns the number deleted
+    # An outbox entry is only deleted after its credit committed, so an inbox entry is dead if
+    # its xid was handed out (it is at most the outbox's AUTOINCREMENT sequence) and isn't in
+    # the outbox. Both are read in one read transaction, so entries of transfers in flight
+    # are never taken for dead ones.
+    def prune_inbox(self):
+        pruned = 0
+        for source_shard, manager in enumerate(self.managers):
+            source = manager.acquire()
+            source.execute("BEGIN")
+            try:
+                issued = source.execute("SELECT IFNULL((SELECT seq FROM sqlite_sequence WHERE name = 'transfer_outbox'), 0)").fetchone()[0]
+                live = {xid for (xid,) in source.execute("SELECT xid FROM transfer_outbox")}
+            finally:
+                source.commit()
+            for target_shard, target in enumerate(self.shard_connections()):
+                if target_shard == source_shard:
+                    continue
+                dead = [(source_shard, xid) for (xid,) in target.execute("SELECT xid FROM transfer_inbox WHERE source_shard = ? AND xid <= ?", (source_shard, issued))
+                        if xid not in live]
+                target.executemany("DELETE FROM transfer_inbox WHERE source_shard = ? AND xid = ?", dead)
+                target.commit()
+                pruned += len(dead)
+        return pruned
+
+    # Method to return (shard path, accounts, transactions, outbox entries) for every shard
+    def status(self):
+        def shard_status(conn):
+            return tuple(conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                         for table in ("accounts", "transactions", "transfer_outbox"))
+        return [(path,) + counts for path, counts in zip(self.paths, self.scatter(shard_status))]
+
+    # Method to close every shard connection and the scatter-gather threads
+    def close_all(self):
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+        for manager in self.managers:
+            manager.close_all()
+
+
+_router = None
+
+
+# Function to open the shards of a catalog database and route account work to them
+# The catalog itself must be configured with connection_pool.configure(path, ...).
+def configure_shards(path=DEFAULT_DATABASE, shard_count=DEFAULT_SHARDS, profile=DEFAULT_PROFILE):
+    global _router
+    close_shards()
+    _router = ShardRouter(path, shard_count, profile)
+    connection_pool.set_router(_router)
+    return _router
+
+
+# Function to return the process-wide shard router, or None when the database isn't sharded
+def get_router():
+    return _router
+
+
+# Function to stop routing to shards and close their connections
+def close_shards():
+    global _router
+    if _router is not None:
+        connection_pool.set_router(None)
+        _router.close_all()
+        _router = None
+
+
+# Function to hand the calling thread's shard connections back, when the database is sharded
+def release_shards():
+    if _router is not None:
+        _router.release()
+
+
+# Function to return the connections that hold account data: every shard's when sharded,
+# otherwise just conn (or the calling thread's pooled connection)
+def data_connections(conn=None):
+    if _router is not None:
+        return _router.shard_connections()
+    return [connection_pool.resolve_connection(conn)]
+
+
+# Function to move the accounts of a single-file database into shard_count shard files
+# The database becomes the catalog. Returns the number of accounts moved to each shard.
+def split_database(path, shard_count):
+    paths = shard_paths(path, shard_count)
+    for shard_path in paths:
+        if os.path.exists(shard_path):
+            raise ValueError(f"{shard_path} already exists")
+    conn = sqlite3.connect(path)
+    try:
+        initialize_database(conn)
+        _initialize_catalog(conn)
+        if conn.execute("SELECT COUNT(*) FROM shard_layout").fetchone()[0]:
+            raise ValueError(f"{path} is already sharded")
+        if conn.execute("SELECT COUNT(*) FROM archive_partitions").fetchone()[0]:
+            raise ValueError("Databases with archived months can't be split")
+        last_acc_num = _max_acc_num(conn)
+        advance_aggregates(conn)
+        conn.commit()
+        journal_mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+        moved = []
+        for n, shard_path in enumerate(paths):
+            shard = sqlite3.connect(shard_path)
+            try:
+                # Switched here, while nothing else has the file open, rather than by the first
+                # of many connections racing to do it
+                shard.execute(f"PRAGMA journal_mode={journal_mode}")
+                _initialize_shard(shard)
+            finally:
+                shard.close()
+            conn.execute("ATTACH DATABASE ? AS shard", (shard_path,))
+            for table in _SHARDED_TABLES:
+                conn.execute(f"INSERT INTO shard.{table} SELECT * FROM main.{table} WHERE acc_num % ? = ?", (shard_count, n))
+            # Everything copied is already aggregated; new rows take ids above the shard's own highest
+            conn.execute("INSERT INTO shard.aggregate_state (id, transaction_id) SELECT 1, IFNULL(MAX(transaction_id), 0) FROM shard.transactions")
+            moved.append(conn.execute("SELECT COUNT(*) FROM shard.accounts").fetchone()[0])
+            conn.commit()
+            conn.execute("DETACH DATABASE shard")
+        for table in _SHARDED_TABLES + ("aggregate_state",):
+            conn.execute(f"DELETE FROM {table}")
+        conn.executemany("INSERT INTO shard_layout (shard, path) VALUES (?, ?)",
+                         [(n, os.path.basename(shard_path)) for n, shard_path in enumerate(paths)])
+        conn.execute("INSERT OR REPLACE INTO account_sequence (id, last_acc_num) VALUES (1, ?)", (last_acc_num,))
+        conn.commit()
+    finally:
+        conn.close()
+    return moved
+
+
+# Function to return the shard count recorded in a catalog database, or None if it isn't sharded
+def recorded_shard_count(path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("SELECT COUNT(*) FROM shard_layout").fetchone()[0] or None
+    except sqlite3.OperationalError:
+        return None
+    finally:
+        conn.close()
+
+
+# Function to return the files holding a database's accounts: its shards, or the file itself
+def data_paths(path):
+    shard_count = recorded_shard_count(path)
+    return shard_paths(path, shard_count) if shard_count else [path]
+
+
+# Function to return the file holding an account of a database, sharded or not
+def account_path(path, acc_num):
+    paths = data_paths(path)
+    return paths[acc_num % len(paths)]
+
+
+# Function to tell whether conn is the catalog of a sharded database
+def is_sharded(conn):
+    try:
+        return conn.execute("SELECT 1 FROM shard_layout LIMIT 1").fetchone() is not None
+    except sqlite3.OperationalError:
+        return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Shard accounts across several database files")
+    parser.add_argument("--db", default=DEFAULT_DATABASE)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    split = subparsers.add_parser("split", help="move the accounts of a single-file database into N shards")
+    split.add_argument("shards", type=int)
+    subparsers.add_parser("status", help="show accounts, transactions and unfinished transfers per shard")
+    subparsers.add_parser("recover", help="finish cross-shard transfers interrupted by a crash")
+    args = parser.parse_args()
+
+    if args.command == "split":
+        moved = split_database(args.db, args.shards)
+        for n, count in enumerate(moved):
+            print(f"shard {n}: {count} accounts")
+        return
+    shard_count = recorded_shard_count(args.db)
+    if shard_count is None:
+        raise SystemExit(f"{args.db} is not sharded")
+    connection_pool.configure(args.db)
+    router = configure_shards(args.db, shard_count)
+    try:
+        completed = router.initialize()
+        if args.command == "recover":
+            print(f"Completed {completed} interrupted transfers.")
+        else:
+            for path, accounts, transactions, pending in router.status():
+                print(f"{path}: {accounts} accounts, {transactions} transactions, {pending} transfers pending")
+    finally:
+        close_shards()
+        connection_pool.close_all()
+
+
+if __name__ == "__main__":
+    main()
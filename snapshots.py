@@ -0,0 +1,277 @@
+# Read-only snapshots of the database for reporting, so long admin scans never share a
+# connection (or a lock) with the tellers' writes.
+# Run from the repository root:  python snapshots.py [--db bank.db] refresh [--io-share 0.1]
+#
+# A snapshot is a copy of a database file (bank_snapshot.db next to bank.db, and one per shard
+# when sharded) made with sqlite3's online backup API, a few pages per step. The copy runs in
+# one read transaction on the primary, so in WAL mode it is a consistent picture of one moment
+# and commits made meanwhile don't restart it. After every step the copier sleeps long enough
+# that copying takes at most io_share of the wall-clock time, which caps the I/O a refresh takes
+# from the primary. The finished copy replaces the previous snapshot file and readers move to it
+# on their next query.
+import argparse
+import os
+import sqlite3
+import threading
+import time
+
+import connection_pool
+
+DEFAULT_REFRESH_INTERVAL = 60.0
+DEFAULT_IO_SHARE = 0.1
+DEFAULT_PAGES_PER_STEP = 64
+
+
+# Function to return the snapshot path of a database file: <root>_snapshot<ext>
+def snapshot_path(path):
+    root, ext = os.path.splitext(path)
+    return f"{root}_snapshot{ext}"
+
+
+class ReadSnapshot:
+    # A periodically refreshed read-only copy of one database file
+    # connection() hands every thread its own read-only connection to the latest copy.
+    def __init__(self, source, path=None, io_share=DEFAULT_IO_SHARE, pages_per_step=DEFAULT_PAGES_PER_STEP):
+        if not 0 < io_share <= 1:
+            raise ValueError("io_share must be in (0, 1]")
+        if pages_per_step < 1:
+            raise ValueError("pages_per_step must be at least 1")
+        self.source = source
+        self.path = path or snapshot_path(source)
+        self.io_share = io_share
+        self.pages_per_step = pages_per_step
+        # Wall-clock time of the moment the current copy shows, None until the first refresh
+        self.taken_at = None
+        self.refreshes = 0
+        self.last_refresh_seconds = 0.0
+        self.last_refresh_pages = 0
+        self._generation = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        if os.path.exists(self.path):
+            # A copy left by an earlier run is usable straight away; its age is the file's
+            self.taken_at = os.path.getmtime(self.path)
+
+    # Method to copy the primary into a new snapshot file and switch readers over to it
+    # Returns the number of pages copied.
+    def refresh(self):
+        with self._refresh_lock:
+            started = time.monotonic()
+            temporary = self.path + ".tmp"
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            source = sqlite3.connect(self.source)
+            target = sqlite3.connect(temporary)
+            try:
+                wal = source.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+                if wal:
+                    # Pin one consistent version of the database for the whole copy; writers
+                    # carry on, as WAL readers don't block them
+                    source.execute("BEGIN")
+                    source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+                taken_at = time.time()
+                pages = [0]
+                step_started = [time.monotonic()]
+
+                def throttle(status, remaining, total):
+                    pages[0] = total - remaining
+                    busy = time.monotonic() - step_started[0]
+                    if remaining and self.io_share < 1 and self._stop.wait(busy * (1 - self.io_share) / self.io_share):
+                        # stop() was called: abandon the copy rather than finish it unthrottled
+                        raise InterruptedError("Snapshot refresh stopped")
+                    step_started[0] = time.monotonic()
+
+                source.backup(target, pages=self.pages_per_step, progress=throttle)
+                # The copy carries the primary's WAL flag; a plain rollback-journal file can be
+                # opened read-only without -wal/-shm side files
+                target.execute("PRAGMA journal_mode=DELETE")
+            except BaseException:
+                target.close()
+                os.remove(temporary)
+                raise
+            finally:
+                if source.in_transaction:
+                    source.rollback()
+                source.close()
+                target.close()
+            os.replace(temporary, self.path)
+            with self._lock:
+                self.taken_at = taken_at
+                self.refreshes += 1
+                self.last_refresh_seconds = time.monotonic() - started
+                self.last_refresh_pages = pages[0]
+                self._generation += 1
+            return pages[0]
+
+    # Method to return the calling thread's read-only connection to the latest copy
+    # Returns None until the first copy exists. A connection to a replaced copy is reopened.
+    def connection(self):
+        with self._lock:
+            if self.taken_at is None:
+                return None
+            generation = self._generation
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.generation == generation:
+            return conn
+        if conn is not None:
+            conn.close()
+        conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+        self._local.conn = conn
+        self._local.generation = generation
+        return conn
+
+    # Method to return how many seconds old the data in the snapshot is, or None without one
+    def staleness(self):
+        with self._lock:
+            return None if self.taken_at is None else max(0.0, time.time() - self.taken_at)
+
+    # Method to report the snapshot's age and refresh counters
+    def status(self):
+        with self._lock:
+            return {
+                "source": self.source,
+                "path": self.path,
+                "taken_at": self.taken_at,
+                "staleness": None if self.taken_at is None else max(0.0, time.time() - self.taken_at),
+                "refreshes": self.refreshes,
+                "last_refresh_seconds": self.last_refresh_seconds,
+                "last_refresh_pages": self.last_refresh_pages,
+            }
+
+    # Method to refresh the snapshot every `interval` seconds on a background thread
+    # The first refresh starts at once; until it finishes readers use the previous copy, if any.
+    def start(self, interval=DEFAULT_REFRESH_INTERVAL):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(interval,), name="snapshot", daemon=True)
+        self._thread.start()
+
+    def _run(self, interval):
+        while not self._stop.is_set():
+            try:
+                self.refresh()
+            except InterruptedError:
+                return
+            except sqlite3.Error as e:
+                # Readers keep the previous copy; the next round tries again
+                print(f"Snapshot refresh of {self.source} failed: {e}")
+            self._stop.wait(interval)
+
+    # Method to stop the refresh thread, abandoning a refresh in progress
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+
+_snapshots = {}
+_snapshots_lock = threading.Lock()
+
+
+# Function to serve the process's reporting reads from snapshots refreshed every `interval` seconds
+# One snapshot is kept of the pooled database, or one per shard when the database is sharded
+# (call after sharding.configure_shards).
+def enable_snapshots(interval=DEFAULT_REFRESH_INTERVAL, io_share=DEFAULT_IO_SHARE, pages_per_step=DEFAULT_PAGES_PER_STEP):
+    disable_snapshots()
+    router = connection_pool.get_router()
+    paths = router.paths if router is not None else [connection_pool.get_manager().path]
+    with _snapshots_lock:
+        for path in paths:
+            snapshot = ReadSnapshot(path, io_share=io_share, pages_per_step=pages_per_step)
+            _snapshots[path] = snapshot
+            snapshot.start(interval)
+
+
+# Function to stop refreshing snapshots; reporting reads go back to the live database
+def disable_snapshots():
+    with _snapshots_lock:
+        snapshots = list(_snapshots.values())
+        _snapshots.clear()
+    for snapshot in snapshots:
+        snapshot.stop()
+
+
+# Function to return the calling thread's snapshot connection for a database file, or None
+def snapshot_connection(path):
+    snapshot = _snapshots.get(path)
+    return snapshot.connection() if snapshot is not None else None
+
+
+# Function to return the connection reporting reads of an account (or, without one, of the
+# unsharded database) should use: its snapshot when there is one, else the live connection
+def reporting_connection(acc_num=None, conn=None):
+    if _snapshots:
+        router = connection_pool.get_router()
+        if router is None:
+            path = connection_pool.get_manager().path
+        elif acc_num is not None:
+            path = router.paths[router.shard_of(acc_num)]
+        else:
+            path = None
+        snapshot_conn = snapshot_connection(path) if path is not None else None
+        if snapshot_conn is not None:
+            return snapshot_conn
+    if acc_num is not None:
+        return connection_pool.account_connection(acc_num, conn)
+    return connection_pool.resolve_connection(conn)
+
+
+# Function to return one reporting connection per file holding account data (every shard when sharded)
+def reporting_connections(conn=None):
+    router = connection_pool.get_router()
+    if router is None:
+        return [reporting_connection(conn=conn)]
+    return [snapshot_connection(path) or live for path, live in zip(router.paths, router.shard_connections())]
+
+
+# Function to return how stale the reporting data is in seconds: the oldest snapshot's age,
+# 0.0 when reports read the live database, or None while a first copy is still being made
+def reporting_staleness():
+    with _snapshots_lock:
+        snapshots = list(_snapshots.values())
+    if not snapshots:
+        return 0.0
+    ages = [snapshot.staleness() for snapshot in snapshots]
+    return None if None in ages else max(ages)
+
+
+# Function to print where the data a report shows comes from
+def describe_staleness():
+    staleness = reporting_staleness()
+    if staleness:
+        print(f"Reporting snapshot, {staleness:.1f} seconds old.")
+
+
+# Function to report every snapshot's status, keyed by database path
+def snapshot_stats():
+    with _snapshots_lock:
+        return {path: snapshot.status() for path, snapshot in _snapshots.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Refresh the read-only reporting snapshots of a database")
+    parser.add_argument("--db", default=connection_pool.DEFAULT_DATABASE)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    refresh = subparsers.add_parser("refresh", help="copy the database (every shard when sharded) into its snapshot")
+    refresh.add_argument("--io-share", type=float, default=DEFAULT_IO_SHARE, help="largest share of wall-clock time spent copying")
+    refresh.add_argument("--pages-per-step", type=int, default=DEFAULT_PAGES_PER_STEP)
+    args = parser.parse_args()
+
+    # Imported here because sharding imports this module
+    from sharding import recorded_shard_count, shard_paths
+
+    shard_count = recorded_shard_count(args.db)
+    for path in shard_paths(args.db, shard_count) if shard_count else [args.db]:
+        snapshot = ReadSnapshot(path, io_share=args.io_share, pages_per_step=args.pages_per_step)
+        pages = snapshot.refresh()
+        print(f"{snapshot.path}: {pages} pages in {snapshot.last_refresh_seconds:.2f}s.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+# Account statement export with bounded memory.
+# Run from the repository root:
+#   python statements.py [--db bank.db] export ACC_NUM OUTPUT [--format csv|columnar] [--start DATE] [--end DATE]
+#   python statements.py [--db bank.db] export-all DIRECTORY [--format csv|columnar] [--workers N] [--start DATE] [--end DATE]
+#   python statements.py dump FILE.sfs
+#
+# The columnar format (.sfs) is a small header followed by blocks of up to FETCH_ROWS rows.
+# Each block is a little-endian uint32 row count and then one typed array per column:
+# transaction_id int64, timestamp int64 (Unix seconds, UTC), amount int64, type uint8.
+import argparse
+import array
+import concurrent.futures
+import csv
+import datetime
+import multiprocessing
+import os
+import sqlite3
+import struct
+import sys
+
+from archive import ledger_windows, window_select, window_tables
+from history import HISTORY_HEADERS, format_timestamp
+from schema import LEDGER_TYPES, initialize_database
+from sharding import account_path, data_paths
+
+FETCH_ROWS = 5000
+COLUMNAR_MAGIC = b"SFFSTMT1"
+# Codes stored in the type column; the order is part of the file format
+TRANSACTION_TYPES = ("other",) + LEDGER_TYPES
+FORMATS = {"csv": ".csv", "columnar": ".sfs"}
+
+_TYPE_CODE = "CASE transaction_type " + " ".join(f"WHEN '{kind}' THEN {code}" for code, kind in enumerate(TRANSACTION_TYPES) if code) + " ELSE 0 END"
+_ACCOUNTS_PER_TASK = 64
+
+
+# Function to stream an account's ledger rows, oldest first, in batches of at most fetch_rows
+# start is inclusive and end is exclusive, as in history.iter_history_pages. Each ledger window
+# (the hot table, or an archived month read together with it) is one query read with fetchmany.
+def _statement_batches(conn, acc_num, columns, start=None, end=None, fetch_rows=FETCH_ROWS):
+    for window in ledger_windows(conn, format_timestamp(start), format_timestamp(end)):
+        sql, params = window_select(window_tables(conn, window), columns, ["acc_num = ?"], [acc_num], window[2], window[3])
+        cursor = conn.execute(sql + " ORDER BY timestamp, transaction_id", params)
+        while True:
+            rows = cursor.fetchmany(fetch_rows)
+            if not rows:
+                break
+            yield rows
+
+
+# Function to write an account's statement to a CSV file, FETCH_ROWS rows at a time
+# Returns the number of transactions written.
+def export_statement_csv(conn, acc_num, path, start=None, end=None, fetch_rows=FETCH_ROWS):
+    written = 0
+    with open(path, "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(HISTORY_HEADERS)
+        for rows in _statement_batches(conn, acc_num, "transaction_id, transaction_type, amount, timestamp", start, end, fetch_rows):
+            writer.writerows(rows)
+            written += len(rows)
+    return written
+
+
+# Function to write one typed array to a file in little-endian byte order
+def _write_array(file, values):
+    if sys.byteorder == "big":
+        values.byteswap()
+    values.tofile(file)
+
+
+# Function to write an account's statement to a columnar .sfs file, one block per fetch
+# Returns the number of transactions written.
+def export_statement_columnar(conn, acc_num, path, start=None, end=None, fetch_rows=FETCH_ROWS):
+    columns = f"transaction_id, CAST(strftime('%s', timestamp) AS INTEGER), amount, {_TYPE_CODE}"
+    written = 0
+    with open(path, "wb") as file:
+        file.write(COLUMNAR_MAGIC)
+        file.write(struct.pack("<q", acc_num))
+        for rows in _statement_batches(conn, acc_num, columns, start, end, fetch_rows):
+            ids, timestamps, amounts, types = zip(*rows)
+            file.write(struct.pack("<I", len(rows)))
+            _write_array(file, array.array("q", ids))
+            _write_array(file, array.array("q", timestamps))
+            _write_array(file, array.array("q", amounts))
+            _write_array(file, array.array("B", types))
+            written += len(rows)
+    return written
+
+
+_EXPORTERS = {"csv": export_statement_csv, "columnar": export_statement_columnar}
+
+
+# Function to export one account's statement in the given format ('csv' or 'columnar')
+def export_statement(conn, acc_num, path, fmt="csv", start=None, end=None, fetch_rows=FETCH_ROWS):
+    if fmt not in _EXPORTERS:
+        raise ValueError(f"Unknown statement format: {fmt}")
+    return _EXPORTERS[fmt](conn, acc_num, path, start, end, fetch_rows)
+
+
+# Function to read a columnar statement back one block at a time
+# Yields (transaction_ids, timestamps, amounts, types) typed arrays per block.
+def iter_columnar_blocks(path):
+    with open(path, "rb") as file:
+        if file.read(len(COLUMNAR_MAGIC)) != COLUMNAR_MAGIC:
+            raise ValueError(f"{path} is not a statement file")
+        file.read(8)
+        while True:
+            header = file.read(4)
+            if not header:
+                return
+            count = struct.unpack("<I", header)[0]
+            block = []
+            for typecode in ("q", "q", "q", "B"):
+                values = array.array(typecode)
+                values.fromfile(file, count)
+                if sys.byteorder == "big":
+                    values.byteswap()
+                block.append(values)
+            yield tuple(block)
+
+
+# Function to stream a columnar statement as (transaction_id, transaction_type, amount, timestamp) rows
+def iter_columnar_statement(path):
+    for ids, timestamps, amounts, types in iter_columnar_blocks(path):
+        for row in zip(ids, types, amounts, timestamps):
+            timestamp = datetime.datetime.fromtimestamp(row[3], datetime.timezone.utc)
+            yield row[0], TRANSACTION_TYPES[row[1]], row[2], timestamp.strftime("%Y-%m-%d %H:%M:%S")
+
+
+# Function to export the statements of a group of accounts; runs in a worker process
+def _export_accounts(db_path, acc_nums, directory, fmt, start, end):
+    conn = sqlite3.connect(db_path)
+    try:
+        written = 0
+        for acc_num in acc_nums:
+            written += export_statement(conn, acc_num, os.path.join(directory, f"{acc_num}{FORMATS[fmt]}"), fmt, start, end)
+        return len(acc_nums), written
+    finally:
+        conn.close()
+
+
+# Function to export every account's statement into `directory`, one file per account
+# Accounts are handed to a process pool in groups, read from their shard when the database is
+# sharded; returns (files_written, transactions_written).
+def export_all_statements(db_path, directory, fmt="csv", start=None, end=None, workers=None):
+    if fmt not in _EXPORTERS:
+        raise ValueError(f"Unknown statement format: {fmt}")
+    os.makedirs(directory, exist_ok=True)
+    start = format_timestamp(start)
+    end = format_timestamp(end)
+    tasks = []
+    for path in data_paths(db_path):
+        conn = sqlite3.connect(path)
+        try:
+            initialize_database(conn)
+            acc_nums = [row[0] for row in conn.execute("SELECT acc_num FROM accounts ORDER BY acc_num")]
+        finally:
+            conn.close()
+        tasks.extend((path, acc_nums[i:i + _ACCOUNTS_PER_TASK]) for i in range(0, len(acc_nums), _ACCOUNTS_PER_TASK))
+
+    files = 0
+    written = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = [pool.submit(_export_accounts, path, acc_nums, directory, fmt, start, end) for path, acc_nums in tasks]
+        for future in concurrent.futures.as_completed(futures):
+            task_files, task_rows = future.result()
+            files += task_files
+            written += task_rows
+    return files, written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Account statement export")
+    parser.add_argument("--db", default="bank.db")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export = subparsers.add_parser("export", help="export one account's statement")
+    export.add_argument("acc_num", type=int)
+    export.add_argument("output")
+    export_all = subparsers.add_parser("export-all", help="export every account's statement, one file per account")
+    export_all.add_argument("directory")
+    export_all.add_argument("--workers", type=int, default=None)
+    for command in (export, export_all):
+        command.add_argument("--format", choices=sorted(FORMATS), default="csv")
+        command.add_argument("--start", help="first day included, 'YYYY-MM-DD[ HH:MM:SS]'")
+        command.add_argument("--end", help="first day excluded, 'YYYY-MM-DD[ HH:MM:SS]'")
+    dump = subparsers.add_parser("dump", help="print a columnar statement file as CSV")
+    dump.add_argument("path")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        conn = sqlite3.connect(account_path(args.db, args.acc_num))
+        try:
+            initialize_database(conn)
+            written = export_statement(conn, args.acc_num, args.output, args.format, args.start, args.end)
+        finally:
+            conn.close()
+        print(f"Wrote {written} transactions to {args.output}.")
+    elif args.command == "export-all":
+        files, written = export_all_statements(args.db, args.directory, args.format, args.start, args.end, args.workers)
+        print(f"Wrote {files} statements with {written} transactions to {args.directory}.")
+    else:
+        writer = csv.writer(sys.stdout)
+        writer.writerow(HISTORY_HEADERS)
+        writer.writerows(iter_columnar_statement(args.path))
+
+
+if __name__ == "__main__":
+    main()
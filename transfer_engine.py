@@ -0,0 +1,86 @@
+import random
+import sqlite3
+import time
+
+from account_repository import invalidate_accounts
+from aggregates import advance_aggregates
+from checkpoints import advance_checkpoints
+
+MAX_RETRIES = 8
+BASE_BACKOFF = 0.005  # seconds
+MAX_BACKOFF = 0.25  # seconds
+
+
+# Function to tell whether an sqlite error means another connection holds the write lock
+def is_busy_error(error):
+    if not isinstance(error, sqlite3.OperationalError):
+        return False
+    code = getattr(error, 'sqlite_errorcode', None)
+    if code is not None:
+        return code & 0xff in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+    message = str(error).lower()
+    return "locked" in message or "busy" in message
+
+
+# Function to sleep before the next retry using exponential backoff with jitter
+def backoff(attempt, base_delay=BASE_BACKOFF, max_delay=MAX_BACKOFF):
+    delay = min(max_delay, base_delay * (2 ** attempt))
+    time.sleep(delay * random.uniform(0.5, 1.5))
+
+
+# Function to run the debit, the credit and both ledger rows as a single write transaction
+def _transfer_once(conn, from_acc_num, to_acc_num, amount):
+    cursor = conn.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        # Touch the two rows in ascending account order so every transfer acquires them the same way
+        for acc_num in sorted((from_acc_num, to_acc_num)):
+            if acc_num == from_acc_num:
+                cursor.execute("UPDATE accounts SET total_amount = total_amount - ?, total_tra = total_tra + ? WHERE acc_num = ? AND total_amount >= ?",
+                               (amount, amount, from_acc_num, amount))
+                if cursor.rowcount == 0:
+                    cursor.execute("SELECT 1 FROM accounts WHERE acc_num = ?", (from_acc_num,))
+                    message = "Insufficient funds" if cursor.fetchone() else "Source account not found."
+                    conn.rollback()
+                    return False, message
+            else:
+                cursor.execute("UPDATE accounts SET total_amount = total_amount + ? WHERE acc_num = ?", (amount, to_acc_num))
+                if cursor.rowcount == 0:
+                    conn.rollback()
+                    return False, "Target account not found."
+
+        cursor.executemany("INSERT INTO transactions (acc_num, transaction_type, amount) VALUES (?, ?, ?)",
+                           [(from_acc_num, 'transfer', -amount), (to_acc_num, 'transfer', amount)])
+        advance_checkpoints(conn, (from_acc_num, to_acc_num))
+        advance_aggregates(conn)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        invalidate_accounts(conn, from_acc_num, to_acc_num)
+    return True, "Transfer successful."
+
+
+# Function to move funds between two accounts atomically, retrying while the database is busy
+# Returns (success, message). The balance check happens in SQL, so concurrent sessions can
+# never overdraw the source account or lose each other's updates. Raises RuntimeError if conn
+# already has a transaction open.
+def transfer_funds(conn, from_acc_num, to_acc_num, amount, max_retries=MAX_RETRIES):
+    if not isinstance(amount, int) or isinstance(amount, bool) or amount <= 0:
+        return False, "Invalid amount"
+    if from_acc_num == to_acc_num:
+        return False, "Cannot transfer to the same account."
+    if conn.in_transaction:
+        # BEGIN IMMEDIATE cannot nest, and committing here would commit the caller's writes too
+        raise RuntimeError("transfer_funds needs a connection with no open transaction; commit or roll back first")
+
+    attempt = 0
+    while True:
+        try:
+            return _transfer_once(conn, from_acc_num, to_acc_num, amount)
+        except sqlite3.OperationalError as e:
+            if not is_busy_error(e) or attempt >= max_retries:
+                raise
+            backoff(attempt)
+            attempt += 1